@@ -0,0 +1,529 @@
+"""
+Offline CPU benchmark for modal_service.py.
+
+Builds tiny randomly initialized SDXL t2i / i2i / inpaint pipelines, LoRA
+styles, an IP-Adapter and a safety checker from local configs, then drives
+SDXLLoRAHost's own startup and generation code outside Modal: no GPU, no
+network, no Hub weights. Results are flat JSON metrics so two runs (e.g. two
+commits on the same machine) can be compared:
+
+    python modal/bench_offline.py --out base.json
+    python modal/bench_offline.py --out new.json --baseline base.json
+
+Needs the image's Python packages (torch, diffusers, transformers, peft,
+Pillow, numpy) and the modal client to import the app module. The absolute
+numbers say nothing about A100 latency; only compare runs on one machine.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest import mock
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from diffusers import (
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+    StableDiffusionXLInpaintPipeline,
+    StableDiffusionXLPipeline,
+    UNet2DConditionModel,
+)
+from diffusers.models.attention_processor import IPAdapterAttnProcessor
+from diffusers.models.embeddings import ImageProjection
+from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+from peft import LoraConfig
+from peft.utils import get_peft_model_state_dict
+from transformers import (
+    CLIPConfig,
+    CLIPImageProcessor,
+    CLIPTextConfig,
+    CLIPTextModel,
+    CLIPTextModelWithProjection,
+    CLIPTokenizer,
+    CLIPVisionConfig,
+    CLIPVisionModelWithProjection,
+)
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import modal_service as svc
+
+# Pixel size of every generation (tiny VAE: 2x downsampling, UNet sample_size 32)
+SIZE = 64
+STEPS = 4
+STYLES = ("anime", "90s_anime", "ghibli", "pixar")
+# A metric is a regression when it moves the wrong way by more than this fraction
+REGRESSION_THRESHOLD = 0.15
+
+# ───────────────────────── Tiny random models ───────────────────────── #
+TEXT_HIDDEN = 32
+CROSS_ATTENTION_DIM = 2 * TEXT_HIDDEN   # both text encoders' hidden states, concatenated
+
+def _tiny_tokenizer(root: str) -> CLIPTokenizer:
+    """Byte-level CLIP BPE without merges: every byte is a token (with and without the word end)."""
+    chars = list(bytes_to_unicode().values())
+    vocab = {tok: i for i, tok in enumerate(chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"])}
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(root, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(os.path.join(root, "vocab.json"), os.path.join(root, "merges.txt"), model_max_length=77)
+
+def _text_config(tokenizer: CLIPTokenizer) -> CLIPTextConfig:
+    eos = tokenizer.convert_tokens_to_ids("<|endoftext|>")
+    return CLIPTextConfig(
+        vocab_size=len(tokenizer), hidden_size=TEXT_HIDDEN, intermediate_size=37, projection_dim=TEXT_HIDDEN,
+        num_hidden_layers=5, num_attention_heads=4, max_position_embeddings=77, hidden_act="gelu",
+        bos_token_id=tokenizer.convert_tokens_to_ids("<|startoftext|>"), eos_token_id=eos, pad_token_id=eos,
+    )
+
+def _tiny_unet(in_channels: int = 4) -> UNet2DConditionModel:
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64), layers_per_block=2, sample_size=SIZE // 2, in_channels=in_channels, out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"), up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4), use_linear_projection=True, transformer_layers_per_block=(1, 2),
+        addition_embed_type="text_time", addition_time_embed_dim=8,
+        # 6 size/crop time ids * 8 + the pooled text_encoder_2 projection
+        projection_class_embeddings_input_dim=6 * 8 + TEXT_HIDDEN,
+        cross_attention_dim=CROSS_ATTENTION_DIM, norm_num_groups=1,
+    )
+
+def _tiny_vae() -> AutoencoderKL:
+    return AutoencoderKL(
+        block_out_channels=(32, 64), in_channels=3, out_channels=3, latent_channels=4, norm_num_groups=32,
+        down_block_types=("DownEncoderBlock2D",) * 2, up_block_types=("UpDecoderBlock2D",) * 2, sample_size=SIZE * 2,
+    )
+
+def _tiny_scheduler() -> EulerDiscreteScheduler:
+    return EulerDiscreteScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", steps_offset=1, timestep_spacing="leading",
+    )
+
+def _tiny_base(root: str) -> StableDiffusionXLPipeline:
+    tokenizer = _tiny_tokenizer(os.path.join(root, "tokenizer"))
+    config = _text_config(tokenizer)
+    return StableDiffusionXLPipeline(
+        vae=_tiny_vae(), unet=_tiny_unet(), scheduler=_tiny_scheduler(),
+        text_encoder=CLIPTextModel(config), text_encoder_2=CLIPTextModelWithProjection(config),
+        tokenizer=tokenizer, tokenizer_2=tokenizer,
+    )
+
+def _tiny_safety_checker() -> StableDiffusionSafetyChecker:
+    vision = dict(
+        hidden_size=32, intermediate_size=37, num_hidden_layers=2, num_attention_heads=4,
+        image_size=svc.CLIP_SIZE, patch_size=32,
+    )
+    return StableDiffusionSafetyChecker(CLIPConfig(text_config={}, vision_config=vision, projection_dim=32))
+
+def _tiny_ip_adapter(unet: UNet2DConditionModel) -> tuple:
+    """(image encoder, its processor, IP-Adapter state dict in the checkpoint layout load_ip_adapter reads)."""
+    encoder = CLIPVisionModelWithProjection(CLIPVisionConfig(
+        hidden_size=32, intermediate_size=37, projection_dim=32, num_hidden_layers=2, num_attention_heads=4,
+        image_size=32, patch_size=4,
+    ))
+    processor = CLIPImageProcessor(size=32, crop_size=32)
+
+    ip_adapter, key_id = {}, 1
+    for name in unet.attn_processors:
+        if name.endswith("attn1.processor"):
+            continue
+        if name.startswith("mid_block"):
+            hidden_size = unet.config.block_out_channels[-1]
+        elif name.startswith("up_blocks"):
+            hidden_size = list(reversed(unet.config.block_out_channels))[int(name[len("up_blocks.")])]
+        else:
+            hidden_size = unet.config.block_out_channels[int(name[len("down_blocks.")])]
+        sd = IPAdapterAttnProcessor(hidden_size=hidden_size, cross_attention_dim=CROSS_ATTENTION_DIM).state_dict()
+        ip_adapter[f"{key_id}.to_k_ip.weight"] = sd["to_k_ip.0.weight"]
+        ip_adapter[f"{key_id}.to_v_ip.weight"] = sd["to_v_ip.0.weight"]
+        key_id += 2
+    proj = ImageProjection(
+        cross_attention_dim=CROSS_ATTENTION_DIM, image_embed_dim=encoder.config.projection_dim, num_image_text_embeds=4,
+    ).state_dict()
+    image_proj = {
+        "proj.weight": proj["image_embeds.weight"], "proj.bias": proj["image_embeds.bias"],
+        "norm.weight": proj["norm.weight"], "norm.bias": proj["norm.bias"],
+    }
+    return encoder, processor, {"image_proj": image_proj, "ip_adapter": ip_adapter}
+
+def _tiny_lora(root: str, text_config: CLIPTextConfig, seed: int) -> str:
+    """A random UNet + text_encoder LoRA saved like a Hub style repo; returns its directory."""
+    torch.manual_seed(seed)
+    unet, text_encoder = _tiny_unet(), CLIPTextModel(text_config)
+    unet.add_adapter(LoraConfig(r=4, lora_alpha=4, init_lora_weights=False, target_modules=["to_q", "to_k", "to_v", "to_out.0"]))
+    text_encoder.add_adapter(LoraConfig(r=4, lora_alpha=4, init_lora_weights=False, target_modules=["q_proj", "k_proj", "v_proj", "out_proj"]))
+    StableDiffusionXLPipeline.save_lora_weights(
+        root,
+        unet_lora_layers=get_peft_model_state_dict(unet),
+        text_encoder_lora_layers=get_peft_model_state_dict(text_encoder),
+    )
+    return root
+
+@contextmanager
+def _tiny_host(root: str):
+    """
+    A started SDXLLoRAHostBase whose weight sources are the tiny models above.
+    The module settings it needs are patched for the duration and restored on exit.
+    """
+    config = _text_config(_tiny_tokenizer(os.path.join(root, "tokenizer")))
+    overrides = {
+        "LORAS": {name: _tiny_lora(os.path.join(root, "loras", name), config, seed=i) for i, name in enumerate(STYLES)},
+        "WARMUP_BUCKETS": {
+            "t2i": ((SIZE, SIZE), (2 * SIZE, SIZE), (SIZE, 2 * SIZE)),
+            "i2i": ((SIZE, SIZE),),
+            "inpaint": ((SIZE, SIZE),),
+        },
+        "RESULT_CACHE_MB": 0,             # measure the work, not the result cache
+        "T2I_BATCH_WINDOW_MS": 0,         # _bench_batching turns it on explicitly
+        "METRICS_PUBLISH_INTERVAL_S": 0,  # no metrics_snapshots Dict offline
+    }
+
+    class TinyHost(svc.SDXLLoRAHostBase):
+        # offload hooks move each model to cuda:0 before its forward; there is none here
+        cpu_offload = False
+
+        def _base_pipeline(self):
+            return _tiny_base(root)
+
+        def _safety_model(self):
+            return _tiny_safety_checker()
+
+        def _inpaint_weights(self) -> dict:
+            return {"unet": _tiny_unet(in_channels=9), "vae": _tiny_vae()}
+
+        def _inpaint_pipeline(self):
+            return StableDiffusionXLInpaintPipeline(
+                scheduler=_tiny_scheduler(),
+                **self._inpaint_parts,
+                **self.pipes.components_of("t2i", svc.INPAINT_SHARED_COMPONENTS),
+            )
+
+        def _attach_ip_adapter(self, pipe):
+            encoder, processor, state_dict = _tiny_ip_adapter(pipe.unet)
+            pipe.register_modules(image_encoder=encoder.to(pipe.device), feature_extractor=processor)
+            pipe.unet._load_ip_adapter_weights([state_dict])
+
+    with mock.patch.multiple(svc, **overrides):
+        torch.manual_seed(0)
+        host = TinyHost()
+        host.load_weights()
+        host.setup()
+        host.loader.require("inpaint")
+        try:
+            yield host
+        finally:
+            host.encode_pool.shutdown(wait=True)
+
+# ───────────────────────── Inputs ───────────────────────── #
+def _png(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def _jpeg(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def _photo(w: int, h: int, seed: int) -> Image.Image:
+    """Smooth gradients plus noise: compresses and resizes like a photo, not like flat color."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w]
+    base = np.stack([x / w, y / h, (x + y) / (w + h)], axis=-1) * 200.0
+    arr = np.clip(base + rng.normal(0, 12, (h, w, 3)), 0, 255).astype(np.uint8)
+    return Image.fromarray(arr)
+
+def _mask(w: int, h: int) -> Image.Image:
+    mask = Image.new("L", (w, h), 0)
+    ImageDraw.Draw(mask).ellipse((w // 4, h // 4, 3 * w // 4, 3 * h // 4), fill=255)
+    return mask
+
+# ───────────────────────── Cases ───────────────────────── #
+def _timed(fn, repeats: int) -> list:
+    times = []
+    for _ in range(max(1, repeats)):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return times
+
+def _p50(values) -> float:
+    return round(svc._percentile(values, 0.5), 3)
+
+def _bench_startup(host) -> dict:
+    ready = host._readiness()
+    out = {f"startup.{stage}_s": s for stage, s in ready["stages_s"].items()}
+    out.update({f"startup.load.{name}_s": s for name, s in ready["load_s"].items()})
+    return out
+
+def _bench_adapters(host, repeats: int) -> dict:
+    """Style switches through _set_adapter: cycling the resident pool, no-ops, off, and evict + re-inject."""
+    cycle = list(STYLES) + ["none"]
+    out = {
+        "adapters.cycle_ms_p50": _p50(_timed(lambda: [host._set_adapter(a) for a in cycle], repeats)) / len(cycle),
+        "adapters.noop_ms_p50": _p50(_timed(lambda: host._set_adapter("none"), repeats)),
+    }
+    # a one-slot pool turns every style change into an evict + inject from host memory
+    max_resident = host.loras.max_resident
+    host.loras.max_resident = 1
+    try:
+        out["adapters.reinject_ms_p50"] = _p50(_timed(lambda: [host._set_adapter(a) for a in STYLES[:2]], repeats)) / 2
+    finally:
+        host.loras.max_resident = max_resident
+        host._set_adapter("none")
+    for kind, s in host.loras.stats()["switch_ms"].items():
+        if isinstance(s, dict) and "p50" in s:
+            out[f"adapters.switch_{kind}_ms_p50"] = s["p50"]
+    return out
+
+def _bench_preprocess(repeats: int) -> dict:
+    """Web-side prep (inpaint decode, canvas, mask, ref; i2i init) at production sizes; pure PIL/numpy."""
+    bg, mask, ref = _jpeg(_photo(1536, 1152, 1)), _png(_mask(1536, 1152)), _jpeg(_photo(960, 1280, 2))
+    report = svc.benchmark_preprocess.local(bg, mask, ref, out_size=1024, repeats=repeats)
+    out = {f"preprocess.{stage}_ms_p50": ms for stage, ms in report["new_ms"].items()}
+    out["preprocess.mask_mean_abs_diff"] = report["mask_mean_abs_diff"]
+    out["preprocess.init_mean_abs_diff"] = report["init_mean_abs_diff"]
+    out["preprocess.ref_mean_abs_diff"] = report["ref_mean_abs_diff"]
+    return out
+
+def _bench_host_prep(host, repeats: int) -> dict:
+    """Host-side canvas prep from raw uploads, canvas cache cleared every time."""
+    bg, mask = _jpeg(_photo(1536, 1152, 3)), _png(_mask(1536, 1152))
+
+    def _cold():
+        host.canvas_cache = svc._LRUCache(max_items=svc.CANVAS_CACHE_SIZE)
+        host._prep_inpaint_canvas(bg, mask, 1024)
+    return {"host_prep.canvas_cold_ms_p50": _p50(_timed(_cold, repeats))}
+
+def _bench_safety(host, repeats: int) -> dict:
+    out = {}
+    for batch in (1, 4):
+        images = torch.rand(batch, 3, SIZE, SIZE)
+        out[f"safety.batch{batch}_ms_per_image_p50"] = _p50(_timed(lambda: host._safety_check(images), repeats)) / batch
+    return out
+
+def _bench_encode(repeats: int) -> dict:
+    report = svc.benchmark_encode.local(_png(_photo(1024, 1024, 4)), repeats=repeats)
+    out = {}
+    for fmt, r in report.items():
+        out[f"encode.{fmt}_ms_p50"] = r["ms_p50"]
+        out[f"encode.{fmt}_bytes"] = r["bytes"]
+    return out
+
+def _generate(host, kind: str, seed: int, inputs: dict, **extra):
+    common = dict(seed=seed, return_timings=True, **extra)
+    if kind == "t2i":
+        return host.generate_t2i(prompt="a fox in a forest", width=SIZE, height=SIZE, steps=STEPS, **common)
+    if kind == "i2i":
+        return host.generate_i2i(prompt="a fox in a forest", image_bytes=inputs["init"], out_size=SIZE, steps=2 * STEPS, **common)
+    return host.generate_inpaint_ref(
+        prompt="a child smiling", bg_image_bytes=inputs["bg"], mask_bytes=inputs["mask"],
+        ref_image_bytes=inputs["ref"], out_size=SIZE, steps=STEPS, **common,
+    )
+
+def _generate_inputs() -> dict:
+    return {
+        "init": _png(_photo(SIZE, SIZE, 5)),
+        "bg": _png(_photo(SIZE, SIZE, 6)),
+        "mask": _png(_mask(SIZE, SIZE)),
+        "ref": _png(_photo(SIZE, SIZE, 7)),
+    }
+
+def _bench_generate(host, repeats: int) -> dict:
+    """Seeded end-to-end host calls with return_timings: throughput and per-stage p50 from the traces."""
+    inputs = _generate_inputs()
+    out = {}
+    for kind in ("t2i", "i2i", "inpaint"):
+        for style in ("none", STYLES[0]):
+            _generate(host, kind, 0, inputs, adapter=style)   # first call per style pays the switch
+            traces, totals = [], []
+            for i in range(max(1, repeats)):
+                t0 = time.perf_counter()
+                _, safety = _generate(host, kind, i, inputs, adapter=style)
+                totals.append((time.perf_counter() - t0) * 1000.0)
+                traces.append(safety["timings"])
+            prefix = f"generate.{kind}.{style}"
+            out[f"{prefix}.ms_p50"] = _p50(totals)
+            out[f"{prefix}.images_per_s"] = round(1000.0 * len(totals) / sum(totals), 3)
+            for stage in sorted({s for t in traces for s in t["stages_ms"]}):
+                out[f"{prefix}.{stage}_ms_p50"] = _p50([t["stages_ms"].get(stage, 0.0) for t in traces])
+    return out
+
+def _bench_candidates(host, candidates: int, repeats: int) -> dict:
+    """num_candidates in one call vs the same seeds as separate calls, per kind."""
+    inputs, out = _generate_inputs(), {}
+    for kind in ("t2i", "i2i", "inpaint"):
+        loop = _p50(_timed(lambda: [_generate(host, kind, i, inputs) for i in range(candidates)], repeats))
+        batch = _p50(_timed(lambda: _generate(host, kind, 0, inputs, num_candidates=candidates), repeats))
+        out[f"candidates.{kind}.loop_images_per_s"] = round(1000.0 * candidates / loop, 3)
+        out[f"candidates.{kind}.batch_images_per_s"] = round(1000.0 * candidates / batch, 3)
+    return out
+
+def _bench_deepcache(host) -> dict:
+    """Fixed-prompt t2i at cache_interval 2-4 vs the full run: speedup and PSNR against it."""
+    report = host.benchmark_deepcache(intervals=(2, 3, 4), steps=4 * STEPS, size=SIZE)
+    out = {"deepcache.full_ms_p50": report["intervals"]["1"]["ms_p50"]}
+    for interval, row in report["intervals"].items():
+        if interval != "1":
+            out[f"deepcache.i{interval}.ms_p50"] = row["ms_p50"]
+            out[f"deepcache.i{interval}.psnr_db"] = row["psnr_db"]
+    return out
+
+def _bench_lora_fuse(host, repeats: int) -> dict:
+    """Seeded t2i with the first style live vs fused into the base weights."""
+    report = host.benchmark_lora_fuse(adapter=STYLES[0], steps=STEPS, size=SIZE, repeats=repeats)
+    return {
+        "lora_fuse.unfused_ms_p50": report["unfused_ms_p50"],
+        "lora_fuse.fused_ms_p50": report["fused_ms_p50"],
+        "lora_fuse.mean_abs_diff": report["mean_abs_diff"],
+    }
+
+def _bench_batching(host, requests: int, window_ms: float, max_batch: int) -> dict:
+    """Concurrent t2i requests with the micro-batcher off vs on: images/s and mean batch size."""
+    out = {}
+    for name, batcher in (("off", None), ("on", svc._MicroBatcher(host._run_t2i, window_ms, max_batch))):
+        host.t2i_batcher = batcher
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_batch) as pool:
+            list(pool.map(
+                lambda i: host.generate_t2i(prompt=f"a fox #{i}", width=SIZE, height=SIZE, steps=STEPS, seed=i),
+                range(requests),
+            ))
+        out[f"batching.{name}.images_per_s"] = round(requests / (time.perf_counter() - t0), 3)
+        if batcher is not None:
+            out["batching.on.batch_size_mean"] = batcher.stats()["mean_batch"]
+    host.t2i_batcher = None
+    return out
+
+def _bench_concurrency(host, requests: int, levels=(1, 2, 4)) -> dict:
+    """
+    i2i and inpaint requests from raw camera-sized uploads with 1, 2 and 4 in
+    flight, the way concurrent Modal inputs share one host: images/s. Every
+    request has its own images, so host-side decode and canvas prep always run.
+    """
+    out = {}
+    for level in levels:
+        uploads = [
+            (_jpeg(_photo(1536, 1152, 100 * level + i)), _png(_mask(1536, 1152)))
+            for i in range(requests)
+        ]
+
+        def _one(i):
+            image, mask = uploads[i]
+            if i % 2:
+                return host.generate_inpaint_ref(
+                    prompt="a child smiling", bg_image_bytes=image, mask_bytes=mask,
+                    ref_image_bytes=uploads[0][0], out_size=SIZE, steps=STEPS, seed=i,
+                )
+            return host.generate_i2i(prompt="a fox in a forest", image_bytes=image, out_size=SIZE, steps=2 * STEPS, seed=i)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as pool:
+            list(pool.map(_one, range(requests)))
+        out[f"concurrency.c{level}.images_per_s"] = round(requests / (time.perf_counter() - t0), 3)
+    return out
+
+# ───────────────────────── Report ───────────────────────── #
+def _git_rev() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def _higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_s") or metric.endswith("batch_size_mean")
+
+def compare(baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD) -> dict:
+    """Per shared latency/throughput metric: baseline, current, ratio; regressions listed separately."""
+    rows, regressions = {}, []
+    for metric, new in sorted(current["metrics"].items()):
+        old = baseline["metrics"].get(metric)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old <= 0:
+            continue
+        if not (metric.endswith(("ms_p50", "_s", "_bytes")) or _higher_is_better(metric)):
+            continue
+        ratio = new / old
+        rows[metric] = {"baseline": old, "current": new, "ratio": round(ratio, 3)}
+        worse = ratio < 1.0 - threshold if _higher_is_better(metric) else ratio > 1.0 + threshold
+        if worse:
+            regressions.append(metric)
+    return {"threshold": threshold, "metrics": rows, "regressions": regressions}
+
+def run(repeats: int = 5, batch_requests: int = 8, seed: int = 0) -> dict:
+    random.seed(seed)
+    torch.manual_seed(seed)
+    torch.set_num_threads(max(1, min(8, os.cpu_count() or 1)))
+    metrics = {}
+    with tempfile.TemporaryDirectory(prefix="sdxl-bench-") as root:
+        t0 = time.perf_counter()
+        with _tiny_host(root) as host:
+            metrics["startup.total_s"] = round(time.perf_counter() - t0, 3)
+            metrics.update(_bench_startup(host))
+            metrics.update(_bench_adapters(host, repeats))
+            metrics.update(_bench_preprocess(repeats))
+            metrics.update(_bench_host_prep(host, repeats))
+            metrics.update(_bench_safety(host, repeats))
+            metrics.update(_bench_encode(repeats))
+            metrics.update(_bench_generate(host, repeats))
+            metrics.update(_bench_candidates(host, 4, repeats))
+            metrics.update(_bench_lora_fuse(host, repeats))
+            metrics.update(_bench_deepcache(host))
+            metrics.update(_bench_batching(host, batch_requests, window_ms=20.0, max_batch=4))
+            metrics.update(_bench_concurrency(host, batch_requests))
+    return {
+        "meta": {
+            "git_rev": _git_rev(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpu": platform.processor() or platform.machine(),
+            "threads": torch.get_num_threads(),
+            "size": SIZE,
+            "steps": STEPS,
+            "repeats": repeats,
+        },
+        "metrics": {k: (round(v, 3) if isinstance(v, float) and math.isfinite(v) else v) for k, v in metrics.items()},
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--out", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--batch-requests", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit 1 when --baseline shows regressions")
+    args = parser.parse_args(argv)
+
+    report = run(repeats=args.repeats, batch_requests=args.batch_requests)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare(json.load(f), report, args.threshold)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    regressions = report.get("comparison", {}).get("regressions", [])
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+    return 1 if regressions and args.fail_on_regression else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,20 @@
 import io
+import asyncio
 import base64
+import hashlib
+import json
+import math
 import os
+import random
+import time
+import threading
+import uuid
+import copy
+import functools
+import inspect
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image, ImageOps, ImageFilter
 import modal
 
@@ -21,6 +35,78 @@ LORAS = {
     "pixar": "ntc-ai/SDXL-LoRA-slider.pixar-style",
 }
 
+# How many LORAS stay injected in the pipelines at once. Styles past the cap are
+# evicted least-recently-used and kept in host memory for a cheap re-inject.
+MAX_RESIDENT_LORAS = len(LORAS)
+
+# After this many consecutive requests on the same style and scale, merge the
+# LoRA into the base weights so denoise steps skip the adapter matmuls (0 = never).
+# A style or scale change unmerges and restores the exact base weights from a
+# host-memory copy of the layers the style touches.
+LORA_FUSE_AFTER = 3
+# Max mean |fused - unfused| (0-255 pixels) benchmark_lora_fuse accepts. Fused
+# and unfused renders of a request share one result-cache key (_result_key), so
+# this is also how far a cached image may be from a fresh render of it.
+LORA_FUSE_TOLERANCE = 2.0
+
+# Step counts whose scheduler recipes (timestep/sigma tables) are built at
+# container start for every pipeline; other counts are built on first use.
+SCHEDULER_RECIPE_STEPS = (28, 30, 32)
+SCHEDULER_RECIPE_MAX = 64
+
+# Opt-in cross-request batching for generate_t2i: requests that share adapter,
+# size, steps and guidance and arrive within the window run as one batched
+# denoise. 0 disables it (each request runs alone, one input per container).
+T2I_BATCH_WINDOW_MS = 0
+T2I_MAX_BATCH = 4
+
+# Inputs one GPU container takes at once. Blob fetch, decode, canvas prep and
+# output encode of one input overlap another's denoise; everything touching
+# pipelines or adapter state runs under the host's GPU lock, one at a time.
+HOST_MAX_INPUTS = 4
+
+# num_candidates: several seeds of one request denoised as a single batch. The
+# batch is capped at MAX_CANDIDATES and at what fits in free VRAM, estimated
+# per megapixel per image (learned from observed peaks once a kind has run).
+MAX_CANDIDATES = 8
+CANDIDATE_VRAM_MB_PER_MP = 1500
+CANDIDATE_VRAM_HEADROOM = 0.85   # fraction of free VRAM a candidate batch may plan to use
+
+# Resolution buckets (width, height) per pipeline. Each is warmed once at
+# container start. t2i/i2i requests denoise at the nearest one (aspect first, then
+# area) only when it is within BUCKET_ASPECT_TOLERANCE / BUCKET_AREA_TOLERANCE, and
+# the output is resized back to the requested size (see _render_size); other
+# shapes run as asked.
+# For inpaint, 1024² is the full-canvas run; the rest serve crop_to_mask crops,
+# which are resized back afterwards and so always take the nearest bucket.
+WARMUP_BUCKETS = {
+    "t2i": ((1024, 1024), (1152, 896), (896, 1152)),
+    "i2i": ((1024, 1024),),
+    "inpaint": ((1024, 1024), (768, 768), (1024, 768), (768, 1024)),
+}
+WARMUP_STEPS = 2
+SNAP_TO_BUCKETS = True
+BUCKET_ASPECT_TOLERANCE = 0.05   # max |log(bucket aspect / requested aspect)|
+BUCKET_AREA_TOLERANCE = 0.15     # max |bucket area / requested area - 1|
+# "none", "channels_last" (UNets + VAEs), or "compile" (channels_last plus
+# torch.compile of each distinct UNet, one graph per bucket; adapter switches
+# may trigger recompiles, so measure with bench_buckets before enabling).
+UNET_OPTIMIZE = "channels_last"
+
+# DeepCache-style feature reuse, per request via cache_interval (1 = off): the
+# full UNet runs every cache_interval-th step, the steps in between reuse its
+# deep features and recompute only the outer DEEPCACHE_BRANCH + 1 down/up
+# levels. Higher intervals are faster and drift further from the full run
+# (see benchmark_deepcache). Not applied to torch.compile'd UNets.
+DEEPCACHE_BRANCH = 0
+DEEPCACHE_MAX_INTERVAL = 5
+DEEPCACHE_BENCH_PROMPTS = (
+    "a fox in a forest, storybook illustration",
+    "a lighthouse at dusk, storybook illustration",
+    "a child reading under a tree, storybook illustration",
+    "a dragon flying over a village, storybook illustration",
+)
+
 # Small style guidance to improve consistency per LoRA
 STYLE_HINTS = {
     "ghibli": {
@@ -51,6 +137,95 @@ SAFETY_REPO = "CompVis/stable-diffusion-safety-checker"
 IPADAPTER_REPO = "h94/IP-Adapter"
 IPADAPTER_SUBFOLDER = "sdxl_models"
 
+# GPU budget for cached text-encoder outputs (prompt + negative, pooled + per-token).
+PROMPT_CACHE_MB = 256
+
+# Crop-to-mask inpainting: pad the mask's bounding box, grow it to at least
+# MASK_CROP_MIN_SIDE canvas px per side and denoise only that crop. Masks whose
+# crop would still cover more than MASK_CROP_MAX_FRACTION of the canvas fall
+# back to the full-canvas path.
+MASK_CROP_PAD = 64
+MASK_CROP_MIN_SIDE = 768
+MASK_CROP_MAX_FRACTION = 0.6
+
+# Per-request output encodings: name -> (PIL format, mime type, default quality).
+# For png the "quality" is the zlib compress level (0-9); for the others it is
+# the codec quality (webp_lossless: compression effort).
+OUTPUT_FORMATS = {
+    "png": ("PNG", "image/png", 6),
+    "webp": ("WEBP", "image/webp", 90),
+    "webp_lossless": ("WEBP", "image/webp", 80),
+    "jpeg": ("JPEG", "image/jpeg", 92),
+}
+
+# Inpaint negative prompt when neither the request nor the style hint has one
+INPAINT_DEFAULT_NEGATIVE = (
+    "extra limbs, extra fingers, deformed face,"
+    "mustache, beard, text, watermark, low quality, blurry"
+)
+
+# Prepared IP-Adapter references + image embeddings kept per container (LRU).
+REF_CACHE_SIZE = 128
+
+# VAE-encoded init/background latents kept on the GPU, keyed by image content,
+# size and VAE (see SDXLLoRAHost._vae_latents).
+LATENT_CACHE_MB = 1024
+
+# Step previews: every PREVIEW_EVERY denoise steps the latents are projected
+# to RGB (no VAE decode), JPEG-encoded off-thread at PREVIEW_SIZE long side and
+# pushed to the request's partition of the progress queue. If the measured
+# preview cost amortized over the interval exceeds PREVIEW_STEP_BUDGET_MS,
+# the interval doubles for the rest of that run.
+PREVIEW_EVERY = 4
+PREVIEW_SIZE = 256
+PREVIEW_STEP_BUDGET_MS = 2.0
+PROGRESS_TTL_S = 600
+
+# Upload-once images (backgrounds, masks, references) referenced by content
+# hash. Blobs idle for BLOB_TTL_S are dropped, then the least recently used
+# ones until the store fits BLOB_STORE_MB (prune_blobs, hourly).
+BLOB_TTL_S = 7 * 24 * 3600
+BLOB_STORE_MB = 4096
+BLOB_MAX_MB = 25
+# Per GPU container: fetched blob bytes, and decoded/prepared canvases keyed by content
+BLOB_LOCAL_CACHE_MB = 512
+CANVAS_CACHE_SIZE = 32
+
+# Finished seeded results (encoded image + safety) on the results volume,
+# keyed by a hash of the normalized request. 0 disables the cache. Bump
+# RESULT_CACHE_VERSION whenever a change alters outputs for the same request.
+RESULTS_PATH = "/results"
+RESULT_CACHE_MB = 8192
+RESULT_CACHE_VERSION = 5
+# Minimum seconds between volume commits after new results are written
+RESULT_COMMIT_INTERVAL_S = 30
+# Minimum seconds between volume reloads on a result-cache miss, and between
+# re-scans of the directory (other containers' files) before evicting
+RESULT_RELOAD_INTERVAL_S = 30
+
+# The inpainting checkpoint only fine-tunes the UNet; its CLIP encoders are the
+# SDXL base ones, so it borrows them from the base pipeline instead of loading
+# a third copy.
+INPAINT_SHARED_COMPONENTS = ("text_encoder", "text_encoder_2", "tokenizer", "tokenizer_2")
+
+# Startup is split into a CPU stage (weights read into host memory, captured by
+# Modal memory snapshots when enabled) and a GPU stage (move, adapters, warmup).
+ENABLE_MEMORY_SNAPSHOT = False
+# Components kept off the critical startup path: t2i/i2i serve while they load,
+# and requests that need them wait in _StagedLoader.require().
+LAZY_COMPONENTS = ("inpaint",)
+# True: start lazy components in the background right after the GPU stage;
+# False: load them only on first use.
+LAZY_PREFETCH = True
+
+# Histogram buckets for /metrics: per-request stage latency (seconds) and peak VRAM (MiB)
+METRICS_BUCKETS_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_VRAM_BUCKETS_MB = (4096, 8192, 12288, 16384, 20480, 24576, 32768, 40960, 49152, 65536, 81920)
+# Each GPU container publishes its histograms to metrics_snapshots this often (0 disables);
+# /metrics drops snapshots not refreshed for METRICS_STALE_S (the container is gone).
+METRICS_PUBLISH_INTERVAL_S = 15
+METRICS_STALE_S = 300
+
 # ───────────────────────── Modal Image ───────────────────────── #
 base_image = (
     modal.Image.from_registry(f"nvidia/cuda:{tag}", add_python="3.11")
@@ -89,6 +264,23 @@ image = (
 
 app = modal.App("sdxl-lora-api", image=image)
 
+# character_id -> prepared (512² center-cropped) reference PNG, shared by all containers
+character_refs = modal.Dict.from_name("sdxl-character-refs", create_if_missing=True)
+
+# progress_id partition -> preview events while the call runs; the call returns only after its
+# previews are pushed, and _progress_events drains the partition until that result arrives
+progress_queue = modal.Queue.from_name("sdxl-progress", create_if_missing=True)
+
+# blob id (content hash) -> uploaded image bytes; blob id -> {"bytes", "last_used"} for pruning
+blobs = modal.Dict.from_name("sdxl-blobs", create_if_missing=True)
+blob_meta = modal.Dict.from_name("sdxl-blob-meta", create_if_missing=True)
+
+# instance (container id) -> latest {"ts", "families"} from _MetricsPublisher, merged by /metrics
+metrics_snapshots = modal.Dict.from_name("sdxl-metrics", create_if_missing=True)
+
+# result cache files (see _ResultStore), shared by all GPU containers
+results_volume = modal.Volume.from_name("sdxl-results", create_if_missing=True)
+
 # ───────────────────────── Helpers ───────────────────────── #
 with image.imports():
     import os
@@ -100,13 +292,14 @@ with image.imports():
         StableDiffusionXLImg2ImgPipeline,
         StableDiffusionXLInpaintPipeline,
         DPMSolverMultistepScheduler,
+        UNet2DConditionModel,
+        AutoencoderKL,
     )
     from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
-    from transformers import AutoImageProcessor
+    from peft.tuners.lora import LoraLayer
     from transformers.utils import move_cache
-
-def _png_bytes_to_b64(data: bytes) -> str:
-    return "data:image/png;base64," + base64.b64encode(data).decode("utf-8")
+    from fastapi import HTTPException, Request, Response
+    from fastapi.responses import JSONResponse, StreamingResponse
 
 def _decode_data_url_b64(data_url_or_b64: str) -> bytes:
     s = data_url_or_b64
@@ -114,11 +307,116 @@ def _decode_data_url_b64(data_url_or_b64: str) -> bytes:
         s = s.split(",", 1)[1]
     return base64.b64decode(s)
 
-def _pil_to_png_bytes(img: Image.Image) -> bytes:
+def _pil_to_png_bytes(img: Image.Image, compress_level: int = 6) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=compress_level)
+    return buf.getvalue()
+
+def _image_bytes_to_data_url(data: bytes, output_format: str = "png") -> str:
+    mime = OUTPUT_FORMATS[output_format][1]
+    return f"data:{mime};base64," + base64.b64encode(data).decode("utf-8")
+
+def _output_format(output_format: str | None) -> str:
+    fmt = (output_format or "png").lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format '{output_format}'. Choose one of: {', '.join(OUTPUT_FORMATS)}")
+    return fmt
+
+def _encode_image(img: Image.Image, output_format: str = "png", quality: int | None = None) -> bytes:
+    fmt = _output_format(output_format)
+    pil_format, _, default_quality = OUTPUT_FORMATS[fmt]
+    q = int(default_quality if quality is None else quality)
+    if fmt == "png":
+        return _pil_to_png_bytes(img, compress_level=max(0, min(9, q)))
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
+    if fmt == "jpeg":
+        img.convert("RGB").save(buf, format=pil_format, quality=q)
+    else:
+        img.save(buf, format=pil_format, quality=q, lossless=(fmt == "webp_lossless"), method=4)
     return buf.getvalue()
 
+# CLIPImageProcessor settings of the safety checker (shortest edge → 224, center crop)
+CLIP_SIZE = 224
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+def _pil_to_tensor(img: Image.Image, device) -> "torch.Tensor":
+    """(1, C, H, W) float32 in [0, 1] on device."""
+    arr = np.asarray(img, dtype=np.uint8)
+    if arr.ndim == 2:
+        arr = arr[..., None]
+    return torch.from_numpy(arr.copy()).to(device).permute(2, 0, 1)[None].float() / 255.0
+
+def _resize_images(images: "torch.Tensor", width: int, height: int) -> "torch.Tensor":
+    """(B, 3, H, W) [0, 1] images resized to width x height (bicubic, antialiased); unchanged when they match."""
+    if tuple(images.shape[-2:]) == (int(height), int(width)):
+        return images
+    return torch.nn.functional.interpolate(
+        images.float(), size=(int(height), int(width)), mode="bicubic", align_corners=False, antialias=True
+    ).clamp(0, 1)
+
+def _tensor_to_pil(images: "torch.Tensor") -> list:
+    """(B, 3, H, W) in [0, 1] → list of RGB PIL images (one device→host copy)."""
+    arr = (images.float().clamp(0, 1) * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+    return [Image.fromarray(a) for a in arr]
+
+# Linear SDXL latent → RGB projection (per latent channel RGB weights + bias),
+# a thumbnail-quality stand-in for the VAE decode.
+_SDXL_LATENT_RGB = (
+    (0.3651, 0.4232, 0.4341),
+    (-0.2533, -0.0042, 0.1068),
+    (0.1076, 0.1111, -0.0362),
+    (-0.3165, -0.2492, -0.2188),
+)
+_SDXL_LATENT_RGB_BIAS = (0.1084, -0.0175, -0.0011)
+
+def _latents_to_rgb(latents, size: int | None = PREVIEW_SIZE):
+    """(B, 4, h, w) scaled latents → (B, H, W, 3) uint8 CPU tensor, long side `size`."""
+    weights = torch.tensor(_SDXL_LATENT_RGB, device=latents.device, dtype=torch.float32)
+    bias = torch.tensor(_SDXL_LATENT_RGB_BIAS, device=latents.device, dtype=torch.float32)
+    rgb = torch.einsum("bchw,cr->brhw", latents.float(), weights) + bias[None, :, None, None]
+    rgb = ((rgb + 1.0) / 2.0).clamp(0, 1)
+    h, w = rgb.shape[-2:]
+    if size and max(h, w) != size:
+        scale = size / float(max(h, w))
+        rgb = torch.nn.functional.interpolate(
+            rgb, size=(max(1, round(h * scale)), max(1, round(w * scale))), mode="bilinear", align_corners=False
+        )
+    return (rgb * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).cpu()
+
+def _clip_preprocess(images: "torch.Tensor") -> "torch.Tensor":
+    """GPU equivalent of the CLIP image processor: bicubic shortest-edge resize, center crop, normalize."""
+    h, w = images.shape[-2:]
+    scale = CLIP_SIZE / float(min(h, w))
+    nh, nw = max(CLIP_SIZE, int(round(h * scale))), max(CLIP_SIZE, int(round(w * scale)))
+    x = torch.nn.functional.interpolate(
+        images.float(), size=(nh, nw), mode="bicubic", align_corners=False, antialias=True
+    )
+    top, left = (nh - CLIP_SIZE) // 2, (nw - CLIP_SIZE) // 2
+    x = x[..., top:top + CLIP_SIZE, left:left + CLIP_SIZE]
+    mean = torch.tensor(CLIP_MEAN, device=x.device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=x.device).view(1, 3, 1, 1)
+    return (x - mean) / std
+
+def _content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def _store_blob(data: bytes) -> tuple:
+    """(blob id, already stored) for an uploaded image; the id is its _content_hash."""
+    if len(data) > BLOB_MAX_MB * 2**20:
+        raise ValueError(f"Image larger than {BLOB_MAX_MB} MB.")
+    blob_id = _content_hash(data)
+    existing = blobs.contains(blob_id)
+    if not existing:
+        try:
+            Image.open(io.BytesIO(data)).verify()
+        except Exception:
+            raise ValueError("Not a decodable image.")
+        blobs[blob_id] = data
+    blob_meta[blob_id] = {"bytes": len(data), "last_used": time.time()}
+    return blob_id, existing
+
 def _prepare_ref_image(ref: Image.Image, target_size: int = 512) -> Image.Image:
     """
     Normalize the reference image for IP-Adapter:
@@ -135,395 +433,2892 @@ def _prepare_ref_image(ref: Image.Image, target_size: int = 512) -> Image.Image:
     )
     return ref
 
-def _snap64(x: int | float) -> int:
-    try:
-        return int(round(float(x) / 64.0) * 64)
-    except Exception:
-        return int(x)
+def _module_bytes(module) -> int:
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
 
-_STOP = {
-    "the","a","an","and","or","but","to","of","in","on","for","with","by",
-    "at","from","as","that","this","these","those","is","are","was","were",
-    "be","been","being","it","its","into","over","under","between","through"
-}
+class _PipelineRegistry:
+    """
+    Named pipelines plus the torch modules they hold. Pipelines built from the
+    same weights reference the same module objects, so those are loaded, moved
+    and counted once. Lazy components register from loader threads while
+    requests run, so readers work on snapshots taken under the lock.
+    """
 
-def _shrink_prompt(text: str, max_words: int = 70) -> str:
-    if not text: return text
-    words = []
-    for w in text.replace("\n"," ").split():
-        ww = "".join(ch for ch in w if ch.isalnum() or ch in "-_:,.;")
-        lw = ww.lower()
-        if lw in _STOP and len(words) > 8:
-            continue
-        if ww:
-            words.append(ww)
-        if len(words) >= max_words:
-            break
-    return " ".join(words)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pipes = {}
+        self.load_s = {}
 
-# ───────────────────────── Worker Class ───────────────────────── #
-@app.cls(
-    gpu="A100",
-    volumes={HF_CACHE_PATH: modal.Volume.from_name("hf-cache", create_if_missing=True)},
-    scaledown_window=300,
-)
-class SDXLLoRAHost:
-    @modal.enter()
-    def setup(self):
-        torch.backends.cuda.matmul.allow_tf32 = True
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        # Prefer fp16 on CUDA for SDXL; fall back to fp32 on CPU
-        self.dtype = torch.float16 if self.device == "cuda" else torch.float32
-        # IP-Adapter (reference image guidance) for SDXL Inpaint: will be attached once after creating inpaint pipe
+    def register(self, name: str, pipe, load_s: float):
+        with self._lock:
+            self.pipes[name] = pipe
+            self.load_s[name] = round(float(load_s), 3)
+        return pipe
 
-        # Run HF cache migration once (non-fatal if it fails)
-        try:
-            if not os.path.exists("/cache/.hf_migrated"):
-                move_cache()
-                Path("/cache/.hf_migrated").touch()
-        except Exception:
-            pass
+    def record(self, name: str, load_s: float):
+        """Startup time of a step that is not a pipeline (weights, moves, warmup, ...)."""
+        with self._lock:
+            self.load_s[name] = round(float(load_s), 3)
 
-        # Pipelines
-        self.t2i = StableDiffusionXLPipeline.from_pretrained(
-            BASE_MODEL, torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH
-        ).to(self.device)
+    def load_times(self) -> dict:
+        with self._lock:
+            return dict(self.load_s)
 
-        self.i2i = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-            BASE_MODEL, torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH
-        ).to(self.device)
+    def values(self) -> list:
+        with self._lock:
+            return list(self.pipes.values())
 
-        # Create inpaint pipeline BEFORE using it
-        self.inpaint = StableDiffusionXLInpaintPipeline.from_pretrained(
-            INPAINT_MODEL, torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH
-        ).to(self.device)
+    def components_of(self, name: str, keys=None) -> dict:
+        with self._lock:
+            comps = self.pipes[name].components
+        if keys is None:
+            return dict(comps)
+        return {k: comps[k] for k in keys}
 
-        # One-time IP-Adapter attach; pick ONE and never swap.
-        self.inpaint.load_ip_adapter(
-            IPADAPTER_REPO,
-            subfolder=IPADAPTER_SUBFOLDER,
-            weight_name="ip-adapter_sdxl.safetensors",
-        )
-        try:
-            self.inpaint.set_ip_adapter_scale(1.0)
-        except Exception:
-            pass
+    def modules(self, extra: dict | None = None) -> dict:
+        """id(module) -> (module, ["pipe.component", ...])"""
+        out = {}
+        with self._lock:
+            pipes = list(self.pipes.items())
+        named = [(f"{p}.{c}", m) for p, pipe in pipes for c, m in pipe.components.items()]
+        named += list((extra or {}).items())
+        for label, m in named:
+            if isinstance(m, torch.nn.Module):
+                out.setdefault(id(m), (m, []))[1].append(label)
+        return out
 
-        for p in (self.t2i, self.i2i, self.inpaint):
-            #p.set_progress_bar_config(disable=True) #optional silence progress to save a few ms
-            p.scheduler = DPMSolverMultistepScheduler.from_config(p.scheduler.config)
-            p.enable_vae_slicing()
-            p.enable_vae_tiling()
-            if self.device != "cuda":
-                p.enable_model_cpu_offload()
+    def report(self, extra: dict | None = None) -> dict:
+        mods = self.modules(extra).values()
+        unshared = sum(_module_bytes(m) * len(labels) for m, labels in mods)
+        resident = sum(_module_bytes(m) for m, _ in mods)
+        load_s = self.load_times()
+        rep = {
+            "load_s": load_s,
+            "cold_start_s": round(sum(load_s.values()), 3),
+            "weights_mb_unshared": round(unshared / 2**20, 1),
+            "weights_mb_resident": round(resident / 2**20, 1),
+            "shared": sorted(" = ".join(labels) for _, labels in mods if len(labels) > 1),
+        }
+        if torch.cuda.is_available():
+            rep["cuda_allocated_mb"] = round(torch.cuda.memory_allocated() / 2**20, 1)
+            rep["cuda_reserved_mb"] = round(torch.cuda.memory_reserved() / 2**20, 1)
+        return rep
 
-        # Track currently active style per pipeline; no preloading
-        self._active_style = {"t2i": None, "i2i": None, "inpaint": None}
+class _StagedLoader:
+    """
+    Named startup components, each loaded once on its own thread after the
+    components it depends on. start() kicks a component off in the background,
+    require() blocks until it is ready (starting it if nobody has) and re-raises
+    its load error. report() is the per-component startup breakdown.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._t0 = time.perf_counter()
+        self.components = {}   # name -> {"fn", "after", "future", "started", "load_s", "waited_s"}
+
+    def add(self, name: str, fn, after=()):
+        self.components[name] = {
+            "fn": fn, "after": tuple(after), "future": None,
+            "started": None, "load_s": None, "waited_s": 0.0,
+        }
+
+    def start(self, name: str) -> Future:
+        with self._lock:
+            comp = self.components[name]
+            if comp["future"] is None:
+                comp["future"] = Future()
+                comp["started"] = time.perf_counter()
+                threading.Thread(target=self._run, args=(name,), name=f"load-{name}", daemon=True).start()
+            return comp["future"]
+
+    def _run(self, name: str):
+        comp = self.components[name]
+        try:
+            for dep in comp["after"]:
+                self.require(dep)
+            t0 = time.perf_counter()
+            comp["fn"]()
+            comp["load_s"] = round(time.perf_counter() - t0, 3)
+            comp["future"].set_result(None)
+        except BaseException as e:
+            print(f"[startup] {name} failed:", e)
+            comp["future"].set_exception(e)
 
-        # Start with no style active
-        for p in (self.t2i, self.i2i, self.inpaint):
+    def ready(self, name: str) -> bool:
+        fut = self.components[name]["future"]
+        return fut is not None and fut.done() and fut.exception() is None
+
+    def require(self, name: str):
+        fut = self.start(name)
+        if not fut.done():
+            t0 = time.perf_counter()
             try:
-                p.set_adapters([], [])
-            except Exception:
-                p.disable_lora()
-        self.active_adapter = "none"
+                fut.result()
+            finally:
+                with self._lock:
+                    self.components[name]["waited_s"] += time.perf_counter() - t0
+        fut.result()
 
-        # Safety tooling (Transformers 4.44+)
-        self.safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-            SAFETY_REPO, cache_dir=HF_CACHE_PATH
-        ).to(self.device)
-        self.image_processor = AutoImageProcessor.from_pretrained(
-            SAFETY_REPO, cache_dir=HF_CACHE_PATH
-        )
+    def report(self) -> dict:
+        out = {}
+        for name, comp in self.components.items():
+            fut = comp["future"]
+            if fut is None:
+                state = "lazy"
+            elif not fut.done():
+                state = "loading"
+            else:
+                state = "failed" if fut.exception() is not None else "ready"
+            out[name] = {
+                "state": state,
+                "start_s": None if comp["started"] is None else round(comp["started"] - self._t0, 3),
+                "load_s": comp["load_s"],
+                "waited_s": round(comp["waited_s"], 3),
+            }
+        return out
+
+def _tensor_bytes(obj) -> int:
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(_tensor_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in obj)
+    return 0
+
+class _LRUCache:
+    """Thread-safe LRU map bounded by entry count and/or an estimated byte size."""
+
+    def __init__(self, max_items: int | None = None, max_bytes: int | None = None, sizeof=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data = OrderedDict()   # key -> (value, nbytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        nbytes = int(self._sizeof(value))
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, nbytes)
+            self.bytes += nbytes
+            while self._data and (
+                (self.max_items is not None and len(self._data) > self.max_items)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes and len(self._data) > 1)
+            ):
+                _, (_, freed) = self._data.popitem(last=False)
+                self.bytes -= freed
+                self.evictions += 1
+        return value
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+def _percentile(values, q: float) -> float:
+    vals = sorted(values)
+    if not vals:
+        return 0.0
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+class _StageTrace:
+    """
+    One host request: ms per stage (summed when a stage repeats; stages may
+    nest, e.g. blob_fetch inside ref_embeds), peak VRAM while it held the GPU
+    and the number of adapter switches it caused.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.t0 = time.perf_counter()
+        self.total_ms = None
+        self.stages = {}
+        self.peak_vram_mb = None
+        self.adapter_switches = 0
+
+    def add(self, stage: str, ms: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+
+    def peak(self, mb: float):
+        self.peak_vram_mb = max(self.peak_vram_mb or 0.0, mb)
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self.t0) * 1000.0
+        return self
 
-        # ─────────────── Minimal warmup to keep init fast ─────────────── #
+    def summary(self) -> dict:
+        return {
+            "total_ms": None if self.total_ms is None else round(self.total_ms, 2),
+            "stages_ms": {stage: round(ms, 2) for stage, ms in self.stages.items()},
+            "peak_vram_mb": None if self.peak_vram_mb is None else round(self.peak_vram_mb, 1),
+            "adapter_switches": self.adapter_switches,
+        }
+
+class _Histogram:
+    """Cumulative-bucket histogram per label tuple, Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}   # labels -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        row = self.series.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        i = next((i for i, le in enumerate(self.buckets) if value <= le), len(self.buckets))
+        row[0][i] += 1
+        row[1] += value
+        row[2] += 1
+
+    def render(self, name: str, label_names: tuple, const_labels: dict | None = None) -> list:
+        lines = []
+        for labels, (counts, total, n) in sorted(self.series.items()):
+            pairs = list((const_labels or {}).items()) + list(zip(label_names, labels))
+            base = ",".join(f'{k}="{v}"' for k, v in pairs)
+            cumulative = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                cumulative += c
+                lines.append(f'{name}_bucket{{{base},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{base}}} {total:.6f}")
+            lines.append(f"{name}_count{{{base}}} {n}")
+        return lines
+
+class _StageMetrics:
+    """
+    Aggregates finished _StageTraces (plus stages timed outside any request,
+    kind "other") into histograms, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, buckets_s=METRICS_BUCKETS_S, vram_buckets_mb=METRICS_VRAM_BUCKETS_MB):
+        self._lock = threading.Lock()
+        self.stage_s = _Histogram(buckets_s)
+        self.request_s = _Histogram(buckets_s)
+        self.vram_mb = _Histogram(vram_buckets_mb)
+        self.adapter_switches = {}   # kind -> count
+
+    def observe(self, kind: str, stage: str, ms: float):
+        with self._lock:
+            self.stage_s.observe((kind, stage), ms / 1000.0)
+
+    def observe_request(self, trace: _StageTrace):
+        with self._lock:
+            for stage, ms in trace.stages.items():
+                self.stage_s.observe((trace.kind, stage), ms / 1000.0)
+            self.request_s.observe((trace.kind,), trace.total_ms / 1000.0)
+            if trace.peak_vram_mb is not None:
+                self.vram_mb.observe((trace.kind,), trace.peak_vram_mb)
+            self.adapter_switches[trace.kind] = self.adapter_switches.get(trace.kind, 0) + trace.adapter_switches
+
+    def families(self, prefix: str = "sdxl", instance: str | None = None) -> list:
+        """[(name, type, help, sample lines)]; every sample carries instance="..." when given."""
+        const = {"instance": instance} if instance else {}
+        inst = f'instance="{instance}",' if instance else ""
+        with self._lock:
+            return [
+                (f"{prefix}_stage_seconds", "histogram", "Time per request spent in each stage.",
+                 self.stage_s.render(f"{prefix}_stage_seconds", ("kind", "stage"), const)),
+                (f"{prefix}_request_seconds", "histogram", "Host-side request latency.",
+                 self.request_s.render(f"{prefix}_request_seconds", ("kind",), const)),
+                (f"{prefix}_request_peak_vram_mib", "histogram", "Peak CUDA memory allocated while a request held the GPU.",
+                 self.vram_mb.render(f"{prefix}_request_peak_vram_mib", ("kind",), const)),
+                (f"{prefix}_adapter_switches_total", "counter", "LoRA style switches caused by requests.",
+                 [f'{prefix}_adapter_switches_total{{{inst}kind="{k}"}} {n}' for k, n in sorted(self.adapter_switches.items())]),
+            ]
+
+    def render(self, prefix: str = "sdxl", instance: str | None = None) -> str:
+        return _render_metric_families([self.families(prefix, instance)])
+
+def _render_metric_families(snapshots: list) -> str:
+    """Prometheus text for several families() snapshots: one HELP/TYPE header per metric, then every snapshot's samples."""
+    merged = OrderedDict()
+    for families in snapshots:
+        for name, kind, help_text, lines in families:
+            merged.setdefault(name, (kind, help_text, []))[2].extend(lines)
+    out = []
+    for name, (kind, help_text, lines) in merged.items():
+        out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", *lines]
+    return "\n".join(out) + "\n"
+
+class _MetricsPublisher:
+    """
+    Pushes this container's _StageMetrics, labelled with its instance id, to
+    metrics_snapshots every interval_s from a daemon thread (and once more on
+    close), so /metrics is served from a CPU function without calling into,
+    or keeping warm, a GPU container.
+    """
+
+    def __init__(self, metrics: _StageMetrics, instance: str, interval_s: float):
+        self.metrics = metrics
+        self.instance = instance
+        self.interval_s = float(interval_s)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="metrics-publisher", daemon=True)
+        self._thread.start()
+
+    def publish(self):
         try:
-            _ = self.t2i(
-                prompt="warmup",
-                width=64,
-                height=64,
-                num_inference_steps=2,
-                guidance_scale=1.0,
-                output_type="pil",
-            ).images[0]
+            metrics_snapshots.put(self.instance, {"ts": time.time(), "families": self.metrics.families(instance=self.instance)})
         except Exception as e:
-            print("Warmup t2i failed:", e)
+            print(f"[metrics] publish failed: {e}")
 
-    
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            self.publish()
 
-    # ─────────────── LoRA adapter switching (single-owner loader) ─────────────── #
+    def close(self):
+        self._stop.set()
+        self.publish()
 
-    def _set_adapter_single(self, pipe, pipe_name: str, adapter: str, scale: float):
-        adapter = (adapter or "none").lower()
+class _SchedulerRecipes:
+    """
+    Immutable DPM++ 2M recipes per (pipeline, steps, karras): a scheduler built
+    once from the pipeline's startup config, with its timestep/sigma table
+    computed once. Each call gets a shallow copy whose set_timesteps restores
+    that table instead of recomputing it, so no request rebuilds a scheduler
+    or touches a shared one's config.
+    """
 
-        # turn off style
-        if adapter in ("none", "off", "disable"):
-            try:
-                # diffusers >= 0.29
-                if hasattr(pipe, "set_adapters"):
-                    pipe.set_adapters([], [])
-                # best-effort unload any LoRA weights that might be present
-                if hasattr(pipe, "unload_lora_weights"):
-                    pipe.unload_lora_weights()  # unload all
-            except Exception:
-                try: pipe.disable_lora()
-                except Exception: pass
-            self._active_style[pipe_name] = None
-            return
+    def __init__(self, max_items: int = SCHEDULER_RECIPE_MAX):
+        self.configs = {}   # pipeline name -> scheduler config at registration
+        self._recipes = _LRUCache(max_items=max_items)
+        self.builds = 0
+        self.build_ms = 0.0
 
-        # sanity check
-        if adapter not in LORAS:
-            raise ValueError(f"Unknown adapter '{adapter}'. Choose one of: {', '.join(list(LORAS.keys()) + ['none'])}")
+    def register(self, name: str, config):
+        self.configs[name] = dict(config)
 
-        # only (re)load if switching styles
-        if self._active_style.get(pipe_name) != adapter:
-            # hard reset: ensure nothing residual remains
-            try:
-                if hasattr(pipe, "unload_lora_weights"):
-                    pipe.unload_lora_weights()
-            except Exception:
-                pass
-            try:
-                pipe.disable_lora()
-            except Exception:
-                pass
+    def _recipe(self, name: str, steps: int, karras: bool):
+        key = (name, steps, karras)
+        recipe = self._recipes.get(key)
+        if recipe is None:
+            t0 = time.perf_counter()
+            template = DPMSolverMultistepScheduler.from_config(self.configs[name], use_karras_sigmas=karras)
+            template.set_timesteps(steps)
+            recipe = self._recipes.put(key, (template, template.timesteps, template.sigmas, {}))
+            self.builds += 1
+            self.build_ms += (time.perf_counter() - t0) * 1000.0
+        return recipe
 
-            # load requested style (diffusers backend = no PEFT stacking)
-            repo = LORAS[adapter]
-            pipe.load_lora_weights(repo, adapter_name=adapter, use_peft_backend=False)
-            self._active_style[pipe_name] = adapter
+    def warm(self, name: str, steps_list, karras: bool | None = None):
+        for steps in steps_list:
+            self.scheduler(name, steps, karras)
 
-        # activate only this adapter with a single weight
-        pipe.set_adapters([adapter], adapter_weights=[float(scale)])
+    def scheduler(self, name: str, steps: int, karras: bool | None = None):
+        """A fresh scheduler for one call; karras=None keeps the pipeline's own setting."""
+        if karras is None:
+            karras = bool(self.configs[name].get("use_karras_sigmas", False))
+        steps = int(steps)
+        template, table, sigmas, on_device = self._recipe(name, steps, bool(karras))
+        sched = copy.copy(template)
+        base_set_timesteps = sched.set_timesteps
 
-    def _set_adapter(self, adapter: str, scale: float = 1.0):
-        # keep all three pipelines in sync
-        self._set_adapter_single(self.t2i, "t2i", adapter, scale)
-        self._set_adapter_single(self.i2i, "i2i", adapter, scale)
-        self._set_adapter_single(self.inpaint, "inpaint", adapter, scale)
-        self.active_adapter = (adapter or "none").lower()
+        def set_timesteps(num_inference_steps=None, device=None, timesteps=None):
+            if timesteps is not None or num_inference_steps != steps:
+                return base_set_timesteps(num_inference_steps, device=device, timesteps=timesteps)
+            # the state DPMSolverMultistepScheduler.set_timesteps resets, from the cached table
+            key = str(device)
+            if key not in on_device:
+                on_device[key] = table.to(device) if device is not None else table
+            sched.timesteps = on_device[key]
+            sched.sigmas = sigmas
+            sched.num_inference_steps = len(table)
+            sched.model_outputs = [None] * sched.config.solver_order
+            sched.lower_order_nums = 0
+            sched._step_index = None
+            sched._begin_index = None
 
-    # ─────────────── Text → Image ─────────────── #
-    @modal.method()
-    def generate_t2i(
-        self,
-        prompt: str,
-        width: int = 1024,
-        height: int = 1024,
-        steps: int = 30,
-        guidance_scale: float = 4.5,
-        seed=None,
-        adapter: str = "none",
-        negative_prompt: str | None = None,
-        adapter_scale: float | None = None,
-        use_freeu: bool = False,
-    ) -> bytes:
-        if not prompt:
-            raise ValueError("Missing 'prompt'.")
+        sched.set_timesteps = set_timesteps
+        return sched
 
-        if adapter_scale is None:
-            adapter_scale = STYLE_HINTS.get(adapter, {}).get("default_scale", 1.0)
-        self._set_adapter(adapter, scale=float(adapter_scale))
+    def stats(self) -> dict:
+        return dict(self._recipes.stats(), builds=self.builds, build_ms=round(self.build_ms, 1))
 
-        # Shrink prompts, then apply short style hints
-        hint = STYLE_HINTS.get(adapter, {})
-        prompt = _shrink_prompt(prompt, max_words=70)
-        neg = _shrink_prompt(negative_prompt, max_words=70) if negative_prompt else None
-        if hint.get("add"):
-            prompt = f"{prompt} {hint['add']}".strip()
-        if neg:
-            negative_prompt = f"{neg} {hint.get('neg','')}".strip()
-        else:
-            negative_prompt = hint.get("neg", None)
+def _pipe_view(pipe, scheduler):
+    """
+    A shallow copy of `pipe` that runs with `scheduler`: components are shared,
+    while the scheduler and the per-call attributes __call__ sets (guidance,
+    timestep count, ...) stay on the copy.
+    """
+    view = copy.copy(pipe)
+    # plain setattr would re-register the scheduler in the pipeline config
+    object.__setattr__(view, "scheduler", scheduler)
+    return view
 
-        # Snap sizes to 64-multiples (SDXL friendly)
-        width = _snap64(width)
-        height = _snap64(height)
+class _DeepCache:
+    """
+    DeepCache (arXiv 2312.00858) for a UNet2DConditionModel, installed once
+    per UNet and inert outside session(). On every `interval`-th UNet call the
+    whole network runs and the input of the outer up blocks is kept; on the
+    calls in between the deep down blocks, the mid block and the deep up
+    blocks return placeholders and the outer up blocks run on the kept
+    features, so only conv_in, the outer levels and conv_out are computed.
+    Placeholders only need the right residual counts: their values are never read.
+    """
 
-        # Ensure t2i uses Karras sigmas as well
-        try:
-            cfg = self.t2i.scheduler.config
-            if getattr(cfg, "use_karras_sigmas", False) is False:
-                cfg.use_karras_sigmas = True
-            from diffusers import DPMSolverMultistepScheduler
-            self.t2i.scheduler = DPMSolverMultistepScheduler.from_config(cfg)
-        except Exception:
-            pass
+    def __init__(self, unet, branch: int = DEEPCACHE_BRANCH):
+        levels = len(unet.down_blocks)
+        keep = max(0, min(int(branch), levels - 2)) + 1   # outer levels that always run
+        self.interval = 1
+        self.calls = 0
+        self.shallow = False
+        self.features = None
+        self.full_calls = 0
+        self.shallow_calls = 0
+        for block in unet.down_blocks[keep:]:
+            self._wrap(block, self._down)
+        self._wrap(unet.mid_block, self._passthrough)
+        deep_up = unet.up_blocks[:len(unet.up_blocks) - keep]
+        for block in deep_up[:-1]:
+            self._wrap(block, self._passthrough)
+        self._wrap(deep_up[-1], self._last_deep_up)
+        unet.register_forward_pre_hook(self._on_call)
 
-        g = None
-        if seed is not None:
-            g = torch.Generator(device=self.device).manual_seed(int(seed))
+    @staticmethod
+    def _hidden(args, kwargs):
+        return kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
 
-        # Optional FreeU
-        freeu_enabled = False
-        if use_freeu and hasattr(self.t2i, "enable_freeu"):
-            try:
-                self.t2i.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4)
-                freeu_enabled = True
-            except Exception:
-                pass
+    def _wrap(self, block, fn):
+        forward = block.forward
+        block.forward = functools.partial(fn, block, forward)
 
-        with torch.inference_mode():
-            image = self.t2i(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                width=int(width),
-                height=int(height),
-                num_inference_steps=int(steps),
-                guidance_scale=float(guidance_scale),
-                generator=g,
-                output_type="pil",
-            ).images[0]
+    def _down(self, block, forward, *args, **kwargs):
+        if not self.shallow:
+            return forward(*args, **kwargs)
+        hidden = self._hidden(args, kwargs)
+        residuals = len(block.resnets) + (1 if getattr(block, "downsamplers", None) else 0)
+        return hidden, (hidden,) * residuals
 
-        if freeu_enabled and hasattr(self.t2i, "disable_freeu"):
-            try:
-                self.t2i.disable_freeu()
-            except Exception:
-                pass
-        return _pil_to_png_bytes(image)
+    def _passthrough(self, block, forward, *args, **kwargs):
+        return self._hidden(args, kwargs) if self.shallow else forward(*args, **kwargs)
 
-    # ─────────────── Image → Image ─────────────── #
-    @modal.method()
-    def generate_i2i(
-        self,
-        prompt: str,
-        image_bytes: bytes,
-        strength: float = 0.35,                 # lower = preserve more of the init
-        steps: int = 32,                        # a bit more steps for i2i
-        guidance_scale: float = 6.5,            # SDXL i2i tends to like 5.5–7.5
-        seed=None,
-        out_size: int = 1024,
-        adapter: str = "none",
-        negative_prompt: str | None = "low quality, blurry, jpeg artifacts, extra fingers, extra limbs",
-        # Advanced (optional) knobs:
-        adapter_scale: float = 1.0,             # LoRA strength per-request
-        use_freeu: bool = True,                 # sharper textures, tiny overhead
-        guidance_rescale: float | None = 0.7,   # mitigates CFG artifacts
-        noise_offset: float | None = 0.02,      # combats desaturation/washed look
-        keep_aspect: bool = True,               # avoid squashing
-    ):
-        import io
-        from PIL import Image, ImageOps
-    
-        if not prompt:
-            raise ValueError("Missing 'prompt'.")
-        if not image_bytes:
-            raise ValueError("Missing 'image'.")
-    
-        # single adapter, adjustable scale
-        self._set_adapter(adapter, scale=float(adapter_scale))
+    def _last_deep_up(self, block, forward, *args, **kwargs):
+        if self.shallow:
+            return self.features
+        out = forward(*args, **kwargs)
+        if self.interval > 1:
+            self.features = out
+        return out
 
-        # Shrink prompts, then apply short style hints
-        hint = STYLE_HINTS.get(adapter, {})
-        prompt = _shrink_prompt(prompt, max_words=70)
-        neg = _shrink_prompt(negative_prompt, max_words=70) if negative_prompt else None
-        if hint.get("add"):
-            prompt = f"{prompt} {hint['add']}".strip()
-        if neg:
-            negative_prompt = f"{neg} {hint.get('neg','')}".strip()
+    def _on_call(self, module, args):
+        if self.interval == 1:
+            return   # outside session(): a plain UNet call, not counted
+        self.shallow = self.features is not None and self.calls % self.interval != 0
+        self.calls += 1
+        if self.shallow:
+            self.shallow_calls += 1
         else:
-            negative_prompt = hint.get("neg", None)
+            self.full_calls += 1
 
-        # --- preprocess init image safely ---
-        init = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        if out_size:
-            size = _snap64(int(out_size))
-            if keep_aspect:
-                # center-crop to square, then resize → no distortion
-                init = ImageOps.fit(init, (size, size), method=Image.Resampling.LANCZOS, centering=(0.5, 0.5))
-            else:
-                init = init.resize((size, size), Image.Resampling.LANCZOS)
-    
-        # --- scheduler: DPM++ 2M with Karras sigmas for i2i smoothness ---
+    @contextmanager
+    def session(self, interval: int):
+        """Reuse deep features for one pipeline call (under the GPU lock)."""
+        self.interval = max(1, min(int(interval), DEEPCACHE_MAX_INTERVAL))
+        self.calls, self.features, self.shallow = 0, None, False
+        try:
+            yield
+        finally:
+            self.interval, self.features, self.shallow = 1, None, False
+
+    def stats(self) -> dict:
+        return {"full_calls": self.full_calls, "shallow_calls": self.shallow_calls}
+
+@contextmanager
+def _freeu(pipe, enabled: bool):
+    """
+    FreeU on `pipe` for one call, always switched back off. It patches the
+    shared UNet's up blocks, so hold the GPU lock around it.
+    """
+    active = False
+    if enabled and hasattr(pipe, "enable_freeu"):
         try:
-            cfg = self.i2i.scheduler.config
-            if getattr(cfg, "use_karras_sigmas", False) is False:
-                cfg.use_karras_sigmas = True
-            # re-init scheduler from config to apply flag
-            from diffusers import DPMSolverMultistepScheduler
-            self.i2i.scheduler = DPMSolverMultistepScheduler.from_config(cfg)
+            # Common SDXL-ish FreeU settings; adjust if too sharp
+            pipe.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4)
+            active = True
         except Exception:
-            pass  # safe fallback to existing scheduler
-        
-        # FreeU can add crispness to textures with small cost
-        if use_freeu and hasattr(self.i2i, "enable_freeu"):
-            try:
-                # Common SDXL-ish FreeU settings; adjust if too sharp
-                self.i2i.enable_freeu(s1=0.9, s2=0.2, b1=1.2, b2=1.4)
-            except Exception:
-                pass
-            
-        # RNG
-        g = None
-        if seed is not None:
-            g = torch.Generator(device=self.device).manual_seed(int(seed))
-    
-        # --- run ---
-        kwargs = dict(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            image=init,
-            strength=float(strength),
-            num_inference_steps=int(steps),
-            guidance_scale=float(guidance_scale),
-            generator=g,
-            output_type="pil",
-        )
-        if guidance_rescale is not None:
-            kwargs["guidance_rescale"] = float(guidance_rescale)
-        if noise_offset is not None:
-            kwargs["noise_offset"] = float(noise_offset)
-    
-        if not hasattr(self, "_i2i_warm"):
+            pass
+    try:
+        yield active
+    finally:
+        if active and hasattr(pipe, "disable_freeu"):
             try:
-                from PIL import Image as _PILImage
-                _dummy = _PILImage.new("RGB", (64, 64), color=(128, 128, 128))
-                _ = self.i2i(prompt="warmup", image=_dummy, strength=0.1, num_inference_steps=2, output_type="pil")
+                pipe.disable_freeu()
             except Exception:
                 pass
-            self._i2i_warm = True
 
-        with torch.inference_mode():
-            result = self.i2i(**kwargs)
-        out_img = result.images[0]
-    
-        # Safety (unchanged)
-        np_img = np.array(out_img).astype(np.float32) / 255.0
-        clip_in = self.image_processor(images=[out_img], return_tensors="pt")
-        pixel_values = clip_in["pixel_values"].to(self.device)
-        _checked_images, has_nsfw_concepts = self.safety_checker(
-            images=np_img[None, ...], clip_input=pixel_values
-        )
-        safety = {
-            "flagged": bool(has_nsfw_concepts[0]),
-            "explanation": "Heuristic safety signal from StableDiffusionSafetyChecker; may over/under-flag.",
-        }
-    
-        # Reset FreeU to avoid surprising other calls that don't want it
-        if use_freeu and hasattr(self.i2i, "disable_freeu"):
-            try:
-                self.i2i.disable_freeu()
-            except Exception:
-                pass
-            
-        return _pil_to_png_bytes(out_img), safety
+class _LoRAPool:
+    """
+    Keeps LoRA styles injected as named PEFT adapters so that switching style
+    is a set_adapters call instead of an unload/reload. Targets are
+    (pipeline, patch_text_encoders) pairs; a pipeline whose text encoders are
+    shared with an earlier target only gets its UNet patched.
 
-    # ─────────────── Inpaint (reference-guided via IP-Adapter) ─────────────── #
-    @modal.method()
-    def generate_inpaint_ref(
-        self,
-        prompt: str,
-        bg_image_bytes: bytes,
-        mask_bytes: bytes,
-        ref_image_bytes: bytes,
-        # Keep a tiny set of knobs; defaults chosen for stability on SDXL:
-        steps: int = 28,
-        guidance_scale: float = 5,
-        seed=None,
-        out_size: int = 1024,
-        adapter: str = "none",
-        adapter_scale: float = 1.0,
-        negative_prompt: str | None = None,
+    A style that stays active for fuse_after requests in a row is merged into
+    the base weights (fused); any change first unmerges it and restores the
+    touched base weights bit-exactly from host memory.
+    """
+
+    def __init__(self, targets, max_resident: int, fuse_after: int = 0):
+        self.targets = targets
+        self.max_resident = max(1, int(max_resident))
+        self.fuse_after = max(0, int(fuse_after))
+        self.resident = OrderedDict()   # adapter -> None, least recently used first
+        self.host = {}                  # adapter -> (state_dict, network_alphas) on CPU
+        self.active = None
+        self.scale = None
+        self.noop_switches = 0
+        self.stable = 0                 # noop activations since the last switch
+        self.fused = []                 # LoRA layers currently merged into their base weights
+        self.base_weights = {}          # id(layer) -> pristine base weight on CPU
+        self.switches = deque(maxlen=512)
+
+    def _state_dict(self, name: str):
+        if name not in self.host:
+            pipe = self.targets[0][0]
+            self.host[name] = pipe.lora_state_dict(LORAS[name])
+        return self.host[name]
+
+    def _inject(self, name: str, targets=None):
+        state_dict, network_alphas = self._state_dict(name)
+        for pipe, patch_text_encoders in (self.targets if targets is None else targets):
+            pipe.load_lora_into_unet(
+                dict(state_dict), network_alphas=network_alphas, unet=pipe.unet,
+                adapter_name=name, _pipeline=pipe,
+            )
+            if not patch_text_encoders:
+                continue
+            for prefix in ("text_encoder", "text_encoder_2"):
+                te_state_dict = {k: v for k, v in state_dict.items() if k.startswith(prefix + ".")}
+                if te_state_dict:
+                    pipe.load_lora_into_text_encoder(
+                        te_state_dict, network_alphas=network_alphas, text_encoder=getattr(pipe, prefix),
+                        prefix=prefix, lora_scale=1.0, adapter_name=name, _pipeline=pipe,
+                    )
+        self.resident[name] = None
+
+    def _evict(self, name: str):
+        for pipe, patch_text_encoders in self.targets:
+            if patch_text_encoders:
+                pipe.delete_adapters([name])
+            else:
+                pipe.unet.delete_adapters([name])
+        self.resident.pop(name, None)
+
+    def _disable(self, targets=None):
+        for pipe, patch_text_encoders in (self.targets if targets is None else targets):
+            (pipe if patch_text_encoders else pipe.unet).disable_lora()
+
+    def _set(self, name: str, scale: float, enable: bool, targets=None):
+        for pipe, patch_text_encoders in (self.targets if targets is None else targets):
+            if patch_text_encoders:
+                if enable:
+                    pipe.enable_lora()
+                pipe.set_adapters([name], adapter_weights=[float(scale)])
+            else:
+                if enable:
+                    pipe.unet.enable_lora()
+                pipe.unet.set_adapters([name], weights=[float(scale)])
+
+    def _lora_layers(self, name: str) -> list:
+        layers, seen = [], set()
+        for pipe, patch_text_encoders in self.targets:
+            modules = [pipe.unet] + ([pipe.text_encoder, pipe.text_encoder_2] if patch_text_encoders else [])
+            for module in modules:
+                for layer in module.modules():
+                    if isinstance(layer, LoraLayer) and name in layer.lora_A and id(layer) not in seen:
+                        seen.add(id(layer))
+                        layers.append(layer)
+        return layers
+
+    def _record(self, kind: str, frm, to, t0: float):
+        self.switches.append({
+            "from": frm,
+            "to": to,
+            "kind": kind,
+            "ms": round((time.perf_counter() - t0) * 1000.0, 3),
+        })
+
+    def fuse(self):
+        """Merge the active style (at its set_adapters scale) into the base weights."""
+        if self.active is None or self.fused:
+            return
+        t0 = time.perf_counter()
+        layers = self._lora_layers(self.active)
+        with torch.no_grad():
+            for layer in layers:
+                weight = layer.get_base_layer().weight
+                if id(layer) not in self.base_weights:
+                    self.base_weights[id(layer)] = weight.detach().to("cpu", copy=True)
+                layer.merge(adapter_names=[self.active])
+        self.fused = layers
+        self._record("fuse", self.active, self.active, t0)
+
+    def unfuse(self):
+        """Undo fuse(): unmerge, then copy the saved base weights back so no rounding drift accumulates."""
+        if not self.fused:
+            return
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            for layer in self.fused:
+                layer.unmerge()
+                weight = layer.get_base_layer().weight
+                weight.copy_(self.base_weights[id(layer)].to(weight.device, non_blocking=True))
+        self.fused = []
+        self._record("unfuse", self.active, self.active, t0)
+
+    def add_target(self, pipe, patch_text_encoders: bool = False):
+        """Attach a pipeline loaded after startup: inject the resident adapters, mirror the active style."""
+        self.unfuse()
+        self.stable = 0
+        target = [(pipe, patch_text_encoders)]
+        for name in list(self.resident):
+            self._inject(name, target)
+        self.targets.append(target[0])
+        if self.active is not None:
+            self._set(self.active, self.scale, True, target)
+        elif self.resident:
+            self._disable(target)
+
+    def preload(self, names):
+        for name in names:
+            if name in self.resident:
+                continue
+            try:
+                self._inject(name)
+            except Exception as e:
+                print(f"LoRA preload '{name}' failed (will load on first use):", e)
+        # freshly injected adapters come up enabled; keep "no style" until asked
+        if self.active is None and self.resident:
+            self._disable()
+
+    def activate(self, name: str | None, scale: float = 1.0):
+        if name == self.active and (name is None or scale == self.scale):
+            self.noop_switches += 1
+            self.stable += 1
+            if self.fuse_after and self.stable >= self.fuse_after:
+                self.fuse()
+            return False
+        self.unfuse()
+        self.stable = 0
+        t0 = time.perf_counter()
+        kind = "off" if name is None else "set"
+        if name is None:
+            self._disable()
+        else:
+            if name not in self.resident:
+                while len(self.resident) >= self.max_resident:
+                    victim = next(iter(self.resident))
+                    if victim == self.active:
+                        self.resident.move_to_end(victim)
+                        victim = next(iter(self.resident))
+                    self._evict(victim)
+                self._inject(name)
+                kind = "load"
+            self.resident.move_to_end(name)
+            self._set(name, scale, enable=self.active is None)
+        self._record(kind, self.active, name, t0)
+        self.active, self.scale = name, (None if name is None else float(scale))
+        return True
+
+    def stats(self) -> dict:
+        by_kind = {}
+        for sw in self.switches:
+            by_kind.setdefault(sw["kind"], []).append(sw["ms"])
+        return {
+            "active": self.active,
+            "scale": self.scale,
+            "resident": list(self.resident),
+            "host_cached": sorted(self.host),
+            "noop_switches": self.noop_switches,
+            "fused": bool(self.fused),
+            "fused_layers": len(self.fused),
+            "base_weights_mb": round(sum(_tensor_bytes(w) for w in self.base_weights.values()) / 2**20, 1),
+            "switch_ms": {
+                kind: {"count": len(v), "p50": _percentile(v, 0.5), "p95": _percentile(v, 0.95), "max": max(v)}
+                for kind, v in by_kind.items()
+            },
+            "recent": list(self.switches)[-20:],
+        }
+
+def _styled_prompts(prompt: str, negative_prompt: str | None, adapter: str | None) -> tuple:
+    """Shrink prompts, then apply the short STYLE_HINTS suffixes for the adapter."""
+    hint = STYLE_HINTS.get(adapter, {})
+    prompt = _shrink_prompt(prompt, max_words=70)
+    neg = _shrink_prompt(negative_prompt, max_words=70) if negative_prompt else None
+    if hint.get("add"):
+        prompt = f"{prompt} {hint['add']}".strip()
+    if neg:
+        negative_prompt = f"{neg} {hint.get('neg','')}".strip()
+    else:
+        negative_prompt = hint.get("neg", None)
+    return prompt, negative_prompt
+
+def _adapter_name(adapter: str | None) -> str | None:
+    """LORAS key for a requested style, None for no style; raises on unknown names."""
+    adapter = (adapter or "none").lower()
+    if adapter in ("none", "off", "disable"):
+        return None
+    if adapter not in LORAS:
+        raise ValueError(f"Unknown adapter '{adapter}'. Choose one of: {', '.join(list(LORAS.keys()) + ['none'])}")
+    return adapter
+
+def _result_key(kind: str, params: dict) -> str | None:
+    """
+    Canonical hash of a generator call, or None when it is not deterministic
+    (no seed). Prompts are taken after _styled_prompts, sizes after _snap64 (plus
+    the _render_size when a bucket renders it) and image inputs by content hash,
+    so requests that render the same pixels share a key. Container state is
+    not part of it: running the style fused (_LoRAPool) moves pixels by a mean
+    within LORA_FUSE_TOLERANCE (benchmark_lora_fuse checks it), and one key
+    keeps a style's steady, fused traffic hitting its earlier results.
+    """
+    if params.get("seed") is None:
+        return None
+    if int(params.get("num_candidates") or 1) > 1:
+        return None   # (list, summary) results are not stored; each seed is reproducible alone
+    p = {name: value for name, value in params.items() if name not in ("progress_id", "preview_every", "num_candidates")}
+    if int(p.get("cache_interval") or 1) <= 1:
+        p.pop("cache_interval", None)   # keys from before the knob existed stay valid
+    p["adapter"] = (p.get("adapter") or "none").lower()
+    p["prompt"], p["negative_prompt"] = _styled_prompts(p.get("prompt"), p.get("negative_prompt"), p["adapter"])
+    for name in ("width", "height", "out_size"):
+        if p.get(name):
+            p[name] = _snap64(p[name])
+    requested = (p["width"], p["height"]) if p.get("width") and p.get("height") else (p["out_size"],) * 2 if p.get("out_size") else None
+    if requested and _render_size(kind, *requested) != requested:
+        p["render_size"] = list(_render_size(kind, *requested))
+    p["output_format"] = _output_format(p.get("output_format"))
+
+    def _canon(value):
+        if isinstance(value, (bytes, bytearray)):
+            return "sha256:" + _content_hash(bytes(value))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return value
+
+    canon = {name: _canon(value) for name, value in sorted(p.items())}
+    blob = json.dumps([RESULT_CACHE_VERSION, kind, canon], sort_keys=True, default=str)
+    return _content_hash(blob.encode("utf-8"))
+
+class _ResultStore:
+    """
+    Size-bounded LRU of finished results on disk, one file per key: a JSON
+    header line ({"safety", "compute_s"}) followed by the encoded image.
+    Recency is the file mtime (touched on hit), so the order survives
+    restarts. Identical requests that arrive while the first is still running
+    wait on its Future instead of denoising again.
+
+    The directory is shared with other containers: a key missing from the
+    index is looked up on disk, after an on_reload() (volume reload) at most
+    every reload_interval_s, and the index is re-scanned at the same rate
+    before the byte bound is enforced, so their files are served and counted.
+    """
+
+    def __init__(self, root: str, max_bytes: int, on_write=None, on_reload=None, reload_interval_s: float = RESULT_RELOAD_INTERVAL_S):
+        self.root = root
+        self.max_bytes = int(max_bytes)
+        self._on_write = on_write
+        self._on_reload = on_reload
+        self.reload_interval_s = float(reload_interval_s)
+        self._last_reload = self._last_scan = time.monotonic()
+        self._lock = threading.Lock()
+        self._index = OrderedDict()   # key -> file size, least recently used first
+        self._inflight = {}           # key -> Future of (data, safety)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.compute_s_saved = 0.0
+        self.reloads = 0
+        self.rescans = 0
+        os.makedirs(root, exist_ok=True)
+        self._index = self._scan()
+        self.bytes = sum(self._index.values())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def _scan(self) -> OrderedDict:
+        found = []
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    st = entry.stat()
+                    found.append((st.st_mtime, entry.name, st.st_size))
+            except OSError:
+                pass   # removed by another container mid-scan
+        return OrderedDict((key, size) for _, key, size in sorted(found))
+
+    def _rescan(self):
+        # rebuild the index from disk so files other containers wrote count toward max_bytes
+        index = self._scan()
+        with self._lock:
+            self._index, self.bytes = index, sum(index.values())
+            self._last_scan = time.monotonic()
+            self.rescans += 1
+
+    def _reload(self) -> bool:
+        """Pull other containers' commits (rate-limited); True if a reload ran."""
+        with self._lock:
+            now = time.monotonic()
+            if self._on_reload is None or now - self._last_reload < self.reload_interval_s:
+                return False
+            self._last_reload = now
+            self.reloads += 1
+        self._on_reload()
+        self._rescan()
+        return True
+
+    def _get(self, key: str):
+        try:
+            with open(self._path(key), "rb") as f:
+                header, data = f.read().split(b"\n", 1)
+            meta = json.loads(header)
+            if not isinstance(meta, dict):
+                raise ValueError("bad header")
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            # missing, truncated (half-synced from another container) or corrupt: a miss
+            with self._lock:
+                self.bytes -= self._index.pop(key, 0)
+            return None
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            else:
+                # written by another container since the last scan
+                self._index[key] = len(header) + 1 + len(data)
+                self.bytes += self._index[key]
+            self.hits += 1
+            self.bytes_saved += len(data)
+            self.compute_s_saved += float(meta.get("compute_s", 0.0))
+        return data, meta.get("safety")
+
+    def _put(self, key: str, data: bytes, safety, compute_s: float):
+        header = json.dumps({"safety": safety, "compute_s": round(compute_s, 3)}).encode("utf-8")
+        tmp = self._path(key) + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(header + b"\n" + data)
+        os.replace(tmp, self._path(key))
+        size = len(header) + 1 + len(data)
+        if time.monotonic() - self._last_scan >= self.reload_interval_s:
+            self._rescan()
+        evicted = []
+        with self._lock:
+            self.bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            while len(self._index) > 1 and self.bytes > self.max_bytes:
+                old, freed = self._index.popitem(last=False)
+                self.bytes -= freed
+                self.evictions += 1
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+        if self._on_write is not None:
+            self._on_write()
+
+    def fetch(self, key: str | None, compute):
+        """(data, safety) for key from disk, from an identical in-flight call, or compute()."""
+        if key is None:
+            return compute()
+        # not indexed here: another container may have written it (visible now, or after a reload)
+        if key in self._index or os.path.exists(self._path(key)) or (self._reload() and os.path.exists(self._path(key))):
+            hit = self._get(key)
+            if hit is not None:
+                return hit
+        with self._lock:
+            fut = self._inflight.get(key)
+            owner = fut is None
+            if owner:
+                fut = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not owner:
+            return fut.result()
+        try:
+            t0 = time.perf_counter()
+            data, safety = compute()
+            try:
+                self._put(key, data, safety, time.perf_counter() - t0)
+            except OSError as e:
+                print(f"[results] could not store {key}: {e}")
+            fut.set_result((data, safety))
+            return data, safety
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._index),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes_saved": self.bytes_saved,
+                "compute_s_saved": round(self.compute_s_saved, 2),
+                "reloads": self.reloads,
+                "rescans": self.rescans,
+            }
+
+def _result_cached(kind: str):
+    """
+    Serve seeded host calls from self.results (see _ResultStore). Goes outside
+    _gpu_serialized so callers waiting on an identical in-flight request do
+    not hold the GPU lock.
+    """
+    def decorate(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            if self.results is None:
+                return fn(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            params.pop("self")
+            try:
+                key = _result_key(kind, params)
+            except Exception:
+                key = None   # let the call itself report bad arguments
+            return self.results.fetch(key, lambda: fn(self, *args, **kwargs))
+        return wrapper
+    return decorate
+
+def _resolve(value):
+    if isinstance(value, Future):
+        return value.result()
+    if isinstance(value, (tuple, list)):
+        return type(value)(_resolve(v) for v in value)
+    return value
+
+def _gpu_serialized(fn):
+    """
+    Run a host method under the GPU lock (pipelines and adapter state are
+    shared). Futures in the return value, e.g. off-thread image encodes, are
+    awaited after the lock is released so the next denoise can start.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with self._gpu_section():
+            out = fn(self, *args, **kwargs)
+        return _resolve(out)
+    return wrapper
+
+def _staged(stage: str, sync: bool = False):
+    """Time a host method as `stage` (see SDXLLoRAHost._stage)."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self._stage(stage, sync=sync):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return deco
+
+def _traced(kind: str):
+    """
+    Time one host request as a _StageTrace: stages recorded on this thread
+    while it runs land in it, and it feeds self.metrics when done. Callers may
+    pass return_timings=True to get the trace summary as safety["timings"].
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, return_timings: bool = False, **kwargs):
+            trace = _StageTrace(kind)
+            outer = getattr(self._trace_local, "traces", ())
+            self._trace_local.traces = (trace,)
+            try:
+                out = fn(self, *args, **kwargs)
+            finally:
+                self._trace_local.traces = outer
+            self.metrics.observe_request(trace.finish())
+            if return_timings and isinstance(out, tuple) and len(out) == 2 and isinstance(out[1], dict):
+                out = (out[0], dict(out[1], timings=trace.summary()))
+            return out
+        return wrapper
+    return deco
+
+def _requires(*components):
+    """
+    Wait for lazily loaded startup components (see _StagedLoader) before
+    running; apply outside _gpu_serialized so a loading component can take
+    the GPU lock for its own warmup.
+    """
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            for name in components:
+                self.loader.require(name)
+            return fn(self, *args, **kwargs)
+        return wrapper
+    return deco
+
+class _MicroBatcher:
+    """
+    Groups submissions that share a key for up to `window_ms` (or until
+    `max_batch` are waiting) and hands each group to `run_batch(key, jobs)` on a
+    single worker thread. Each submission gets its own Future.
+    """
+
+    def __init__(self, run_batch, window_ms: float, max_batch: int):
+        self._run_batch = run_batch
+        self.window_s = max(0.0, float(window_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._cv = threading.Condition()
+        self._pending = OrderedDict()   # key -> [(job, future, enqueued_at)]
+        self.batch_sizes = deque(maxlen=512)
+        self._thread = threading.Thread(target=self._loop, name="t2i-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, job) -> Future:
+        fut = Future()
+        with self._cv:
+            self._pending.setdefault(key, []).append((job, fut, time.monotonic()))
+            self._cv.notify()
+        return fut
+
+    def _next_group(self):
+        with self._cv:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for key, items in self._pending.items():
+                    deadline = items[0][2] + self.window_s
+                    if len(items) >= self.max_batch or now >= deadline:
+                        group, rest = items[:self.max_batch], items[self.max_batch:]
+                        if rest:
+                            self._pending[key] = rest
+                        else:
+                            del self._pending[key]
+                        return key, group
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._cv.wait(timeout=wait)
+
+    def _loop(self):
+        while True:
+            key, group = self._next_group()
+            live = [(job, fut) for job, fut, _ in group if fut.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            self.batch_sizes.append(len(live))
+            try:
+                results = self._run_batch(key, [job for job, _ in live])
+                for (_, fut), res in zip(live, results):
+                    fut.set_result(res)
+            except Exception as e:
+                for _, fut in live:
+                    fut.set_exception(e)
+
+    def stats(self) -> dict:
+        sizes = list(self.batch_sizes)
+        return {
+            "window_ms": self.window_s * 1000.0,
+            "max_batch": self.max_batch,
+            "batches": len(sizes),
+            "mean_batch": round(sum(sizes) / len(sizes), 3) if sizes else 0.0,
+            "max_seen": max(sizes) if sizes else 0,
+        }
+
+def _nearest_bucket(sizes, width: int, height: int, strict: bool = False) -> tuple:
+    """
+    Closest bucket by aspect, then area. With strict=True a bucket outside
+    BUCKET_ASPECT_TOLERANCE / BUCKET_AREA_TOLERANCE is not taken and
+    (width, height) comes back unchanged.
+    """
+    if not sizes:
+        return int(width), int(height)
+    aspect, area = math.log(width / float(height)), width * height
+    best = min(sizes, key=lambda b: (abs(math.log(b[0] / float(b[1])) - aspect), abs(b[0] * b[1] - area)))
+    best = (int(best[0]), int(best[1]))
+    if strict and (
+        abs(math.log(best[0] / float(best[1])) - aspect) > BUCKET_ASPECT_TOLERANCE
+        or abs(best[0] * best[1] / float(area) - 1.0) > BUCKET_AREA_TOLERANCE
+    ):
+        return int(width), int(height)
+    return best
+
+def _render_size(kind: str, width: int, height: int) -> tuple:
+    """
+    (width, height) a t2i/i2i call of that (64-snapped) size denoises at: a
+    warmed bucket when one is within tolerance, else the size itself. Callers
+    resize the output back (_fit_output), so the size returned never changes.
+    Module-level so the web tier prepares i2i init images at this size once.
+    """
+    if not SNAP_TO_BUCKETS or kind not in ("t2i", "i2i"):
+        return int(width), int(height)
+    return _nearest_bucket(WARMUP_BUCKETS.get(kind), width, height, strict=True)
+
+def _fit_output(img: Image.Image, width: int, height: int) -> Image.Image:
+    """img at the requested width x height (a no-op unless a bucket rendered it)."""
+    if img.size == (int(width), int(height)):
+        return img
+    return img.resize((int(width), int(height)), Image.Resampling.LANCZOS)
+
+class _WarmupManager:
+    """
+    Resolution buckets per pipeline: snaps request shapes to the nearest
+    bucket, warms each bucket once, and tracks warmup, first-request and
+    steady-state denoise latency per (pipeline, bucket).
+    """
+
+    def __init__(self, buckets: dict):
+        self.buckets = {kind: tuple((int(w), int(h)) for w, h in sizes) for kind, sizes in buckets.items()}
+        self._lock = threading.Lock()
+        self._stats = {}   # (kind, (w, h)) -> {"warmup_ms", "first_ms", "samples"}
+
+    def nearest(self, kind: str, width: int, height: int, strict: bool = False) -> tuple:
+        return _nearest_bucket(self.buckets.get(kind), width, height, strict=strict)
+
+    def _entry(self, kind: str, size: tuple) -> dict:
+        return self._stats.setdefault((kind, tuple(size)), {"warmup_ms": None, "first_ms": None, "samples": deque(maxlen=256)})
+
+    def warm(self, kind: str, run):
+        """run(width, height) once per bucket of `kind`; failures are logged, not raised."""
+        for size in self.buckets.get(kind, ()):
+            t0 = time.perf_counter()
+            try:
+                run(*size)
+            except Exception as e:
+                print(f"[warmup] {kind} {size[0]}x{size[1]} failed: {e}")
+                continue
+            with self._lock:
+                self._entry(kind, size)["warmup_ms"] = (time.perf_counter() - t0) * 1000.0
+
+    def record(self, kind: str, size: tuple, ms: float):
+        with self._lock:
+            entry = self._entry(kind, size)
+            if entry["first_ms"] is None:
+                entry["first_ms"] = ms
+            else:
+                entry["samples"].append(ms)
+
+    def report(self) -> dict:
+        with self._lock:
+            out = {}
+            for (kind, (w, h)), entry in sorted(self._stats.items()):
+                samples = list(entry["samples"])
+                out[f"{kind} {w}x{h}"] = {
+                    "warmup_ms": round(entry["warmup_ms"], 1) if entry["warmup_ms"] is not None else None,
+                    "first_ms": round(entry["first_ms"], 1) if entry["first_ms"] is not None else None,
+                    "steady_ms_p50": round(_percentile(samples, 0.5), 1),
+                    "steady_ms_p95": round(_percentile(samples, 0.95), 1),
+                    "requests": len(samples) + (entry["first_ms"] is not None),
+                    "bucketed": (w, h) in self.buckets.get(kind, ()),
+                }
+            return out
+
+def _mask_crop_box(mask: Image.Image, pad: int = MASK_CROP_PAD, min_side: int = MASK_CROP_MIN_SIDE):
+    """
+    Padded bounding box (left, top, right, bottom) of the non-black mask area,
+    grown around its center to `min_side` (64-aligned) and clamped to the
+    canvas. None for an empty mask.
+    """
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+
+    def _grow(lo: int, hi: int, limit: int) -> tuple:
+        side = -(-max(hi - lo + 2 * pad, min_side) // 64) * 64
+        side = min(side, limit)
+        lo = int(round((lo + hi - side) / 2.0))
+        lo = max(0, min(lo, limit - side))
+        return lo, lo + side
+
+    w, h = mask.size
+    left, right = _grow(bbox[0], bbox[2], w)
+    top, bottom = _grow(bbox[1], bbox[3], h)
+    return left, top, right, bottom
+
+def _snap64(x: int | float) -> int:
+    try:
+        return int(round(float(x) / 64.0) * 64)
+    except Exception:
+        return int(x)
+
+_STOP = {
+    "the","a","an","and","or","but","to","of","in","on","for","with","by",
+    "at","from","as","that","this","these","those","is","are","was","were",
+    "be","been","being","it","its","into","over","under","between","through"
+}
+
+def _shrink_prompt(text: str, max_words: int = 70) -> str:
+    if not text: return text
+    words = []
+    for w in text.replace("\n"," ").split():
+        ww = "".join(ch for ch in w if ch.isalnum() or ch in "-_:,.;")
+        lw = ww.lower()
+        if lw in _STOP and len(words) > 8:
+            continue
+        if ww:
+            words.append(ww)
+        if len(words) >= max_words:
+            break
+    return " ".join(words)
+
+# ───────────────────────── Preprocessing (CPU) ───────────────────────── #
+# Decode/resize/mask hygiene shared by the CPU web functions and the GPU class.
+# The web functions run it before calling the GPU, so the GPU receives
+# canvas-sized inputs and an already-feathered mask (preprocessed=True).
+
+# Max per-pixel deviation (0-255) of _clean_mask from the PIL reference _clean_mask_pil
+MASK_TOLERANCE = 8
+
+# Lossless, fast-to-write PNG for already-normalized images handed to the GPU
+TRANSPORT_PNG_LEVEL = 1
+
+_cpu_pool = None
+
+def _cpu_executor() -> ThreadPoolExecutor:
+    global _cpu_pool
+    if _cpu_pool is None:
+        _cpu_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prep")
+    return _cpu_pool
+
+def _open_rgb(data: bytes, target_long_side: int | None = None, target_short_side: int | None = None) -> Image.Image:
+    """
+    Decode to RGB. For JPEGs bigger than the target, let libjpeg decode at a
+    reduced DCT scale (1/2, 1/4, 1/8) that still covers the target size.
+    Callers that center-crop to a square keep the short side, so they pass
+    target_short_side; the decode then stays at least that large on both sides.
+    """
+    img = Image.open(io.BytesIO(data))
+    if (target_long_side or target_short_side) and img.format == "JPEG":
+        w, h = img.size
+        scale = max(
+            target_long_side / float(max(w, h)) if target_long_side else 0.0,
+            target_short_side / float(min(w, h)) if target_short_side else 0.0,
+        )
+        if scale < 1.0:
+            img.draft("RGB", (max(1, int(round(w * scale))), max(1, int(round(h * scale)))))
+    return img.convert("RGB")
+
+def _fit_canvas(bg: Image.Image, out_size: int | None) -> Image.Image:
+    """Scale so the longest side equals the (64-snapped) story canvas size."""
+    if out_size and int(out_size) > 0:
+        out_size = _snap64(int(out_size))
+        w, h = bg.size
+        scale = out_size / float(max(w, h))
+        if scale != 1.0:
+            bg = bg.resize((max(1, int(round(w * scale))), max(1, int(round(h * scale)))), Image.Resampling.LANCZOS)
+    return bg
+
+def _prepare_init_image(image_bytes: bytes, out_size: int | None, keep_aspect: bool = True) -> Image.Image:
+    """i2i init image at out_size² (center-cropped when keep_aspect, else squashed)."""
+    size = _snap64(int(out_size)) if out_size else None
+    # both branches fill size² from the whole short side
+    init = _open_rgb(image_bytes, target_short_side=size)
+    if size:
+        if keep_aspect:
+            # center-crop to square, then resize → no distortion
+            init = ImageOps.fit(init, (size, size), method=Image.Resampling.LANCZOS, centering=(0.5, 0.5))
+        else:
+            init = init.resize((size, size), Image.Resampling.LANCZOS)
+    return init
+
+def _mask_px(size: tuple) -> int:
+    # Edge hygiene scaled to size
+    return max(1, int(round(max(size) / 1024 * 1.2)))
+
+def _clean_mask_pil(mask: Image.Image, size: tuple) -> Image.Image:
+    """Reference mask hygiene (PIL filters); _clean_mask must stay within MASK_TOLERANCE of it."""
+    if mask.size != size:
+        mask = mask.resize(size, Image.Resampling.LANCZOS)
+    # Binarize mask (sane contract: white=inpaint, black=keep)
+    mask = mask.point(lambda p: 255 if p > 127 else 0)
+    px = _mask_px(size)
+    mask = mask.filter(ImageFilter.MaxFilter(2 * px + 1))
+    mask = mask.filter(ImageFilter.GaussianBlur(0.8 * px))
+    return mask
+
+def _max_along(a, r: int, axis: int):
+    out = a.copy()
+    n = a.shape[axis]
+    for d in range(1, min(r, n - 1) + 1):
+        lo = [slice(None)] * a.ndim
+        hi = [slice(None)] * a.ndim
+        lo[axis], hi[axis] = slice(d, None), slice(None, -d)
+        lo, hi = tuple(lo), tuple(hi)
+        np.maximum(out[lo], a[hi], out=out[lo])
+        np.maximum(out[hi], a[lo], out=out[hi])
+    return out
+
+def _gauss_along(a, sigma: float, axis: int):
+    k = max(1, int(math.ceil(3.0 * sigma)))
+    x = np.arange(-k, k + 1, dtype=np.float32)
+    w = np.exp(-(x * x) / (2.0 * sigma * sigma))
+    w /= w.sum()
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (k, k)
+    p = np.pad(a, pad, mode="edge")
+    out = np.zeros_like(a)
+    for i, wi in enumerate(w):
+        sl = [slice(None)] * a.ndim
+        sl[axis] = slice(i, i + a.shape[axis])
+        out += wi * p[tuple(sl)]
+    return out
+
+def _clean_mask(mask: Image.Image, size: tuple) -> Image.Image:
+    """
+    Vectorized mask hygiene: threshold at 127, square dilation by px, Gaussian
+    feather (sigma 0.8·px). Only the mask's bounding box (plus the dilation and
+    blur reach) is filtered; everything outside stays 0.
+    """
+    if mask.size != size:
+        mask = mask.resize(size, Image.Resampling.LANCZOS)
+    binary = np.asarray(mask, dtype=np.uint8) > 127
+    out = np.zeros(binary.shape, dtype=np.uint8)
+    rows, cols = np.flatnonzero(binary.any(axis=1)), np.flatnonzero(binary.any(axis=0))
+    if rows.size == 0:
+        return Image.fromarray(out, mode="L")
+
+    px = _mask_px(size)
+    sigma = 0.8 * px
+    reach = px + int(math.ceil(3.0 * sigma)) + 1
+    h, w = binary.shape
+    t, b = max(0, rows[0] - reach), min(h, rows[-1] + 1 + reach)
+    l, r = max(0, cols[0] - reach), min(w, cols[-1] + 1 + reach)
+
+    region = binary[t:b, l:r].astype(np.float32) * 255.0
+    region = _max_along(_max_along(region, px, 0), px, 1)
+    region = _gauss_along(_gauss_along(region, sigma, 0), sigma, 1)
+    out[t:b, l:r] = np.clip(region + 0.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(out, mode="L")
+
+def _preprocess_inpaint_inputs(bg_bytes: bytes, mask_bytes: bytes, ref_bytes: bytes | None, out_size: int | None):
+    """
+    CPU-side inpaint prep for generate_inpaint_ref(preprocessed=True): canvas-sized
+    background, cleaned+feathered mask and 512² reference as transport PNGs.
+    Background and reference decode in parallel.
+    """
+    pool = _cpu_executor()
+    bg_f = pool.submit(lambda: _fit_canvas(_open_rgb(bg_bytes, _snap64(out_size) if out_size else None), out_size))
+    ref_f = pool.submit(lambda: _prepare_ref_image(_open_rgb(ref_bytes, target_short_side=512), target_size=512)) if ref_bytes else None
+    mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
+    bg = bg_f.result()
+    mask = _clean_mask(mask, bg.size)
+    encode = lambda img: _pil_to_png_bytes(img, compress_level=TRANSPORT_PNG_LEVEL)
+    return encode(bg), encode(mask), (encode(ref_f.result()) if ref_f else None)
+
+# ───────────────────────── Job Queue ───────────────────────── #
+# Submit → poll/stream status → fetch result, with a priority scheduler in
+# front of SDXLLoRAHost: "interactive" jobs (a reader waiting on a page) go
+# ahead of "bulk" ones (pre-rendering the rest of a book), users share each
+# tier round-robin, and queued or running jobs can be cancelled. The scheduler
+# is plain Python; runners decide how a job reaches the GPU (spawned Modal
+# calls in JobQueue, direct in-process calls via _local_job_runners).
+
+JOB_TIERS = ("interactive", "bulk")
+JOB_TERMINAL = ("done", "failed", "cancelled")
+
+# Jobs in flight to SDXLLoRAHost at once (≈ GPU containers the queue keeps busy)
+JOB_GPU_SLOTS = 2
+
+# After this many interactive dispatches in a row, a waiting bulk job goes next
+JOB_BULK_EVERY = 8
+
+# Finished jobs (and their images) stay fetchable this long
+JOB_RESULT_TTL_S = 3600
+
+class _Job:
+    def __init__(self, job_id: str, kind: str, kwargs: dict, user: str, tier: str, lock=None):
+        self.id = job_id
+        self.kind = kind
+        self.kwargs = kwargs
+        self.user = user
+        self.tier = tier
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self._cancel_hooks = []
+        # the scheduler's lock: status changes and hook registration must not interleave
+        self._lock = lock or threading.Lock()
+
+    def on_cancel(self, fn):
+        """Runners register how to abort the job once it is running (e.g. FunctionCall.cancel)."""
+        with self._lock:
+            self._cancel_hooks.append(fn)
+            cancelled = self.status == "cancelled"
+        # hooks may block (a network call); run them outside the lock, like cancel() does
+        if cancelled:
+            fn()
+
+    def public(self, ahead: int | None = None) -> dict:
+        now = time.time()
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "user": self.user,
+            "priority": self.tier,
+            "status": self.status,
+            "ahead": ahead,
+            "wait_ms": round(((self.started or self.finished or now) - self.submitted) * 1e3, 1),
+            "run_ms": round(((self.finished or now) - self.started) * 1e3, 1) if self.started else None,
+            "error": self.error,
+        }
+
+class _JobScheduler:
+    """
+    Priority + fair-share dispatcher. `runners` maps a job kind to
+    `run(job) -> result`; `slots` worker threads each run one job at a time.
+    Interactive beats bulk (bulk still gets one in every `bulk_every`
+    dispatches), and within a tier users take turns so one book pre-render
+    cannot starve another reader.
+    """
+
+    def __init__(self, runners: dict, slots: int = JOB_GPU_SLOTS, bulk_every: int = JOB_BULK_EVERY, ttl_s: float = JOB_RESULT_TTL_S):
+        self._runners = runners
+        self.slots = max(1, int(slots))
+        self.bulk_every = max(1, int(bulk_every))
+        self.ttl_s = float(ttl_s)
+        self._cv = threading.Condition()
+        self._jobs = {}                                          # job_id -> _Job
+        self._queues = {tier: OrderedDict() for tier in JOB_TIERS}  # tier -> user -> deque[_Job]
+        self._streak = 0                                         # interactive dispatches since the last bulk one
+        self.running = 0
+        self.counts = {status: 0 for status in ("submitted",) + JOB_TERMINAL}
+        self.waits = {tier: deque(maxlen=1024) for tier in JOB_TIERS}
+        for i in range(self.slots):
+            threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True).start()
+
+    def submit(self, kind: str, kwargs: dict, user: str = "anonymous", priority: str = "interactive") -> str:
+        if kind not in self._runners:
+            raise ValueError(f"Unknown job kind '{kind}'. Available: {sorted(self._runners)}")
+        if priority not in JOB_TIERS:
+            raise ValueError(f"Unknown priority '{priority}'. Available: {list(JOB_TIERS)}")
+        job = _Job(uuid.uuid4().hex, kind, kwargs, str(user or "anonymous"), priority, lock=self._cv)
+        with self._cv:
+            self._prune()
+            self._jobs[job.id] = job
+            self._queues[priority].setdefault(job.user, deque()).append(job)
+            self.counts["submitted"] += 1
+            self._cv.notify_all()
+        return job.id
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl_s
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _pick(self, queues: dict, streak: int):
+        """Pop the job to dispatch next from `queues` (tier -> user -> deque); (job, new streak) or None."""
+        interactive, bulk = queues["interactive"], queues["bulk"]
+        if interactive and (streak < self.bulk_every or not bulk):
+            tier, streak = interactive, streak + 1
+        elif bulk:
+            tier, streak = bulk, 0
+        else:
+            return None
+        # round-robin: take the head user's oldest job, then send that user to the back
+        user, q = next(iter(tier.items()))
+        job = q.popleft()
+        if q:
+            tier.move_to_end(user)
+        else:
+            del tier[user]
+        return job, streak
+
+    def _ahead(self, job: _Job) -> int:
+        # queued jobs dispatched before this one: replay _pick on a copy of the queues,
+        # so the bulk interleave and the per-user round-robin are counted
+        queues = {tier: OrderedDict((u, deque(q)) for u, q in self._queues[tier].items()) for tier in JOB_TIERS}
+        streak, ahead = self._streak, 0
+        while True:
+            picked = self._pick(queues, streak)
+            if picked is None or picked[0] is job:
+                return ahead
+            streak, ahead = picked[1], ahead + 1
+
+    def _next_job(self) -> _Job:
+        with self._cv:
+            while True:
+                picked = self._pick(self._queues, self._streak)
+                if picked is None:
+                    self._cv.wait()
+                    continue
+                job, self._streak = picked
+                job.status, job.started = "running", time.time()
+                self.waits[job.tier].append((job.started - job.submitted) * 1e3)
+                self.running += 1
+                self._cv.notify_all()
+                return job
+
+    def _loop(self):
+        while True:
+            job = self._next_job()
+            result, error = None, None
+            try:
+                result = self._runners[job.kind](job)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            with self._cv:
+                self.running -= 1
+                if job.status != "cancelled":
+                    job.result, job.error = result, error
+                    job.status = "failed" if error else "done"
+                    job.finished = time.time()
+                    self.counts[job.status] += 1
+                self._cv.notify_all()
+
+    def cancel(self, job_id: str) -> bool | None:
+        """True if cancelled, False if already finished, None if unknown."""
+        with self._cv:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status in JOB_TERMINAL:
+                return False
+            if job.status == "queued":
+                queues = self._queues[job.tier]
+                queues[job.user].remove(job)
+                if not queues[job.user]:
+                    del queues[job.user]
+            job.status, job.finished = "cancelled", time.time()
+            self.counts["cancelled"] += 1
+            hooks = list(job._cancel_hooks)
+            self._cv.notify_all()
+        for fn in hooks:
+            try:
+                fn()
+            except Exception:
+                pass
+        return True
+
+    def status(self, job_id: str, wait_s: float = 0.0) -> dict | None:
+        """Job status; with wait_s > 0, long-polls until the status changes or the job finishes."""
+        with self._cv:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if wait_s > 0 and job.status not in JOB_TERMINAL:
+                seen = job.status
+                self._cv.wait_for(lambda: job.status != seen, timeout=wait_s)
+            return job.public(self._ahead(job) if job.status == "queued" else None)
+
+    def result(self, job_id: str):
+        """(status, result) — result is the runner's return value once status is "done"."""
+        with self._cv:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None, None
+            return job.status, job.result
+
+    def stats(self) -> dict:
+        with self._cv:
+            return {
+                "slots": self.slots,
+                "running": self.running,
+                "queued": {tier: sum(len(q) for q in self._queues[tier].values()) for tier in JOB_TIERS},
+                "queued_users": {tier: len(self._queues[tier]) for tier in JOB_TIERS},
+                "counts": dict(self.counts),
+                "wait_ms": {
+                    tier: {
+                        "p50": round(_percentile(w, 0.5), 1),
+                        "p95": round(_percentile(w, 0.95), 1),
+                        "max": round(max(w), 1) if w else 0.0,
+                        "n": len(w),
+                    }
+                    for tier, w in ((t, list(self.waits[t])) for t in JOB_TIERS)
+                },
+            }
+
+def _local_job_runners(**fns) -> dict:
+    """In-process backend: runners that call `fns[kind](**job.kwargs)` directly (no Modal needed)."""
+    return {kind: (lambda job, fn=fn: fn(**job.kwargs)) for kind, fn in fns.items()}
+
+# ───────────────────────── Worker Class ───────────────────────── #
+class SDXLLoRAHostBase:
+    """
+    The GPU worker's logic as a plain class: SDXLLoRAHost below only adds the
+    Modal container settings (Modal finds the enter/method hooks through the
+    MRO). Locally, e.g. in bench_offline.py, it is instantiated directly and
+    load_weights() / setup() are called by hand; subclasses override the
+    weight sources (_base_pipeline, _safety_model, ...).
+    """
+
+    # Without CUDA (a local run), keep weights on the CPU and move one model at a time
+    cpu_offload = True
+
+    # Modal rejects snap=True unless the class enables snapshots
+    @modal.enter(snap=ENABLE_MEMORY_SNAPSHOT)
+    def load_weights(self):
+        """
+        CPU stage: read weights from the volume into host memory, independent
+        components concurrently. Needs no GPU, so with ENABLE_MEMORY_SNAPSHOT it
+        is captured in the container snapshot and restored instead of re-run.
+        """
+        # Pipelines, scheduler swaps, FreeU and adapter state are shared; one GPU user at a time
+        self._gpu_lock = threading.RLock()
+        self._gpu_depth = 0
+        # _StageTraces of the requests running on the current thread (see _traced)
+        self._trace_local = threading.local()
+        # fp16 for SDXL on the GPU (a snapshot is taken without one, but always restores onto one)
+        self.dtype = torch.float16 if (torch.cuda.is_available() or ENABLE_MEMORY_SNAPSHOT) else torch.float32
+
+        # Run HF cache migration once (non-fatal if it fails)
+        try:
+            if not os.path.exists("/cache/.hf_migrated"):
+                move_cache()
+                Path("/cache/.hf_migrated").touch()
+        except Exception:
+            pass
+
+        self.pipes = _PipelineRegistry()
+        self.loader = _StagedLoader()
+        self.loader.add("base", self._load_base)
+        self.loader.add("safety", self._load_safety)
+        self.loader.add("inpaint_weights", self._load_inpaint_weights)
+        self.loader.add("inpaint", self._init_inpaint, after=("base", "inpaint_weights"))
+
+        # A snapshot restores host memory for free, so then even lazy inpaint weights are read here
+        eager = ["base", "safety"]
+        if ENABLE_MEMORY_SNAPSHOT or "inpaint" not in LAZY_COMPONENTS:
+            eager.append("inpaint_weights")
+        t0 = time.perf_counter()
+        for name in eager:
+            self.loader.start(name)
+        for name in eager:
+            self.loader.require(name)
+        # wall-clock per stage; pipes.load_s holds the (overlapping) per-component times
+        self.stage_s = {"cpu": round(time.perf_counter() - t0, 3)}
+
+    # Weight sources. bench_offline.py overrides these (and _inpaint_pipeline /
+    # _attach_ip_adapter) with tiny random models; everything else is shared.
+    def _base_pipeline(self):
+        return StableDiffusionXLPipeline.from_pretrained(BASE_MODEL, torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH)
+
+    def _safety_model(self):
+        return StableDiffusionSafetyChecker.from_pretrained(SAFETY_REPO, cache_dir=HF_CACHE_PATH)
+
+    def _inpaint_weights(self) -> dict:
+        # The inpainting checkpoint's own UNet and VAE; its text encoders come from the base
+        return {
+            "unet": UNet2DConditionModel.from_pretrained(
+                INPAINT_MODEL, subfolder="unet", torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH
+            ),
+            "vae": AutoencoderKL.from_pretrained(
+                INPAINT_MODEL, subfolder="vae", torch_dtype=self.dtype, cache_dir=HF_CACHE_PATH
+            ),
+        }
+
+    def _load_base(self):
+        # One SDXL base (UNet, VAE, both text encoders) backs t2i and i2i
+        t0 = time.perf_counter()
+        self.t2i = self.pipes.register("t2i", self._base_pipeline(), time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        self.i2i = self.pipes.register("i2i", StableDiffusionXLImg2ImgPipeline(
+            **self.pipes.components_of("t2i")
+        ), time.perf_counter() - t0)
+
+    def _load_safety(self):
+        # CLIP preprocessing for it runs on the GPU (_clip_preprocess), no image processor needed
+        t0 = time.perf_counter()
+        self.safety_checker = self._safety_model()
+        self.pipes.record("safety", time.perf_counter() - t0)
+
+    def _load_inpaint_weights(self):
+        t0 = time.perf_counter()
+        self._inpaint_parts = self._inpaint_weights()
+        self.pipes.record("inpaint_weights", time.perf_counter() - t0)
+
+    def _prepare_pipe(self, pipe):
+        pipe.to(self.device)
+        #pipe.set_progress_bar_config(disable=True) #optional silence progress to save a few ms
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        pipe.enable_vae_slicing()
+        pipe.enable_vae_tiling()
+        if self.device != "cuda" and self.cpu_offload:
+            pipe.enable_model_cpu_offload()
+
+    @modal.enter(snap=False)
+    def setup(self):
+        """GPU stage: move weights to the GPU, build adapter pool, caches and pools, warm t2i/i2i."""
+        t_stage = time.perf_counter()
+        torch.backends.cuda.matmul.allow_tf32 = True
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        t0 = time.perf_counter()
+        for p in (self.t2i, self.i2i):
+            self._prepare_pipe(p)
+        self.safety_checker.to(self.device)
+        self.pipes.record("to_gpu", time.perf_counter() - t0)
+
+        # Requests run on per-call schedulers with precomputed timestep/sigma tables;
+        # the pipelines' own schedulers and FreeU state are never changed per request
+        self.recipes = _SchedulerRecipes()
+        for name, pipe in (("t2i", self.t2i), ("i2i", self.i2i)):
+            self.recipes.register(name, pipe.scheduler.config)
+            self.recipes.warm(name, SCHEDULER_RECIPE_STEPS, karras=True)
+
+        # Inpaint (+ IP-Adapter) is built by the "inpaint" loader component; None until then
+        self.inpaint = None
+
+        # Track currently active style per pipeline
+        self._active_style = {"t2i": None, "i2i": None, "inpaint": None}
+
+        # Inject every style once as a named adapter; t2i patches the UNet and
+        # text encoders it shares with i2i/inpaint, inpaint (added when loaded) only its own UNet.
+        t0 = time.perf_counter()
+        self.loras = _LoRAPool([(self.t2i, True)], max_resident=MAX_RESIDENT_LORAS, fuse_after=LORA_FUSE_AFTER)
+        self.loras.preload(list(LORAS)[:MAX_RESIDENT_LORAS])
+        self.pipes.record("loras", time.perf_counter() - t0)
+        self.active_adapter = "none"
+
+        # UNet/VAE memory format (and optional compile) once the adapters are injected
+        t0 = time.perf_counter()
+        self._optimize_modules(UNET_OPTIMIZE, (self.t2i, self.i2i))
+        self.pipes.record("optimize", time.perf_counter() - t0)
+
+        # (text encoders + LoRA state, prompt, negative) -> SDXL prompt embeds on the GPU
+        self.prompt_cache = _LRUCache(max_bytes=PROMPT_CACHE_MB * 2**20, sizeof=_tensor_bytes)
+        # content hash / character_id -> (prepared ref image, IP-Adapter embeds incl. CFG negative)
+        self.ref_cache = _LRUCache(max_items=REF_CACHE_SIZE)
+        # blob id -> uploaded bytes; (inputs' content hashes, size) -> prepared PIL canvas(es)
+        self.blob_cache = _LRUCache(max_bytes=BLOB_LOCAL_CACHE_MB * 2**20, sizeof=len)
+        self.canvas_cache = _LRUCache(max_items=CANVAS_CACHE_SIZE)
+        # (VAE, image content, size) -> (scaled latents on the GPU, encode ms)
+        self.latent_cache = _LRUCache(max_bytes=LATENT_CACHE_MB * 2**20, sizeof=_tensor_bytes)
+        self.latent_ms_saved = 0.0
+        # request hash -> (encoded image, safety) on the results volume
+        self._last_commit = 0.0
+        self._commit_lock = threading.Lock()
+        self._commit_timer = None   # pending deferred commit, if any
+        self.results = (
+            _ResultStore(RESULTS_PATH, RESULT_CACHE_MB * 2**20, on_write=self._commit_results, on_reload=self._reload_results)
+            if RESULT_CACHE_MB > 0 else None
+        )
+
+        # (stage, ms) samples for recent stages; per-request traces feed the /metrics histograms
+        self.timings = deque(maxlen=4096)
+        self.metrics = _StageMetrics()
+        self.instance = os.environ.get("MODAL_TASK_ID") or uuid.uuid4().hex[:12]
+        self.metrics_publisher = (
+            _MetricsPublisher(self.metrics, self.instance, METRICS_PUBLISH_INTERVAL_S)
+            if METRICS_PUBLISH_INTERVAL_S > 0 else None
+        )
+        # kind -> observed VRAM MB per image per megapixel, for num_candidates caps
+        self.candidate_mb_per_mp = {}
+        # id(unet) -> _DeepCache, installed on first cache_interval > 1 request
+        self.deepcaches = {}
+
+        # Candidate and book-page encodes run off the request thread; (format, ms, bytes) per encode
+        self.encode_pool = ThreadPoolExecutor(max_workers=max(2, HOST_MAX_INPUTS), thread_name_prefix="encode")
+        self.encode_log = deque(maxlen=2048)
+        # progress_id -> preview pushes still on encode_pool (see _flush_previews)
+        self._previews = {}
+        self._previews_lock = threading.Lock()
+
+        self.t2i_batcher = None
+        if T2I_BATCH_WINDOW_MS > 0:
+            self.t2i_batcher = _MicroBatcher(self._run_t2i, T2I_BATCH_WINDOW_MS, T2I_MAX_BATCH)
+
+        # ─────────────── Warm every resolution bucket ─────────────── #
+        self.warmup = _WarmupManager(WARMUP_BUCKETS)
+        t0 = time.perf_counter()
+        self._warm_buckets(("t2i", "i2i"))
+        self.pipes.record("warmup", time.perf_counter() - t0)
+        self.stage_s["gpu"] = round(time.perf_counter() - t_stage, 3)
+
+        # Lazy components: load in the background while t2i/i2i already serve
+        # (LAZY_PREFETCH), or on first use; callers wait in loader.require().
+        for name in LAZY_COMPONENTS:
+            if LAZY_PREFETCH:
+                self.loader.start(name)
+            else:
+                print(f"[startup] {name} deferred to first use")
+        if "inpaint" not in LAZY_COMPONENTS:
+            self.loader.require("inpaint")
+        print("Model memory:", self._memory_report())
+        print("Warmup:", self.warmup.report())
+        print("Startup:", self._readiness())
+
+    def _init_inpaint(self):
+        """Build the inpaint pipeline on the GPU, attach the IP-Adapter and styles, warm its buckets."""
+        t0 = time.perf_counter()
+        inpaint = self._inpaint_pipeline()
+        self._prepare_pipe(inpaint)
+        self.pipes.register("inpaint", inpaint, time.perf_counter() - t0)
+        self.recipes.register("inpaint", inpaint.scheduler.config)
+        self.recipes.warm("inpaint", SCHEDULER_RECIPE_STEPS)
+
+        t0 = time.perf_counter()
+        self._attach_ip_adapter(inpaint)
+        self.pipes.record("ip_adapter", time.perf_counter() - t0)
+        try:
+            inpaint.set_ip_adapter_scale(1.0)
+        except Exception:
+            pass
+
+        # adapter state and warmup runs touch the shared text encoders: hold the GPU lock
+        with self._gpu_lock:
+            t0 = time.perf_counter()
+            self.loras.add_target(inpaint, patch_text_encoders=False)
+            self._optimize_modules(UNET_OPTIMIZE, (inpaint,))
+            self.inpaint = inpaint
+            self._warm_buckets(("inpaint",))
+            self.pipes.record("inpaint_ready", time.perf_counter() - t0)
+
+    def _inpaint_pipeline(self):
+        return StableDiffusionXLInpaintPipeline.from_pretrained(
+            INPAINT_MODEL,
+            torch_dtype=self.dtype,
+            cache_dir=HF_CACHE_PATH,
+            **self._inpaint_parts,
+            **self.pipes.components_of("t2i", INPAINT_SHARED_COMPONENTS),
+        )
+
+    def _attach_ip_adapter(self, pipe):
+        # One-time IP-Adapter attach; pick ONE and never swap.
+        pipe.load_ip_adapter(
+            IPADAPTER_REPO,
+            subfolder=IPADAPTER_SUBFOLDER,
+            weight_name="ip-adapter_sdxl.safetensors",
+        )
+
+    def _readiness(self) -> dict:
+        return {"stages_s": dict(self.stage_s), "load_s": self.pipes.load_times(), "components": self.loader.report()}
+
+    @modal.method()
+    def readiness(self) -> dict:
+        """
+        Startup breakdown: wall-clock CPU/GPU stage seconds, per-component load
+        seconds, and per loader component its state (lazy / loading / ready /
+        failed), start offset, load and first-use wait seconds.
+        """
+        return self._readiness()
+
+    def _optimize_modules(self, mode: str, pipes: tuple):
+        """channels_last for every distinct UNet/VAE; "compile" also torch.compiles each distinct UNet."""
+        if mode in (None, "none"):
+            return
+        seen = set()
+        for module in [m for pipe in pipes for m in (pipe.unet, pipe.vae)]:
+            if id(module) not in seen:
+                seen.add(id(module))
+                module.to(memory_format=torch.channels_last)
+        if mode == "compile":
+            compiled = {}
+            for pipe in pipes:
+                if id(pipe.unet) not in compiled:
+                    compiled[id(pipe.unet)] = torch.compile(pipe.unet, mode="max-autotune-no-cudagraphs", dynamic=False)
+                pipe.unet = compiled[id(pipe.unet)]
+
+    def _warm_buckets(self, kinds: tuple):
+        """One short CFG run per bucket and pipeline: kernel selection, allocations and compiles happen here."""
+        gray = lambda w, h: Image.new("RGB", (w, h), color=(128, 128, 128))
+
+        def _synced(fn):
+            def run(w, h):
+                with torch.inference_mode():
+                    fn(w, h)
+                self._sync()
+            return run
+
+        if "t2i" in kinds:
+            self.warmup.warm("t2i", _synced(lambda w, h: self.t2i(
+                prompt="warmup", width=w, height=h, num_inference_steps=WARMUP_STEPS,
+                guidance_scale=5.0, output_type="pt",
+            )))
+        if "i2i" in kinds:
+            self.warmup.warm("i2i", _synced(lambda w, h: self.i2i(
+                prompt="warmup", image=gray(w, h), strength=0.5, num_inference_steps=2 * WARMUP_STEPS,
+                guidance_scale=5.0, output_type="pt",
+            )))
+        if "inpaint" in kinds:
+            self.warmup.warm("inpaint", _synced(lambda w, h: self.inpaint(
+                prompt="warmup", image=gray(w, h), mask_image=Image.new("L", (w, h), color=255),
+                ip_adapter_image=gray(512, 512), width=w, height=h, num_inference_steps=WARMUP_STEPS,
+                guidance_scale=5.0, output_type="pt",
+            )))
+
+    @modal.method()
+    def bucket_stats(self) -> dict:
+        """Per (pipeline, bucket): warmup ms at start, first-request ms and steady-state denoise p50/p95."""
+        return self.warmup.report()
+
+
+    def _memory_report(self) -> dict:
+        return self.pipes.report(extra={"safety_checker": self.safety_checker})
+
+    @modal.method()
+    def memory_report(self) -> dict:
+        """Per-pipeline load time plus unshared vs. resident weight size and CUDA usage."""
+        return self._memory_report()
+
+    # ─────────────── LoRA adapter switching (resident adapter pool) ─────────────── #
+
+    def _set_adapter(self, adapter: str, scale: float = 1.0):
+        # keep all three pipelines in sync; i2i wraps the t2i UNet and text
+        # encoders, so the pool only has to patch t2i and the inpaint UNet.
+        name = _adapter_name(adapter)
+        with self._stage("adapter"):
+            switched = self.loras.activate(name, float(scale))
+        # a batch shares one switch: count it once, against its first request
+        for trace in self._active_traces()[:1]:
+            trace.adapter_switches += int(switched)
+        for pipe_name in self._active_style:
+            self._active_style[pipe_name] = name
+        self.active_adapter = (adapter or "none").lower()
+
+    @_staged("text_encode", sync=True)
+    def _encode_prompt(self, pipe, prompt: str, negative_prompt: str | None) -> dict:
+        """
+        SDXL prompt embeddings (both text encoders, with CFG negatives) as pipeline
+        kwargs, memoized per text-encoder identity and active LoRA. Call after
+        _set_adapter: the LoRA also patches the text encoders.
+        """
+        zero_negative = negative_prompt is None and bool(getattr(pipe.config, "force_zeros_for_empty_prompt", False))
+        key = (
+            id(pipe.text_encoder), id(pipe.text_encoder_2), self.loras.active, self.loras.scale,
+            prompt, negative_prompt, zero_negative,
+        )
+        hit = self.prompt_cache.get(key)
+        if hit is None:
+            with torch.inference_mode():
+                pe, npe, ppe, nppe = pipe.encode_prompt(
+                    prompt=prompt,
+                    device=self.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=True,
+                    negative_prompt=negative_prompt,
+                )
+            hit = self.prompt_cache.put(key, {
+                "prompt_embeds": pe,
+                "negative_prompt_embeds": npe,
+                "pooled_prompt_embeds": ppe,
+                "negative_pooled_prompt_embeds": nppe,
+            })
+        return hit
+
+    @modal.method()
+    def adapter_stats(self) -> dict:
+        """Resident/host-cached styles and per-switch latency (ms) by kind: set, load, off."""
+        return self.loras.stats()
+
+    def _sync(self):
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+
+    def _active_traces(self) -> tuple:
+        return getattr(self._trace_local, "traces", ())
+
+    def _record(self, stage: str, ms: float, traces: tuple | None = None):
+        """One stage sample: the recent window, the running requests' traces, or kind "other" outside any."""
+        self.timings.append((stage, ms))
+        traces = self._active_traces() if traces is None else traces
+        for trace in traces:
+            trace.add(stage, ms)
+        if not traces:
+            self.metrics.observe("other", stage, ms)
+
+    @contextmanager
+    def _stage(self, stage: str, sync: bool = False, traces: tuple | None = None):
+        """Time the block as `stage`; sync brackets it with CUDA syncs so its queued GPU work counts too."""
+        if sync:
+            self._sync()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync:
+                self._sync()
+            self._record(stage, (time.perf_counter() - t0) * 1000.0, traces)
+
+    @contextmanager
+    def _gpu_section(self):
+        """The GPU lock; its outermost holder also reports peak VRAM to the running requests' traces."""
+        with self._gpu_lock:
+            outer = self._gpu_depth == 0
+            self._gpu_depth += 1
+            if outer and self.device == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+            try:
+                yield
+            finally:
+                self._gpu_depth -= 1
+                if outer and self.device == "cuda":
+                    peak = torch.cuda.max_memory_allocated() / 2**20
+                    for trace in self._active_traces():
+                        trace.peak(peak)
+
+    def _safety_check(self, images) -> list:
+        """
+        NSFW flags for a (B, 3, H, W) [0, 1] batch (or PIL images), with CLIP
+        preprocessing on the GPU. One safety_checker pass for the whole batch.
+        """
+        self._sync()
+        t0 = time.perf_counter()
+        if not isinstance(images, torch.Tensor):
+            images = torch.cat([_pil_to_tensor(img.convert("RGB"), self.device) for img in images])
+        with torch.inference_mode():
+            clip_input = _clip_preprocess(images.to(self.device)).to(self.safety_checker.dtype)
+            # flags only: the blackout forward_onnx applies lands on the discarded CLIP input
+            _, has_nsfw_concepts = self.safety_checker.forward_onnx(clip_input=clip_input, images=clip_input)
+        flags = [bool(f) for f in has_nsfw_concepts.tolist()]
+        ms = (time.perf_counter() - t0) * 1000.0
+        self._record("safety", ms)
+        return [{"flagged": f, "safety_ms": round(ms, 2)} for f in flags]
+
+    def _preview_callback(self, progress: list):
+        """
+        callback_on_step_end that sends a latent preview of batch item i to
+        progress[i] = (progress_id, every) every `every` steps (None: no one
+        listening). Returns None when no item wants previews.
+        """
+        if not any(progress):
+            return None
+        every = {i: max(1, int(p[1])) for i, p in enumerate(progress) if p}
+
+        def _callback(pipe, step, timestep, callback_kwargs):
+            done, total = step + 1, pipe.num_timesteps
+            due = [i for i, n in every.items() if done % n == 0 and done < total]
+            if due:
+                t0 = time.perf_counter()
+                rgb = _latents_to_rgb(callback_kwargs["latents"][due])
+                for row, i in enumerate(due):
+                    fut = self.encode_pool.submit(self._push_preview, progress[i][0], done, total, rgb[row])
+                    with self._previews_lock:
+                        self._previews.setdefault(progress[i][0], []).append(fut)
+                ms = (time.perf_counter() - t0) * 1000.0
+                self._record("preview", ms)
+                for i in due:
+                    if ms / every[i] > PREVIEW_STEP_BUDGET_MS:
+                        every[i] *= 2
+            return callback_kwargs
+        return _callback
+
+    def _flush_previews(self, progress_id: str | None):
+        """Wait for progress_id's queued preview pushes, so none lands in its partition after the result."""
+        if not progress_id:
+            return
+        with self._previews_lock:
+            pending = self._previews.pop(progress_id, [])
+        for fut in pending:
+            fut.result()   # _push_preview reports its own failures
+
+    def _push_preview(self, progress_id: str, step: int, total: int, rgb):
+        buf = io.BytesIO()
+        Image.fromarray(rgb.numpy()).save(buf, format="JPEG", quality=70)
+        try:
+            progress_queue.put(
+                {"step": step, "steps": total, "preview": buf.getvalue()},
+                partition=progress_id, partition_ttl=PROGRESS_TTL_S,
+            )
+        except Exception as e:
+            print(f"[progress] preview for {progress_id} dropped: {e}")
+
+    def _vae_latents(self, pipe, pixels_fn, key: tuple):
+        """
+        Scaled VAE latents of pixels_fn() (a [-1, 1] image batch), cached per
+        (VAE, key). The latent distribution's mode is used instead of a sample,
+        so a hit gives the same latents as a fresh encode. Hits add the encode
+        time they skipped to latent_ms_saved.
+        """
+        key = (id(pipe.vae),) + tuple(key)
+        hit = self.latent_cache.get(key)
+        if hit is not None:
+            self.latent_ms_saved += hit[1]
+            return hit[0]
+
+        vae = pipe.vae
+        self._sync()
+        t0 = time.perf_counter()
+        with torch.inference_mode():
+            pixels = pixels_fn()
+            # the SDXL VAE overflows in fp16; encode in fp32 like the pipelines do
+            upcast = vae.dtype == torch.float16 and vae.config.force_upcast
+            if upcast:
+                vae.to(dtype=torch.float32)
+            try:
+                latents = vae.encode(pixels.to(self.device, dtype=vae.dtype)).latent_dist.mode()
+            finally:
+                if upcast:
+                    vae.to(dtype=torch.float16)
+            latents = (latents * vae.config.scaling_factor).to(self.dtype)
+        self._sync()
+        ms = (time.perf_counter() - t0) * 1000.0
+        self._record("vae_encode", ms)
+        return self.latent_cache.put(key, (latents, ms))[0]
+
+    def _inpaint_latent_kwargs(self, image, mask, width: int, height: int) -> dict:
+        """
+        image / masked_image_latents for the inpaint pipeline from the latent
+        cache. The pipeline skips its own VAE encodes when handed 4-channel
+        latents. Re-rolls and re-styles of a page reuse the same background and mask.
+        """
+        pipe = self.inpaint
+        image_key, mask_key = _content_hash(image.tobytes()), _content_hash(mask.tobytes())
+        pixels = lambda: pipe.image_processor.preprocess(image, height=height, width=width)
+
+        def masked_pixels():
+            m = pipe.mask_processor.preprocess(mask, height=height, width=width)
+            return pixels() * (m < 0.5)
+
+        return {
+            "image": self._vae_latents(pipe, pixels, ("image", image_key, width, height)),
+            "masked_image_latents": self._vae_latents(pipe, masked_pixels, ("masked", image_key, mask_key, width, height)),
+            "width": width,
+            "height": height,
+        }
+
+    def _timed_denoise(self, fn, bucket: tuple | None = None):
+        """
+        fn() under inference_mode, timed as denoise + vae_decode; bucket =
+        (pipeline, (w, h)) also feeds the per-bucket latency report. The split
+        is where the VAE decode first reaches post_quant_conv.
+        """
+        decode_t0 = []
+
+        def _mark(module, args):
+            if not decode_t0:
+                self._sync()
+                decode_t0.append(time.perf_counter())
+
+        vaes = {id(p.vae): p.vae for p in self.pipes.values()}.values()
+        hooks = [v.post_quant_conv.register_forward_pre_hook(_mark) for v in vaes if getattr(v, "post_quant_conv", None) is not None]
+        self._sync()
+        t0 = time.perf_counter()
+        try:
+            with torch.inference_mode():
+                out = fn()
+            self._sync()
+        finally:
+            for h in hooks:
+                h.remove()
+        t1 = time.perf_counter()
+        split = decode_t0[0] if decode_t0 else t1
+        self._record("denoise", (split - t0) * 1000.0)
+        if decode_t0:
+            self._record("vae_decode", (t1 - split) * 1000.0)
+        if bucket is not None:
+            self.warmup.record(*bucket, (t1 - t0) * 1000.0)
+        return out
+
+    @modal.method()
+    def stage_stats(self) -> dict:
+        """p50/p95 ms per stage (text_encode, denoise, vae_decode, safety, encode, ...) over recent requests."""
+        by_stage = {}
+        for stage, ms in list(self.timings):
+            by_stage.setdefault(stage, []).append(ms)
+        return {
+            stage: {"count": len(v), "ms_p50": round(_percentile(v, 0.5), 2), "ms_p95": round(_percentile(v, 0.95), 2)}
+            for stage, v in by_stage.items()
+        }
+
+    @modal.method()
+    def metrics_text(self) -> str:
+        """This container's stage / request / peak-VRAM histograms and adapter switches, Prometheus text format."""
+        return self.metrics.render(instance=self.instance)
+
+    def _encode_now(self, img, output_format: str = "png", quality: int | None = None, traces: tuple | None = None) -> bytes:
+        """
+        Encode on this thread. Single-image handlers call it after leaving the
+        GPU section, so another input's denoise already overlaps it.
+        """
+        t0 = time.perf_counter()
+        data = _encode_image(img, output_format, quality)
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.encode_log.append((output_format, ms, len(data)))
+        self._record("encode", ms, traces)
+        return data
+
+    def _encode(self, img, output_format: str = "png", quality: int | None = None) -> Future:
+        """_encode_now on encode_pool: for encodes in parallel (candidates) or behind this thread's next denoise (generate_book)."""
+        return self.encode_pool.submit(self._encode_now, img, output_format, quality, self._active_traces())
+
+    def _generator(self, seed):
+        """A seeded torch.Generator (None when unseeded), or one per seed for a list."""
+        if isinstance(seed, (list, tuple)):
+            return [torch.Generator(device=self.device).manual_seed(int(s)) for s in seed]
+        if seed is None:
+            return None
+        return torch.Generator(device=self.device).manual_seed(int(seed))
+
+    def _feature_cache(self, pipe, interval: int):
+        """DeepCache session on pipe's UNet for one call; a no-op at interval 1 or on a compiled UNet."""
+        unet = pipe.unet
+        if int(interval or 1) <= 1 or hasattr(unet, "_orig_mod"):
+            return nullcontext()
+        cache = self.deepcaches.get(id(unet))
+        if cache is None:
+            cache = self.deepcaches[id(unet)] = _DeepCache(unet)
+        return cache.session(interval)
+
+    def _candidate_cap(self, kind: str, width: int, height: int) -> int:
+        """How many width x height images of `kind` one denoise batch can take with the VRAM free now."""
+        if self.device != "cuda":
+            return MAX_CANDIDATES
+        free, _ = torch.cuda.mem_get_info()
+        free += torch.cuda.memory_reserved() - torch.cuda.memory_allocated()   # cached by torch, reusable
+        per_image = self.candidate_mb_per_mp.get(kind, CANDIDATE_VRAM_MB_PER_MP) * width * height / 2**20
+        return max(1, min(MAX_CANDIDATES, int(free / 2**20 * CANDIDATE_VRAM_HEADROOM // max(per_image, 1.0))))
+
+    def _candidate_seeds(self, kind: str, seed, num_candidates: int, width: int, height: int) -> list:
+        """seed, seed + 1, ... (from a random base when unseeded), as many as requested and VRAM allows."""
+        n = min(int(num_candidates), self._candidate_cap(kind, int(width), int(height)))
+        base = int(seed) if seed is not None else random.randrange(2**31)
+        return [base + i for i in range(max(1, n))]
+
+    @contextmanager
+    def _candidate_vram(self, kind: str, batch: int, width: int, height: int):
+        """Learn MB per image per megapixel for _candidate_cap from the allocation peak of a denoise batch."""
+        if self.device != "cuda":
+            yield
+            return
+        before = torch.cuda.memory_allocated()
+        yield
+        # the peak counter is reset per GPU section, so this can only overestimate
+        mb = (torch.cuda.max_memory_allocated() - before) / 2**20
+        per_mp = mb / max(1, int(batch)) / (int(width) * int(height) / 2**20)
+        self.candidate_mb_per_mp[kind] = max(per_mp, self.candidate_mb_per_mp.get(kind, 0.0))
+
+    def _candidates(self, images: list, safety: list, seeds: list, requested: int, output_format: str, output_quality: int | None) -> tuple:
+        """
+        (encoded images, summary) for a num_candidates call. The summary is
+        flagged if any candidate is and lists each candidate's seed and flags
+        under "candidates", in image order; `requested` is kept next to the
+        count actually run (lower when VRAM capped the batch).
+        """
+        summary = {
+            "flagged": any(s["flagged"] for s in safety),
+            "requested_candidates": int(requested),
+            "num_candidates": len(images),
+            "candidates": [dict(s, seed=seed) for s, seed in zip(safety, seeds)],
+        }
+        return [self._encode(img, output_format, output_quality) for img in images], summary
+
+    @modal.method()
+    def encode_stats(self) -> dict:
+        """Per output format: encode count, p50/p95 encode ms and mean size in bytes."""
+        by_fmt = {}
+        for fmt, ms, size in list(self.encode_log):
+            by_fmt.setdefault(fmt, ([], []))
+            by_fmt[fmt][0].append(ms)
+            by_fmt[fmt][1].append(size)
+        return {
+            fmt: {
+                "count": len(ms),
+                "ms_p50": round(_percentile(ms, 0.5), 2),
+                "ms_p95": round(_percentile(ms, 0.95), 2),
+                "mean_bytes": int(sum(sizes) / len(sizes)),
+            }
+            for fmt, (ms, sizes) in by_fmt.items()
+        }
+
+    def _commit_results(self):
+        # make new result files visible to other containers: at most one commit per
+        # RESULT_COMMIT_INTERVAL_S, but a write inside the window is deferred, not dropped
+        with self._commit_lock:
+            if self._commit_timer is not None:
+                return   # the scheduled commit will include this write
+            delay = max(0.0, RESULT_COMMIT_INTERVAL_S - (time.monotonic() - self._last_commit))
+            self._commit_timer = threading.Timer(delay, self._flush_results)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def _flush_results(self):
+        with self._commit_lock:
+            self._commit_timer = None
+            self._last_commit = time.monotonic()
+        try:
+            results_volume.commit()
+        except Exception as e:
+            print(f"[results] volume commit failed: {e}")
+
+    def _reload_results(self):
+        # see result files other containers committed (_ResultStore rate-limits the calls)
+        try:
+            results_volume.reload()
+        except Exception as e:
+            print(f"[results] volume reload failed: {e}")
+
+    @modal.exit()
+    def teardown(self):
+        if self.metrics_publisher is not None:
+            self.metrics_publisher.close()
+        if self.results is not None:
+            with self._commit_lock:
+                pending, self._commit_timer = self._commit_timer, None
+            if pending is not None:
+                pending.cancel()
+                self._flush_results()
+
+    @modal.method()
+    def cache_stats(self) -> dict:
+        """Hit/miss/eviction counters and size of the per-container caches."""
+        return {
+            "prompt_embeds": self.prompt_cache.stats(),
+            "ref_embeds": self.ref_cache.stats(),
+            "blobs": self.blob_cache.stats(),
+            "canvases": self.canvas_cache.stats(),
+            "latents": dict(self.latent_cache.stats(), encode_ms_saved=round(self.latent_ms_saved, 1)),
+            "scheduler_recipes": self.recipes.stats(),
+            "deepcache": {
+                name: sum(cache.stats()[name] for cache in self.deepcaches.values())
+                for name in ("full_calls", "shallow_calls")
+            },
+            "results": self.results.stats() if self.results is not None else {},
+        }
+
+    # ─────────────── Text → Image ─────────────── #
+    def _run_t2i(self, key: tuple, jobs: list) -> list:
+        """
+        One denoise (and one safety pass) for every (prompt, negative_prompt, seed,
+        progress, traces) job sharing `key`; returns (image, safety) per job. Each job gets its own
+        generator, so its initial latents are exactly the ones it would get alone
+        under the same seed. Stages are timed into every job's traces.
+        """
+        outer = self._active_traces()
+        self._trace_local.traces = tuple(trace for job in jobs for trace in job[4])
+        try:
+            return self._run_t2i_batch(key, jobs)
+        finally:
+            self._trace_local.traces = outer
+
+    def _run_t2i_batch(self, key: tuple, jobs: list) -> list:
+        adapter, adapter_scale, width, height, steps, guidance_scale, use_freeu, cache_interval = key
+        with self._gpu_section():
+            self._set_adapter(adapter, scale=adapter_scale)
+            encoded = [self._encode_prompt(self.t2i, p, n) for p, n, *_ in jobs]
+            embeds = {k: torch.cat([e[k] for e in encoded]) for k in encoded[0]}
+
+            # DPM++ 2M with Karras sigmas, on a per-call scheduler from the recipe cache
+            with self._stage("scheduler"):
+                pipe = _pipe_view(self.t2i, self.recipes.scheduler("t2i", steps, karras=True))
+
+            generators = []
+            for _, _, seed, *_ in jobs:
+                g = torch.Generator(device=self.device)
+                if seed is not None:
+                    g.manual_seed(int(seed))
+                else:
+                    g.seed()
+                generators.append(g)
+
+            # Optional FreeU, for this call only
+            with _freeu(self.t2i, use_freeu), self._feature_cache(self.t2i, cache_interval):
+                with self._candidate_vram("t2i", len(jobs), width, height):
+                    images = self._timed_denoise(lambda: pipe(
+                        **embeds,
+                        width=int(width),
+                        height=int(height),
+                        num_inference_steps=int(steps),
+                        guidance_scale=float(guidance_scale),
+                        generator=generators,
+                        output_type="pt",
+                        callback_on_step_end=self._preview_callback([job[3] for job in jobs]),
+                    ).images, bucket=("t2i", (int(width), int(height))))
+            safety = self._safety_check(images)
+        return list(zip(_tensor_to_pil(images), safety))
+
+    @modal.method()
+    @_traced("t2i")
+    @_result_cached("t2i")
+    def generate_t2i(
+        self,
+        prompt: str,
+        width: int = 1024,
+        height: int = 1024,
+        steps: int = 30,
+        guidance_scale: float = 4.5,
+        seed=None,
+        adapter: str = "none",
+        negative_prompt: str | None = None,
+        adapter_scale: float | None = None,
+        use_freeu: bool = False,
+        output_format: str = "png",
+        output_quality: int | None = None,
+        progress_id: str | None = None,
+        preview_every: int = PREVIEW_EVERY,
+        num_candidates: int = 1,
+        cache_interval: int = 1,
+    ):
+        """
+        progress_id: push latent previews every `preview_every` steps to that progress_queue partition.
+        num_candidates > 1: one batched denoise over explicit seeds; see _candidates for the result.
+        cache_interval > 1: speed over quality, full UNet every cache_interval steps (see _DeepCache).
+        """
+        if not prompt:
+            raise ValueError("Missing 'prompt'.")
+        output_format = _output_format(output_format)
+
+        if adapter_scale is None:
+            adapter_scale = STYLE_HINTS.get(adapter, {}).get("default_scale", 1.0)
+        _adapter_name(adapter)
+
+        # Shrink prompts, then apply short style hints
+        prompt, negative_prompt = _styled_prompts(prompt, negative_prompt, adapter)
+
+        # Snap sizes to 64-multiples (SDXL friendly); denoise at a warmed bucket if one is close
+        width, height = _snap64(width), _snap64(height)
+        rw, rh = _render_size("t2i", width, height)
+        sizes = dict(size=[width, height], render_size=[rw, rh])
+
+        key = (
+            (adapter or "none").lower(), float(adapter_scale), int(rw), int(rh),
+            int(steps), float(guidance_scale), bool(use_freeu), int(cache_interval),
+        )
+        progress = (progress_id, preview_every) if progress_id else None
+        if int(num_candidates) > 1:
+            seeds = self._candidate_seeds("t2i", seed, num_candidates, rw, rh)
+            # previews follow the first candidate; the request's trace rides on it once
+            jobs = [
+                (prompt, negative_prompt, s, progress if i == 0 else None, self._active_traces() if i == 0 else ())
+                for i, s in enumerate(seeds)
+            ]
+            results = self._run_t2i(key, jobs)
+            self._flush_previews(progress_id)
+            images, summary = _resolve(self._candidates(
+                [_fit_output(image, width, height) for image, _ in results], [safety for _, safety in results], seeds,
+                num_candidates, output_format, output_quality,
+            ))
+            return images, dict(summary, **sizes)
+        job = (prompt, negative_prompt, seed, progress, self._active_traces())
+        if self.t2i_batcher is not None:
+            image, safety = self.t2i_batcher.submit(key, job).result()
+        else:
+            image, safety = self._run_t2i(key, [job])[0]
+        self._flush_previews(progress_id)
+        return self._encode_now(_fit_output(image, width, height), output_format, output_quality), dict(safety, **sizes)
+
+    @modal.method()
+    def batch_stats(self) -> dict:
+        """t2i micro-batching config and observed batch sizes (empty when disabled)."""
+        return self.t2i_batcher.stats() if self.t2i_batcher is not None else {}
+
+    @modal.method()
+    def benchmark_previews(self, prompt: str = "a fox in a forest, storybook illustration", steps: int = 30, preview_every: int = PREVIEW_EVERY, repeats: int = 3) -> dict:
+        """t2i latency with and without latent previews; per-step overhead vs PREVIEW_STEP_BUDGET_MS."""
+        key = ("none", 1.0, 1024, 1024, int(steps), 5.0, False, 1)
+        progress_id = f"bench-{uuid.uuid4().hex}"
+        report = {}
+        for name, progress in (("off", None), ("on", (progress_id, preview_every))):
+            times = []
+            for _ in range(max(1, int(repeats))):
+                t0 = time.perf_counter()
+                self._run_t2i(key, [(prompt, None, 0, progress, ())])
+                times.append((time.perf_counter() - t0) * 1000.0)
+            report[f"{name}_ms_p50"] = round(_percentile(times, 0.5), 1)
+        self._flush_previews(progress_id)
+        try:
+            progress_queue.clear(partition=progress_id)
+        except Exception:
+            pass
+        per_step = (report["on_ms_p50"] - report["off_ms_p50"]) / float(steps)
+        previews = [ms for stage, ms in list(self.timings) if stage == "preview"]
+        report.update(
+            preview_every=int(preview_every),
+            preview_ms_p50=round(_percentile(previews, 0.5), 2),
+            per_step_overhead_ms=round(per_step, 2),
+            budget_ms=PREVIEW_STEP_BUDGET_MS,
+            within_budget=per_step <= PREVIEW_STEP_BUDGET_MS,
+        )
+        return report
+
+    @modal.method()
+    def benchmark_lora_fuse(self, adapter: str = "anime", prompt: str = "a fox in a forest, storybook illustration", steps: int = 30, size: int = 1024, repeats: int = 3) -> dict:
+        """Seeded t2i with the style as a live adapter vs fused into the base weights: latency and pixel drift."""
+        key = (adapter, 1.0, int(size), int(size), int(steps), 5.0, False, 1)
+        fuse_after, report, images = self.loras.fuse_after, {}, {}
+        with self._gpu_lock:
+            try:
+                for name in ("unfused", "fused"):
+                    self.loras.fuse_after = 0
+                    self._set_adapter("none")   # drop any fused state and the stable count
+                    self._set_adapter(adapter)
+                    if name == "fused":
+                        self.loras.fuse()
+                    times = []
+                    for _ in range(max(1, int(repeats))):
+                        t0 = time.perf_counter()
+                        images[name] = self._run_t2i(key, [(prompt, None, 0, None, ())])[0][0]
+                        times.append((time.perf_counter() - t0) * 1000.0)
+                    report[f"{name}_ms_p50"] = round(_percentile(times, 0.5), 1)
+                    report[f"{name}_fused_layers"] = self.loras.stats()["fused_layers"]
+            finally:
+                self.loras.fuse_after = fuse_after
+                self._set_adapter("none")
+        diff = np.abs(np.asarray(images["fused"], dtype=np.float32) - np.asarray(images["unfused"], dtype=np.float32))
+        report.update(
+            adapter=adapter,
+            speedup=round(report["unfused_ms_p50"] / max(report["fused_ms_p50"], 1e-6), 3),
+            max_abs_diff=float(diff.max()),
+            mean_abs_diff=round(float(diff.mean()), 4),
+            tolerance=LORA_FUSE_TOLERANCE,
+            within_tolerance=float(diff.mean()) <= LORA_FUSE_TOLERANCE,
+        )
+        return report
+
+    @modal.method()
+    def benchmark_deepcache(self, intervals: tuple = (2, 3, 4), steps: int = 30, size: int = 1024, adapter: str = "none", prompts: tuple = DEEPCACHE_BENCH_PROMPTS) -> dict:
+        """
+        Seeded t2i over a fixed prompt set at each cache_interval vs the full
+        run (interval 1): latency, speedup and how far the images drift
+        (mean abs pixel diff, PSNR against the full run).
+        """
+        baseline, report = {}, {}
+        for interval in (1,) + tuple(int(i) for i in intervals):
+            key = (adapter, 1.0, int(size), int(size), int(steps), 5.0, False, interval)
+            times, diffs, psnrs = [], [], []
+            for seed, prompt in enumerate(prompts):
+                t0 = time.perf_counter()
+                image = self._run_t2i(key, [(prompt, None, seed, None, ())])[0][0]
+                times.append((time.perf_counter() - t0) * 1000.0)
+                px = np.asarray(image, dtype=np.float32)
+                if interval == 1:
+                    baseline[seed] = px
+                    continue
+                diff = px - baseline[seed]
+                mse = float((diff ** 2).mean())
+                diffs.append(float(np.abs(diff).mean()))
+                psnrs.append(10 * np.log10(255.0 ** 2 / max(mse, 1e-8)))
+            row = {"ms_p50": round(_percentile(times, 0.5), 1)}
+            if interval > 1:
+                row.update(
+                    speedup=round(report["1"]["ms_p50"] / max(row["ms_p50"], 1e-6), 3),
+                    mean_abs_diff=round(float(np.mean(diffs)), 3),
+                    psnr_db=round(float(np.mean(psnrs)), 2),
+                )
+            report[str(interval)] = row
+        return {"steps": int(steps), "size": int(size), "prompts": len(prompts), "intervals": report}
+
+    # ─────────────── Image → Image ─────────────── #
+    @modal.method()
+    @_traced("i2i")
+    @_result_cached("i2i")
+    def generate_i2i(
+        self,
+        prompt: str,
+        image_bytes: bytes | None = None,
+        strength: float = 0.35,                 # lower = preserve more of the init
+        steps: int = 32,                        # a bit more steps for i2i
+        guidance_scale: float = 6.5,            # SDXL i2i tends to like 5.5–7.5
+        seed=None,
+        out_size: int = 1024,
+        adapter: str = "none",
+        negative_prompt: str | None = "low quality, blurry, jpeg artifacts, extra fingers, extra limbs",
+        # Advanced (optional) knobs:
+        adapter_scale: float = 1.0,             # LoRA strength per-request
+        use_freeu: bool = True,                 # sharper textures, tiny overhead
+        guidance_rescale: float | None = 0.7,   # mitigates CFG artifacts
+        noise_offset: float | None = 0.02,      # combats desaturation/washed look
+        keep_aspect: bool = True,               # avoid squashing
+        output_format: str = "png",             # png | webp | webp_lossless | jpeg
+        output_quality: int | None = None,      # png compress level, else codec quality
+        image_id: str | None = None,            # uploaded blob instead of image_bytes
+        progress_id: str | None = None,         # progress_queue partition for latent previews
+        preview_every: int = PREVIEW_EVERY,
+        num_candidates: int = 1,                # >1: seeds seed, seed+1, ... in one batch
+        cache_interval: int = 1,                # >1: reuse deep UNet features between full steps (faster)
+    ):
+        if not prompt:
+            raise ValueError("Missing 'prompt'.")
+        if not (image_bytes or image_id):
+            raise ValueError("Missing 'image'/'image_id'.")
+        output_format = _output_format(output_format)
+        image_bytes = image_bytes or self._blob(image_id)
+
+        # Shrink prompts, then apply short style hints
+        prompt, negative_prompt = _styled_prompts(prompt, negative_prompt, adapter)
+
+        # --- preprocess init image safely (a no-op resize if the web function already did) ---
+        # CPU only: runs outside the GPU lock, overlapping other inputs' denoise
+        render = None
+        if out_size:
+            out_size = _snap64(out_size)
+            render = _render_size("i2i", out_size, out_size)[0]
+        key = ("i2i", _content_hash(image_bytes), render, bool(keep_aspect))
+        init = self.canvas_cache.get(key)
+        if init is None:
+            with self._stage("preprocess"):
+                init = self.canvas_cache.put(key, _prepare_init_image(image_bytes, render, keep_aspect=keep_aspect))
+        size = (out_size, out_size) if out_size else init.size
+
+        with self._gpu_section():
+            # single adapter, adjustable scale
+            self._set_adapter(adapter, scale=float(adapter_scale))
+
+            # the pipeline takes 4-channel latents as-is instead of VAE-encoding the init image
+            init_latents = self._vae_latents(self.i2i, lambda: self.i2i.image_processor.preprocess(init), key)
+
+            # --- scheduler: DPM++ 2M with Karras sigmas for i2i smoothness (per-call, cached tables) ---
+            with self._stage("scheduler"):
+                pipe = _pipe_view(self.i2i, self.recipes.scheduler("i2i", steps, karras=True))
+
+            # RNG (one generator per candidate)
+            seeds = None
+            if int(num_candidates) > 1:
+                seeds = self._candidate_seeds("i2i", seed, num_candidates, *init.size)
+            g = self._generator(seeds if seeds else seed)
+
+            # --- run ---
+            kwargs = dict(
+                **self._encode_prompt(self.i2i, prompt, negative_prompt),
+                image=init_latents,
+                strength=float(strength),
+                num_inference_steps=int(steps),
+                guidance_scale=float(guidance_scale),
+                num_images_per_prompt=len(seeds) if seeds else 1,
+                generator=g,
+                output_type="pt",
+                callback_on_step_end=self._preview_callback([(progress_id, preview_every) if progress_id else None]),
+            )
+            if guidance_rescale is not None:
+                kwargs["guidance_rescale"] = float(guidance_rescale)
+            if noise_offset is not None:
+                kwargs["noise_offset"] = float(noise_offset)
+
+            # FreeU can add crispness to textures with small cost; off again after this call
+            with _freeu(self.i2i, use_freeu), self._feature_cache(self.i2i, cache_interval):
+                with self._candidate_vram("i2i", len(seeds) if seeds else 1, *init.size):
+                    images = self._timed_denoise(lambda: pipe(**kwargs).images, bucket=("i2i", init.size))
+
+            # Safety (on the GPU tensor, before the host copy)
+            flags = self._safety_check(images)
+            out_imgs = [_fit_output(img, *size) for img in _tensor_to_pil(images)]
+
+        # encodes run off the GPU lock, so the next input can start denoising
+        self._flush_previews(progress_id)
+        sizes = dict(size=list(size), render_size=list(init.size))
+        if seeds:
+            images, summary = _resolve(self._candidates(out_imgs, flags, seeds, num_candidates, output_format, output_quality))
+            return images, dict(summary, **sizes)
+        safety = flags[0]
+        safety["explanation"] = "Heuristic safety signal from StableDiffusionSafetyChecker; may over/under-flag."
+        safety.update(sizes)
+        return self._encode_now(out_imgs[0], output_format, output_quality), safety
+
+    # ─────────────── Inpaint (reference-guided via IP-Adapter) ─────────────── #
+    @_staged("ref_embeds", sync=True)
+    def _ref_source(self, ref_image_bytes: bytes | None, character_id: str | None, ref_image_id: str | None = None) -> tuple:
+        """
+        (embed-cache key, load) for a reference, where load() returns the
+        prepared 512² image. The key is the content hash of inline bytes, else
+        the character_id or uploaded blob id, so it always names the image the
+        embeds come from. Inline refs from the web tier are _transport_ref PNGs
+        and register_character ids hash that same PNG, so the two share an entry.
+        On a cache miss the reference is fetched here: call this before taking
+        the GPU lock, since blob and character_refs lookups are network round-trips.
+        """
+        key = _content_hash(ref_image_bytes) if ref_image_bytes else (character_id or ref_image_id)
+
+        @functools.lru_cache(maxsize=1)
+        def load():
+            data = ref_image_bytes
+            if not data and ref_image_id and not character_id:
+                data = self._blob(ref_image_id)
+            if data:
+                # Normalize ref to 512x512 center-cropped square for IP-Adapter
+                return _prepare_ref_image(_open_rgb(data, target_short_side=512), target_size=512)
+            png = character_refs.get(character_id)
+            if png is None:
+                raise ValueError(f"Unknown character_id '{character_id}'. Register the reference first.")
+            return Image.open(io.BytesIO(png)).convert("RGB")
+
+        if key not in self.ref_cache:
+            load()
+        return key, load
+
+    def _ref_embeds(self, source: tuple, do_cfg: bool) -> list:
+        """
+        IP-Adapter image embeds for a _ref_source, computed once per key. Cached
+        entries hold [negative, positive] stacked along the batch dim, the
+        layout the pipeline expects under CFG.
+        """
+        key, load = source
+        hit = self.ref_cache.get(key)
+        if hit is None:
+            ref = load()   # already loaded by _ref_source unless evicted since
+            with torch.inference_mode():
+                embeds = self.inpaint.prepare_ip_adapter_image_embeds(
+                    ip_adapter_image=ref,
+                    ip_adapter_image_embeds=None,
+                    device=self.device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=True,
+                )
+            hit = self.ref_cache.put(key, (ref, embeds))
+        embeds = hit[1]
+        # without CFG the pipeline wants the positive half only
+        return embeds if do_cfg else [e.chunk(2)[1] for e in embeds]
+
+    @_staged("blob_fetch")
+    def _blob(self, blob_id: str) -> bytes:
+        """Bytes of an uploaded blob, fetched from the blob store once per container."""
+        data = self.blob_cache.get(blob_id)
+        if data is None:
+            data = blobs.get(blob_id)
+            if data is None:
+                raise ValueError(f"Unknown image id '{blob_id}'. Upload it first.")
+            self.blob_cache.put(blob_id, data)
+            try:
+                blob_meta[blob_id] = {"bytes": len(data), "last_used": time.time()}
+            except Exception:
+                pass
+        return data
+
+    @_staged("preprocess")
+    def _prep_inpaint_canvas(self, bg_image_bytes: bytes, mask_bytes: bytes, out_size: int | None, preprocessed: bool = False):
+        """
+        Decode background + mask, force the story canvas size and clean the mask
+        edge. preprocessed: the web function already did this (_preprocess_inpaint_inputs).
+        Cached by content, so a template background reused across pages decodes once.
+        """
+        key = ("inpaint", _content_hash(bg_image_bytes), _content_hash(mask_bytes), out_size, bool(preprocessed))
+        hit = self.canvas_cache.get(key)
+        if hit is not None:
+            return hit
+
+        bg = _open_rgb(bg_image_bytes, _snap64(out_size) if out_size else None)
+        mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
+        if not (preprocessed and mask.size == bg.size):
+            # Force deterministic canvas size (match your story template)
+            bg = _fit_canvas(bg, out_size)
+            mask = _clean_mask(mask, bg.size)
+        return self.canvas_cache.put(key, (bg, mask))
+
+    def _denoise_inpaint(self, bg, mask, cond: dict, steps: int, guidance_scale: float, seed, crop_to_mask: bool = False, callback=None, cache_interval: int = 1):
+        """
+        Run the inpaint pipeline on the full canvas, or (crop_to_mask) only on a
+        padded crop around the mask that is blended back into the untouched
+        background through the feathered mask. cond holds the prompt and
+        IP-Adapter embeds; callback is a callback_on_step_end (previews show
+        the crop when cropping). A list of seeds denoises one image per seed in
+        a single batch; cache_interval > 1 reuses deep UNet features between
+        full steps. Returns a (B, 3, H, W) [0, 1] tensor on the device.
+        """
+        g = self._generator(seed)
+        n = len(g) if isinstance(g, list) else 1
+        with self._stage("scheduler"):
+            pipe = _pipe_view(self.inpaint, self.recipes.scheduler("inpaint", steps))
+
+        box = _mask_crop_box(mask) if crop_to_mask else None
+        if box is not None:
+            cw, ch = box[2] - box[0], box[3] - box[1]
+            if cw * ch > MASK_CROP_MAX_FRACTION * bg.size[0] * bg.size[1]:
+                box = None
+
+        if box is None:
+            # denoise at the canvas aspect (a warmed bucket when one is close) and
+            # return bg.size, the same contract as the crop path below
+            tw, th = max(64, _snap64(bg.size[0])), max(64, _snap64(bg.size[1]))
+            if SNAP_TO_BUCKETS:
+                tw, th = self.warmup.nearest("inpaint", tw, th, strict=True)
+            latents = self._inpaint_latent_kwargs(bg, mask, tw, th)
+            with self._candidate_vram("inpaint", n, tw, th), self._feature_cache(pipe, cache_interval):
+                images = self._timed_denoise(lambda: pipe(
+                    **cond,
+                    **latents,
+                    mask_image=mask,
+                    num_inference_steps=int(steps),
+                    guidance_scale=float(guidance_scale),
+                    num_images_per_prompt=n,
+                    generator=g,
+                    output_type="pt",
+                    callback_on_step_end=callback,
+                ).images, bucket=("inpaint", (tw, th)))
+            return _resize_images(images, *bg.size)
+
+        bg_crop, mask_crop = bg.crop(box), mask.crop(box)
+        tw, th = max(64, _snap64(cw)), max(64, _snap64(ch))
+        if SNAP_TO_BUCKETS:
+            # the patch is resized back to (cw, ch) below, so any nearby warmed shape works
+            tw, th = self.warmup.nearest("inpaint", tw, th)
+        latents = self._inpaint_latent_kwargs(bg_crop, mask_crop, tw, th)
+        with self._candidate_vram("inpaint", n, tw, th), self._feature_cache(pipe, cache_interval):
+            patch = self._timed_denoise(lambda: pipe(
+                **cond,
+                **latents,
+                mask_image=mask_crop,
+                num_inference_steps=int(steps),
+                guidance_scale=float(guidance_scale),
+                num_images_per_prompt=n,
+                generator=g,
+                output_type="pt",
+                callback_on_step_end=callback,
+            ).images, bucket=("inpaint", (tw, th))).float()
+        patch = _resize_images(patch, cw, ch)
+        out = _pil_to_tensor(bg, self.device).repeat(n, 1, 1, 1)
+        m = _pil_to_tensor(mask_crop, self.device)
+        left, top, right, bottom = box
+        region = out[..., top:bottom, left:right]
+        out[..., top:bottom, left:right] = patch * m + region * (1.0 - m)
+        return out
+
+    @modal.method()
+    @_traced("inpaint")
+    @_result_cached("inpaint")
+    @_requires("inpaint")
+    def generate_inpaint_ref(
+        self,
+        prompt: str,
+        bg_image_bytes: bytes | None = None,
+        mask_bytes: bytes | None = None,
+        ref_image_bytes: bytes | None = None,
+        # Keep a tiny set of knobs; defaults chosen for stability on SDXL:
+        steps: int = 28,
+        guidance_scale: float = 5,
+        seed=None,
+        out_size: int = 1024,
+        adapter: str = "none",
+        adapter_scale: float = 1.0,
+        negative_prompt: str | None = None,
+        character_id: str | None = None,
+        crop_to_mask: bool = False,
+        preprocessed: bool = False,
+        output_format: str = "png",
+        output_quality: int | None = None,
+        bg_image_id: str | None = None,
+        mask_id: str | None = None,
+        ref_image_id: str | None = None,
+        progress_id: str | None = None,
+        preview_every: int = PREVIEW_EVERY,
+        num_candidates: int = 1,
+        cache_interval: int = 1,
     ):
         """
         Simple: Put the character (from ref_image) into the masked hole of the background.
@@ -532,204 +3327,1227 @@ class SDXLLoRAHost:
           - Style == LoRA adapter (story-level), applied once per call.
           - White = inpaint region, Black = keep.
           - Output is forced to 'out_size' longest side to match story canvas.
+          - The reference is either inline bytes or a character_id from register_character;
+            its IP-Adapter embeddings are cached per content hash / id.
+          - crop_to_mask denoises only a padded region around the mask; pixels outside
+            the feathered mask are the background's, untouched.
+          - preprocessed: background is canvas-sized and the mask already cleaned and
+            feathered by the caller (see _preprocess_inpaint_inputs).
+          - *_id: blob ids from /upload in place of the matching bytes.
+          - progress_id: latent previews every preview_every steps go to that
+            progress_queue partition (see /generate_stream).
+          - num_candidates > 1: seeds seed, seed+1, ... share one batched denoise
+            (same adapter, prompt and ref embeds); see _candidates for the result.
+          - cache_interval > 1: faster, approximate denoise that runs the full UNet
+            only every cache_interval steps (see _DeepCache).
         """
-        import io
-        import numpy as np
-        import torch
-    
         if not prompt:
             raise ValueError("Missing 'prompt'.")
-        if not bg_image_bytes or not mask_bytes or not ref_image_bytes:
-            raise ValueError("Missing 'image', 'mask', or 'ref_image'.")
-    
-        # 1) Decode inputs
-        bg = Image.open(io.BytesIO(bg_image_bytes)).convert("RGB")
-        mask = Image.open(io.BytesIO(mask_bytes)).convert("L")
-        ref = Image.open(io.BytesIO(ref_image_bytes)).convert("RGB")
-        # Normalize ref to 512x512 center-cropped square for IP-Adapter
-        ref = _prepare_ref_image(ref, target_size=512)
-    
-        # 2) Force deterministic canvas size (match your story template)
-        if out_size and int(out_size) > 0:
-            out_size = _snap64(int(out_size))
-            w, h = bg.size
-            scale = out_size / float(max(w, h))
-            if scale != 1.0:
-                bg = bg.resize((max(1, int(round(w * scale))), max(1, int(round(h * scale)))), Image.Resampling.LANCZOS)
-
-        if mask.size != bg.size:
-            mask = mask.resize(bg.size, Image.Resampling.LANCZOS)
-
-        # Binarize mask (sane contract: white=inpaint, black=keep)
-        mask = mask.point(lambda p: 255 if p > 127 else 0)
-        # Edge hygiene scaled to size
-        px = max(1, int(round(max(bg.size) / 1024 * 1.2)))
-        mask = mask.filter(ImageFilter.MaxFilter(2 * px + 1))
-        mask = mask.filter(ImageFilter.GaussianBlur(0.8 * px))
-
-        # 3) Style (LoRA) — single call, no fuse/unfuse or unload/reload
-        self._set_adapter(adapter, scale=float(adapter_scale))
+        if not (bg_image_bytes or bg_image_id) or not (mask_bytes or mask_id) or not (ref_image_bytes or ref_image_id or character_id):
+            raise ValueError("Missing 'image', 'mask', or 'ref_image'/'character_id'.")
+        output_format = _output_format(output_format)
+        bg_image_bytes = bg_image_bytes or self._blob(bg_image_id)
+        mask_bytes = mask_bytes or self._blob(mask_id)
+
+        # 1-2) Decode inputs and force the canvas (the reference is decoded lazily, on an embed-cache miss)
+        bg, mask = self._prep_inpaint_canvas(bg_image_bytes, mask_bytes, out_size, preprocessed=preprocessed)
+
         # Shrink prompts, then apply short style hints (lighter touch for inpaint)
-        hint = STYLE_HINTS.get(adapter, {})
-        prompt = _shrink_prompt(prompt, max_words=70)
-        neg = _shrink_prompt(negative_prompt, max_words=70) if negative_prompt else None
-        if hint.get("add"):
-            prompt = f"{prompt} {hint['add']}".strip()
-        if neg:
-            negative_prompt = f"{neg} {hint.get('neg','')}".strip()
-        else:
-            negative_prompt = hint.get("neg", None)
-
-        # 4) Seed locking
-        g = None
-        if seed is not None:
-            g = torch.Generator(device=self.device).manual_seed(int(seed))
-    
-        # 5) Run inpaint — fixed recipe, no IP-Adapter hot swapping, no extra tricks
-        # style (LoRA) already set above; do NOT fuse/unfuse on inpaint
+        prompt, negative_prompt = _styled_prompts(prompt, negative_prompt, adapter)
         # Negative prompt fallback to reduce common artifacts if none provided
         if negative_prompt is None:
-            negative_prompt = (
-                "extra limbs, extra fingers, deformed face,"
-                "mustache, beard, text, watermark, low quality, blurry"
+            negative_prompt = INPAINT_DEFAULT_NEGATIVE
+
+        ref = self._ref_source(ref_image_bytes, character_id, ref_image_id)
+
+        # everything above is CPU/network work that overlaps other inputs; pipelines and adapter state need the lock
+        with self._gpu_section():
+            # 3) Style (LoRA) — single call, no fuse/unfuse or unload/reload
+            self._set_adapter(adapter, scale=float(adapter_scale))
+
+            # 4-5) Run inpaint — fixed recipe, no IP-Adapter hot swapping, no extra tricks
+            # style (LoRA) already set above; do NOT fuse/unfuse on inpaint
+            cond = dict(
+                **self._encode_prompt(self.inpaint, prompt, negative_prompt),
+                ip_adapter_image_embeds=self._ref_embeds(ref, float(guidance_scale) > 1.0),
             )
+            callback = self._preview_callback([(progress_id, preview_every) if progress_id else None])
+            seeds = None
+            if int(num_candidates) > 1:
+                seeds = self._candidate_seeds("inpaint", seed, num_candidates, *bg.size)
+            images = self._denoise_inpaint(
+                bg, mask, cond, steps, guidance_scale, seeds or seed,
+                crop_to_mask=crop_to_mask, callback=callback, cache_interval=cache_interval,
+            )
+
+            # 6) Safety (on the GPU tensor, before the host copy)
+            flags = self._safety_check(images)
+            out_imgs = _tensor_to_pil(images)
+
+        self._flush_previews(progress_id)
+        if seeds:
+            return _resolve(self._candidates(out_imgs, flags, seeds, num_candidates, output_format, output_quality))
+        return self._encode_now(out_imgs[0], output_format, output_quality), flags[0]
+
+    @modal.method()
+    @_requires("inpaint")
+    @_gpu_serialized
+    def benchmark_mask_crop(
+        self,
+        prompt: str,
+        bg_image_bytes: bytes,
+        mask_bytes: bytes,
+        ref_image_bytes: bytes,
+        steps: int = 28,
+        guidance_scale: float = 5,
+        seed: int = 0,
+        out_size: int = 1024,
+        repeats: int = 3,
+    ) -> dict:
+        """
+        Latency of full-canvas vs crop-to-mask inpainting on the same inputs and
+        seed, plus how far the two outputs are apart inside and outside the mask.
+        """
+        bg, mask = self._prep_inpaint_canvas(bg_image_bytes, mask_bytes, out_size)
+        self._set_adapter("none")
+        cond = dict(
+            **self._encode_prompt(self.inpaint, _shrink_prompt(prompt, max_words=70), INPAINT_DEFAULT_NEGATIVE),
+            ip_adapter_image_embeds=self._ref_embeds(self._ref_source(ref_image_bytes, None), float(guidance_scale) > 1.0),
+        )
+        report, outputs = {}, {}
+        for name, crop in (("full", False), ("crop", True)):
+            times = []
+            for _ in range(max(1, int(repeats))):
+                if self.device == "cuda":
+                    torch.cuda.synchronize()
+                t0 = time.perf_counter()
+                outputs[name] = _tensor_to_pil(
+                    self._denoise_inpaint(bg, mask, cond, steps, guidance_scale, seed, crop_to_mask=crop)
+                )[0]
+                if self.device == "cuda":
+                    torch.cuda.synchronize()
+                times.append((time.perf_counter() - t0) * 1000.0)
+            report[name] = {"ms_p50": round(_percentile(times, 0.5), 1), "ms_min": round(min(times), 1)}
+
+        box = _mask_crop_box(mask)
+        m = np.asarray(mask, dtype=np.float32)[..., None] / 255.0
+        ref_px = np.asarray(bg, dtype=np.float32)
+        full = np.asarray(outputs["full"], dtype=np.float32)
+        crop = np.asarray(outputs["crop"], dtype=np.float32)
+
+        def _region(diff, weight):
+            w = float(weight.sum()) * diff.shape[-1]
+            mae = float(np.abs(diff * weight).sum() / max(w, 1.0))
+            mse = float((diff ** 2 * weight).sum() / max(w, 1.0))
+            return {"mae": round(mae, 3), "psnr": round(10 * np.log10(255.0 ** 2 / max(mse, 1e-8)), 2)}
+
+        report["speedup"] = round(report["full"]["ms_p50"] / max(report["crop"]["ms_p50"], 1e-6), 3)
+        report["crop_box"] = box
+        report["mask_fraction"] = round(float(m.mean()), 4)
+        report["crop_vs_full_inside_mask"] = _region(crop - full, m)
+        report["outside_mask_vs_background"] = {
+            "full": _region(full - ref_px, 1.0 - m),
+            "crop": _region(crop - ref_px, 1.0 - m),
+        }
+        return report
+
+    # ─────────────── Whole book (pipelined inpaint pages) ─────────────── #
+    @modal.method()
+    def generate_book(
+        self,
+        pages: list,
+        ref_image_bytes: bytes | None = None,
+        character_id: str | None = None,
+        adapter: str = "none",
+        adapter_scale: float = 1.0,
+        steps: int = 28,
+        guidance_scale: float = 5,
+        out_size: int = 1024,
+        negative_prompt: str | None = None,
+        crop_to_mask: bool = False,
+        preprocessed: bool = False,
+        output_format: str = "png",
+        output_quality: int | None = None,
+        ref_image_id: str | None = None,
+    ):
+        """
+        Render every page of a story with one style and one character reference.
+        pages: [{"prompt", "image" (background bytes) | "image_id", "mask" (bytes) | "mask_id",
+                 "seed"?, "negative_prompt"?}].
+        Yields {"index", "image", "safety", "seed"} in page order as pages finish.
+
+        The reference embeds and the adapter are set up once. Decoding and mask
+        prep of the next pages run on the CPU pool while the current page
+        denoises, and each page encodes off-thread while the next one denoises.
+        The GPU lock is taken per page, so single-page requests can interleave.
+        """
+        if not pages:
+            raise ValueError("Missing 'pages'.")
+        if not (ref_image_bytes or ref_image_id or character_id):
+            raise ValueError("Missing 'ref_image'/'character_id'.")
+        for i, page in enumerate(pages):
+            if not page.get("prompt") or not (page.get("image") or page.get("image_id")) or not (page.get("mask") or page.get("mask_id")):
+                raise ValueError(f"Page {i}: missing 'prompt', 'image' or 'mask'.")
+        _adapter_name(adapter)
+        output_format = _output_format(output_format)
+        self.loader.require("inpaint")
+
+        ref = self._ref_source(ref_image_bytes, character_id, ref_image_id)
+        with self._gpu_section():
+            self._set_adapter(adapter, scale=float(adapter_scale))
+            ref_embeds = self._ref_embeds(ref, float(guidance_scale) > 1.0)
+
+        pool = _cpu_executor()
+        prepared = deque()   # futures of (bg, mask), at most 2 pages ahead
+        next_page = 0
+
+        def _prep(page):
+            bg_bytes = page.get("image") or self._blob(page["image_id"])
+            mask_bytes = page.get("mask") or self._blob(page["mask_id"])
+            return self._prep_inpaint_canvas(bg_bytes, mask_bytes, out_size, preprocessed)
+
+        def _prefetch():
+            nonlocal next_page
+            while next_page < len(pages) and len(prepared) < 2:
+                prepared.append(pool.submit(_prep, pages[next_page]))
+                next_page += 1
+
+        def _page_result(index, seed, encoded, safety):
+            return {"index": index, "image": encoded.result(), "safety": safety, "seed": seed}
+
+        finished = deque()   # (index, seed, encode future, safety)
+        _prefetch()
+        for i, page in enumerate(pages):
+            bg, mask = prepared.popleft().result()
+            _prefetch()
+            prompt, neg = _styled_prompts(page["prompt"], page.get("negative_prompt", negative_prompt), adapter)
+            seed = page.get("seed")
+            seed = int(seed) if seed is not None else random.randrange(2**31)
+            with self._gpu_section():
+                # no-op unless a request in between switched the style
+                self._set_adapter(adapter, scale=float(adapter_scale))
+                cond = dict(
+                    **self._encode_prompt(self.inpaint, prompt, neg or INPAINT_DEFAULT_NEGATIVE),
+                    ip_adapter_image_embeds=ref_embeds,
+                )
+                images = self._denoise_inpaint(bg, mask, cond, steps, guidance_scale, seed, crop_to_mask=crop_to_mask)
+                safety = self._safety_check(images)[0]
+            finished.append((i, seed, self._encode(_tensor_to_pil(images)[0], output_format, output_quality), safety))
+            while finished and finished[0][2].done():
+                yield _page_result(*finished.popleft())
+        while finished:
+            yield _page_result(*finished.popleft())
+
+# t2i batching also needs several inputs waiting in one container. Set with
+# @modal.concurrent: Modal 1.x removed app.cls(allow_concurrent_inputs=...) and
+# raises a TypeError on it, so the old keyword stops the app from importing.
+_host_max_inputs = max(HOST_MAX_INPUTS, T2I_MAX_BATCH if T2I_BATCH_WINDOW_MS > 0 else 1)
+
+@app.cls(
+    gpu="A100",
+    volumes={
+        HF_CACHE_PATH: modal.Volume.from_name("hf-cache", create_if_missing=True),
+        RESULTS_PATH: results_volume,
+    },
+    scaledown_window=300,
+    enable_memory_snapshot=ENABLE_MEMORY_SNAPSHOT,
+)
+@modal.concurrent(max_inputs=_host_max_inputs)
+class SDXLLoRAHost(SDXLLoRAHostBase):
+    """SDXLLoRAHostBase deployed as a Modal class on an A100."""
 
-        with torch.inference_mode():
-            result = self.inpaint(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            image=bg,
-            mask_image=mask,
-            ip_adapter_image=ref,   # that’s it — no embed prep
-            num_inference_steps=int(steps),
-            guidance_scale=float(guidance_scale),
-            generator=g,
-            output_type="pil",
-        )
-    
-        out_img = result.images[0]
-    
-        # 6) Safety
-        np_img = np.array(out_img).astype(np.float32) / 255.0
-        clip_in = self.image_processor(images=[out_img], return_tensors="pt")
-        pixel_values = clip_in["pixel_values"].to(self.device)
-        _checked_images, has_nsfw_concepts = self.safety_checker(
-            images=np_img[None, ...], clip_input=pixel_values
-        )
-        safety = {"flagged": bool(has_nsfw_concepts[0])}
-    
-        return _pil_to_png_bytes(out_img), safety
+# ───────────────────────── Job Queue (Modal) ───────────────────────── #
+def _modal_job_runners() -> dict:
+    """Runners that spawn the SDXLLoRAHost call, so a cancel can abort it on the GPU side too."""
+    host = SDXLLoRAHost()
+
+    def _spawned(method):
+        def run(job):
+            call = method.spawn(**job.kwargs)
+            job.on_cancel(call.cancel)
+            data, safety = call.get()
+            return {"image": data, "safety": safety, "output_format": job.kwargs["output_format"]}
+        return run
+
+    return {
+        "t2i": _spawned(host.generate_t2i),
+        "i2i": _spawned(host.generate_i2i),
+        "inpaint": _spawned(host.generate_inpaint_ref),
+    }
+
+@app.cls(
+    # queue state lives in memory: exactly one container, kept warm between submissions
+    max_containers=1,
+    scaledown_window=1200,
+)
+# long-polls and event streams each hold an input while they wait
+@modal.concurrent(max_inputs=256)
+class JobQueue:
+    @modal.enter()
+    def setup(self):
+        self.scheduler = _JobScheduler(_modal_job_runners())
+
+    @modal.method()
+    def submit(self, kind: str, kwargs: dict, user: str = "anonymous", priority: str = "interactive") -> str:
+        return self.scheduler.submit(kind, kwargs, user=user, priority=priority)
+
+    @modal.method()
+    def status(self, job_id: str, wait_s: float = 0.0) -> dict | None:
+        return self.scheduler.status(job_id, wait_s=min(float(wait_s), 60.0))
+
+    @modal.method()
+    def result(self, job_id: str):
+        return self.scheduler.result(job_id)
+
+    @modal.method()
+    def cancel(self, job_id: str) -> bool | None:
+        return self.scheduler.cancel(job_id)
+
+    @modal.method()
+    def stats(self) -> dict:
+        return self.scheduler.stats()
 
 # ───────────────────────── FastAPI Endpoints ───────────────────────── #
-@app.function()
-@modal.fastapi_endpoint(method="POST")
-def t2i(request: dict):
-    prompt = request.get("prompt")
-    if not prompt:
-        return {"error": "Missing 'prompt'."}, 400
+# Two transports per generator: JSON with base64 data URLs (t2i / i2i / inpaint)
+# and binary (t2i_bin / i2i_bin / inpaint_bin): multipart/form-data or a raw
+# image body in, raw image bytes out, metadata in X-* headers. Both report
+# Server-Timing (prep / gpu / encode) so the transport overhead can be compared.
 
-    width = int(request.get("width", 1024))
-    height = int(request.get("height", 1024))
-    steps = int(request.get("steps", 30))
-    guidance_scale = float(request.get("guidance_scale", 5.5))
-    negative_prompt = request.get("negative_prompt")
-    seed = request.get("seed")
-    seed = int(seed) if seed is not None else None
-    adapter = request.get("adapter", "none")
-    adapter_scale = 1.0
-    use_freeu = bool(request.get("use_freeu", False))
+def _flag(value, default: bool = False) -> bool:
+    # JSON sends real booleans, form fields and query params send strings
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
 
-    png = SDXLLoRAHost().generate_t2i.remote(
-        prompt=prompt,
-        width=width,
-        height=height,
-        steps=steps,
-        guidance_scale=guidance_scale,
-        seed=seed,
-        adapter=adapter,
-        negative_prompt=negative_prompt,
-        adapter_scale=adapter_scale,
-        use_freeu=use_freeu,
+def _server_timing(**ms) -> str:
+    return ", ".join(f"{name};dur={dur:.1f}" for name, dur in ms.items())
+
+def _host_timing(safety) -> dict:
+    # host stages from safety["timings"] (return_timings), as extra Server-Timing entries
+    timings = safety.get("timings") if isinstance(safety, dict) else None
+    return {f"host_{stage}": ms for stage, ms in (timings or {}).get("stages_ms", {}).items()}
+
+def _output_kwargs(request) -> dict:
+    quality = request.get("output_quality")
+    return dict(
+        output_format=_output_format(request.get("output_format")),
+        output_quality=int(quality) if quality is not None else None,
     )
-    return {"image": _png_bytes_to_b64(png)}
 
-@app.function()
-@modal.fastapi_endpoint(method="POST")
-def i2i(request: dict):
-    prompt = request.get("prompt")
-    b64 = request.get("image")
-    if not prompt or not b64:
-        return {"error": "Missing 'prompt' or 'image'."}, 400
+def _timing_kwargs(request) -> dict:
+    # per-stage host timings in safety["timings"]; only sent when asked for
+    return {"return_timings": True} if _flag(request.get("return_timings"), False) else {}
 
-    try:
-        img_bytes = _decode_data_url_b64(b64)
-    except Exception:
-        return {"error": "Invalid base64 in 'image'."}, 400
+def _candidate_kwargs(request) -> dict:
+    # JSON endpoints only: the binary ones return a single image body
+    n = int(request.get("num_candidates") or 1)
+    if n < 1:
+        raise ValueError("'num_candidates' must be at least 1.")
+    return {"num_candidates": n} if n > 1 else {}
+
+def _image_body(data, output_format: str, safety: dict) -> dict:
+    if isinstance(data, (list, tuple)):
+        # num_candidates: images in candidate order, seeds alongside
+        return {
+            "images": [_image_bytes_to_data_url(d, output_format) for d in data],
+            "seeds": [c["seed"] for c in safety["candidates"]],
+            "safety": safety,
+        }
+    return {"image": _image_bytes_to_data_url(data, output_format), "safety": safety}
+
+def _t2i_kwargs(request) -> dict:
+    prompt = request.get("prompt")
+    if not prompt:
+        raise ValueError("Missing 'prompt'.")
+    seed = request.get("seed")
+    return dict(
+        prompt=prompt,
+        width=int(request.get("width", 1024)),
+        height=int(request.get("height", 1024)),
+        steps=int(request.get("steps", 30)),
+        guidance_scale=float(request.get("guidance_scale", 5.5)),
+        seed=int(seed) if seed is not None else None,
+        adapter=request.get("adapter", "none"),
+        negative_prompt=request.get("negative_prompt"),
+        adapter_scale=1.0,
+        use_freeu=_flag(request.get("use_freeu"), False),
+        cache_interval=int(request.get("cache_interval") or 1),
+        **_output_kwargs(request),
+        **_timing_kwargs(request),
+    )
 
-    strength = float(request.get("strength", 0.35))
-    steps = int(request.get("steps", 32))
-    guidance_scale = float(request.get("guidance_scale", 6.5))
-    negative_prompt = request.get("negative_prompt")
-    seed = request.get("seed"); seed = int(seed) if seed is not None else None
+def _i2i_kwargs(request, img_bytes: bytes | None) -> dict:
+    image_id = request.get("image_id")  # or: id from /upload
+    if not request.get("prompt") or not (img_bytes or image_id):
+        raise ValueError("Missing 'prompt' or 'image'/'image_id'.")
+    seed = request.get("seed")
     out_size = int(request.get("out_size", 1024))
-    adapter = request.get("adapter", "none")
+    keep_aspect = _flag(request.get("keep_aspect"), True)
     # NEW: pass-through for the quality knobs
-    adapter_scale = float(request.get("adapter_scale", 1.0))
     guidance_rescale = request.get("guidance_rescale")
-    guidance_rescale = float(guidance_rescale) if guidance_rescale is not None else None
     noise_offset = request.get("noise_offset")
-    noise_offset = float(noise_offset) if noise_offset is not None else None
-    keep_aspect = bool(request.get("keep_aspect", True))
 
-    png, safety = SDXLLoRAHost().generate_i2i.remote(
-        prompt=prompt,
+    # decode/crop/resize here on the CPU function so the GPU gets its render-size canvas
+    # and does not resample it again (uploads are prepared once per container on the GPU worker)
+    if img_bytes:
+        render = _render_size("i2i", _snap64(out_size), _snap64(out_size))[0] if out_size else None
+        try:
+            init = _prepare_init_image(img_bytes, render, keep_aspect=keep_aspect)
+        except Exception:
+            raise ValueError("Invalid image in 'image'.")
+        img_bytes = _pil_to_png_bytes(init, compress_level=TRANSPORT_PNG_LEVEL)
+    return dict(
+        prompt=request.get("prompt"),
         image_bytes=img_bytes,
-        strength=strength,
-        steps=steps,
-        guidance_scale=guidance_scale,
-        seed=seed,
+        image_id=None if img_bytes else image_id,
+        strength=float(request.get("strength", 0.35)),
+        steps=int(request.get("steps", 32)),
+        guidance_scale=float(request.get("guidance_scale", 6.5)),
+        seed=int(seed) if seed is not None else None,
         out_size=out_size,
-        adapter=adapter,
-        negative_prompt=negative_prompt,
-        adapter_scale=adapter_scale,
-        guidance_rescale=guidance_rescale,
-        noise_offset=noise_offset,
+        adapter=request.get("adapter", "none"),
+        negative_prompt=request.get("negative_prompt"),
+        adapter_scale=float(request.get("adapter_scale", 1.0)),
+        guidance_rescale=float(guidance_rescale) if guidance_rescale is not None else None,
+        noise_offset=float(noise_offset) if noise_offset is not None else None,
         keep_aspect=keep_aspect,
+        cache_interval=int(request.get("cache_interval") or 1),
+        **_output_kwargs(request),
+        **_timing_kwargs(request),
+    )
+
+def _transport_ref(ref_bytes: bytes) -> bytes:
+    return _pil_to_png_bytes(_prepare_ref_image(_open_rgb(ref_bytes, target_short_side=512), target_size=512), compress_level=TRANSPORT_PNG_LEVEL)
+
+def _inpaint_kwargs(request, bg_bytes: bytes | None, mask_bytes: bytes | None, ref_bytes: bytes | None) -> dict:
+    character_id = request.get("character_id")  # or: id from /register_character
+    # or: ids from /upload in place of the inline images
+    bg_id, mask_id, ref_id = request.get("image_id"), request.get("mask_id"), request.get("ref_image_id")
+    if (not request.get("prompt") or not (bg_bytes or bg_id) or not (mask_bytes or mask_id)
+            or not (ref_bytes or ref_id or character_id)):
+        raise ValueError("Missing 'prompt', 'image', 'mask', or 'ref_image'/'character_id' (or their '_id' forms).")
+
+    # minimal knobs (everything else is fixed by the service)
+    seed = request.get("seed")
+    out_size = int(request.get("out_size", 1024))
+
+    # canvas resize, mask hygiene and ref crop run here, not on the GPU worker;
+    # uploaded images are prepared (and cached by content) on the GPU worker instead
+    preprocessed = bool(bg_bytes and mask_bytes)
+    try:
+        if preprocessed:
+            bg_bytes, mask_bytes, ref_bytes = _preprocess_inpaint_inputs(bg_bytes, mask_bytes, ref_bytes, out_size)
+        elif ref_bytes:
+            ref_bytes = _transport_ref(ref_bytes)
+    except Exception:
+        raise ValueError("Invalid image in one of: 'image', 'mask', 'ref_image'.")
+    return dict(
+        prompt=request.get("prompt"),
+        bg_image_bytes=bg_bytes,
+        mask_bytes=mask_bytes,
+        ref_image_bytes=ref_bytes,
+        bg_image_id=None if bg_bytes else bg_id,
+        mask_id=None if mask_bytes else mask_id,
+        ref_image_id=None if ref_bytes else ref_id,
+        steps=int(request.get("steps", 28)), #hardcode later, check request for now
+        guidance_scale=float(request.get("guidance_scale", 5)), #hardcode later, check request for now
+        seed=int(seed) if seed is not None else None,
+        out_size=out_size,
+        adapter=request.get("adapter", "none"),
+        adapter_scale=float(request.get("adapter_scale", 1.0)),
+        negative_prompt=request.get("negative_prompt"),
+        character_id=character_id,
+        crop_to_mask=_flag(request.get("crop_to_mask"), False),
+        preprocessed=preprocessed,
+        cache_interval=int(request.get("cache_interval") or 1),
+        **_output_kwargs(request),
+        **_timing_kwargs(request),
     )
-    return {"image": _png_bytes_to_b64(png), "safety": safety}
 
 @app.function()
 @modal.fastapi_endpoint(method="POST")
-def inpaint(request: dict):
-    # required
-    prompt   = request.get("prompt")
+async def t2i(request: dict):
+    t0 = time.perf_counter()
+    try:
+        kwargs = dict(_t2i_kwargs(request), **_candidate_kwargs(request))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_t2i.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    body = await asyncio.to_thread(_image_body, data, kwargs["output_format"], safety)
+    t3 = time.perf_counter()
+    return JSONResponse(body, headers={
+        "Server-Timing": _server_timing(
+            prep=(t1 - t0) * 1e3, gpu=(t2 - t1) * 1e3, encode=(t3 - t2) * 1e3, **_host_timing(safety),
+        ),
+    })
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def i2i(request: dict):
+    t0 = time.perf_counter()
+    b64 = request.get("image")  # or 'image_id' from /upload
+    try:
+        img_bytes = await asyncio.to_thread(_decode_data_url_b64, b64) if b64 else None
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid base64 in 'image'.")
+    td = time.perf_counter()
+    try:
+        kwargs = dict(await asyncio.to_thread(_i2i_kwargs, request, img_bytes), **_candidate_kwargs(request))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_i2i.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    body = await asyncio.to_thread(_image_body, data, kwargs["output_format"], safety)
+    t3 = time.perf_counter()
+    return JSONResponse(body, headers={
+        "Server-Timing": _server_timing(
+            decode=(td - t0) * 1e3, prep=(t1 - td) * 1e3, gpu=(t2 - t1) * 1e3, encode=(t3 - t2) * 1e3,
+            **_host_timing(safety),
+        ),
+    })
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def inpaint(request: dict):
+    t0 = time.perf_counter()
+    # required (each image can instead be an id from /upload: image_id, mask_id, ref_image_id)
     img_b64  = request.get("image")       # background image
     mask_b64 = request.get("mask")        # white=inpaint, black=keep
     ref_b64  = request.get("ref_image")   # selfie/character reference
-    if not prompt or not img_b64 or not mask_b64 or not ref_b64:
-        return {"error": "Missing 'prompt', 'image', 'mask', or 'ref_image'."}, 400
+
+    def _decode_all():
+        return tuple(_decode_data_url_b64(b64) if b64 else None for b64 in (img_b64, mask_b64, ref_b64))
 
     try:
-        bg_bytes   = _decode_data_url_b64(img_b64)
-        mask_bytes = _decode_data_url_b64(mask_b64)
-        ref_bytes  = _decode_data_url_b64(ref_b64)
+        bg_bytes, mask_bytes, ref_bytes = await asyncio.to_thread(_decode_all)
     except Exception:
-        return {"error": "Invalid base64 in one of: 'image', 'mask', 'ref_image'."}, 400
+        raise HTTPException(status_code=400, detail="Invalid base64 in one of: 'image', 'mask', 'ref_image'.")
+    td = time.perf_counter()
+    try:
+        kwargs = dict(
+            await asyncio.to_thread(_inpaint_kwargs, request, bg_bytes, mask_bytes, ref_bytes),
+            **_candidate_kwargs(request),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # minimal knobs (everything else is fixed by the service)
-    seed    = request.get("seed"); seed = int(seed) if seed is not None else None
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_inpaint_ref.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    body = await asyncio.to_thread(_image_body, data, kwargs["output_format"], safety)
+    t3 = time.perf_counter()
+    return JSONResponse(body, headers={
+        "Server-Timing": _server_timing(
+            decode=(td - t0) * 1e3, prep=(t1 - td) * 1e3, gpu=(t2 - t1) * 1e3, encode=(t3 - t2) * 1e3,
+            **_host_timing(safety),
+        ),
+    })
 
-    png, safety = SDXLLoRAHost().generate_inpaint_ref.remote(
-        prompt=prompt,
-        bg_image_bytes=bg_bytes,
-        mask_bytes=mask_bytes,
+async def _read_binary_request(request: "Request") -> tuple:
+    """
+    (params, files) from multipart/form-data (file parts → files, other
+    fields → params), a JSON body (params only) or a raw image body (→
+    files["image"]). Query-string params apply in every case.
+    """
+    params, files = dict(request.query_params), {}
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        for key, value in form.multi_items():
+            if hasattr(value, "read"):
+                files[key] = await value.read()
+            else:
+                params[key] = value
+    elif content_type.startswith("application/json"):
+        params.update(await request.json())
+    else:
+        body = await request.body()
+        if body:
+            files["image"] = body
+    return params, files
+
+def _image_response(data: bytes, output_format: str, safety: dict | None, timing: dict) -> "Response":
+    timing = dict(timing or {}, **_host_timing(safety))
+    headers = {"Server-Timing": _server_timing(**timing)} if timing else {}
+    if safety is not None:
+        headers["X-Safety-Flagged"] = "true" if safety.get("flagged") else "false"
+    return Response(content=data, media_type=OUTPUT_FORMATS[output_format][1], headers=headers)
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def t2i_bin(request: "Request"):
+    """Same knobs as /t2i as JSON body, form fields or query params; returns the encoded image."""
+    t0 = time.perf_counter()
+    params, _ = await _read_binary_request(request)
+    try:
+        kwargs = _t2i_kwargs(params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_t2i.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    return _image_response(data, kwargs["output_format"], safety, {"prep": (t1 - t0) * 1e3, "gpu": (t2 - t1) * 1e3})
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def i2i_bin(request: "Request"):
+    """multipart ('image' file + /i2i fields) or raw image body with knobs in the query string."""
+    t0 = time.perf_counter()
+    params, files = await _read_binary_request(request)
+    try:
+        kwargs = await asyncio.to_thread(_i2i_kwargs, params, files.get("image"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_i2i.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    return _image_response(data, kwargs["output_format"], safety, {"prep": (t1 - t0) * 1e3, "gpu": (t2 - t1) * 1e3})
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def inpaint_bin(request: "Request"):
+    """multipart with 'image', 'mask' and 'ref_image' files (or a 'character_id' field) + /inpaint fields."""
+    t0 = time.perf_counter()
+    params, files = await _read_binary_request(request)
+    try:
+        kwargs = await asyncio.to_thread(
+            _inpaint_kwargs, params, files.get("image"), files.get("mask"), files.get("ref_image")
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    t1 = time.perf_counter()
+    data, safety = await SDXLLoRAHost().generate_inpaint_ref.remote.aio(**kwargs)
+    t2 = time.perf_counter()
+    return _image_response(data, kwargs["output_format"], safety, {"prep": (t1 - t0) * 1e3, "gpu": (t2 - t1) * 1e3})
+
+def _book_kwargs(request) -> dict:
+    pages_in = request.get("pages") or []
+    ref_b64 = request.get("ref_image")
+    ref_id = request.get("ref_image_id")
+    character_id = request.get("character_id")
+    if not pages_in or not (ref_b64 or ref_id or character_id):
+        raise ValueError("Missing 'pages' or 'ref_image'/'ref_image_id'/'character_id'.")
+
+    def _image(page, name):
+        if page.get(f"{name}_id"):
+            return None
+        return _decode_data_url_b64(page[name])
+
+    pages = []
+    try:
+        ref_bytes = _decode_data_url_b64(ref_b64) if ref_b64 else None
+        for page in pages_in:
+            pages.append({
+                "prompt": page.get("prompt"),
+                "image": _image(page, "image"),
+                "image_id": page.get("image_id"),
+                "mask": _image(page, "mask"),
+                "mask_id": page.get("mask_id"),
+                "seed": int(page["seed"]) if page.get("seed") is not None else None,
+                "negative_prompt": page.get("negative_prompt", request.get("negative_prompt")),
+            })
+    except (KeyError, TypeError):
+        raise ValueError("Every page needs 'prompt', 'image'/'image_id' and 'mask'/'mask_id'.")
+    except Exception:
+        raise ValueError("Invalid base64 in 'ref_image' or a page 'image'/'mask'.")
+    if ref_bytes:
+        try:
+            ref_bytes = _transport_ref(ref_bytes)
+        except Exception:
+            raise ValueError("Invalid image in 'ref_image'.")
+    return dict(
+        pages=pages,
         ref_image_bytes=ref_bytes,
-        steps=int(request.get("steps", 28)), #hardcode later, check request for now
-        guidance_scale=float(request.get("guidance_scale", 5)), #hardcode later, check request for now
-        seed=seed,
-        out_size=int(request.get("out_size", 1024)),
-        adapter = request.get("adapter", "none"),
+        ref_image_id=None if ref_bytes else ref_id,
+        character_id=character_id,
+        adapter=request.get("adapter", "none"),
         adapter_scale=float(request.get("adapter_scale", 1.0)),
+        steps=int(request.get("steps", 28)),
+        guidance_scale=float(request.get("guidance_scale", 5)),
+        out_size=int(request.get("out_size", 1024)),
         negative_prompt=request.get("negative_prompt"),
+        crop_to_mask=_flag(request.get("crop_to_mask"), False),
+        **_output_kwargs(request),
+    )
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def book(request: dict):
+    """
+    Whole story in one call: shared 'adapter', 'adapter_scale', 'ref_image' (or
+    'ref_image_id' / 'character_id') and 'pages': [{"prompt", "image" | "image_id",
+    "mask" | "mask_id", "seed"?}]. Streams
+    NDJSON, one line per finished page: {"index", "image", "safety", "seed"}.
+    Page backgrounds/masks are prepared on the GPU worker's CPU pool, overlapped
+    with denoising.
+    """
+    try:
+        kwargs = await asyncio.to_thread(_book_kwargs, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def _lines():
+        try:
+            async for page in SDXLLoRAHost().generate_book.remote_gen.aio(**kwargs):
+                page["image"] = _image_bytes_to_data_url(page["image"], kwargs["output_format"])
+                yield json.dumps(page) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
+
+# Job API: submit returns a job_id right away; the web container is free while
+# the job waits for a GPU slot. Poll /jobs_status (optionally long-polling with
+# 'wait'), or follow /jobs_events, then fetch /jobs_result.
+
+def _job_kwargs(kind: str, request: dict) -> dict:
+    try:
+        if kind == "t2i":
+            return _t2i_kwargs(request)
+        if kind == "i2i":
+            img_b64 = request.get("image")
+            return _i2i_kwargs(request, _decode_data_url_b64(img_b64) if img_b64 else None)
+        if kind == "inpaint":
+            bg_b64, mask_b64, ref_b64 = request.get("image"), request.get("mask"), request.get("ref_image")
+            return _inpaint_kwargs(
+                request,
+                _decode_data_url_b64(bg_b64) if bg_b64 else None,
+                _decode_data_url_b64(mask_b64) if mask_b64 else None,
+                _decode_data_url_b64(ref_b64) if ref_b64 else None,
+            )
+    except ValueError:
+        raise
+    except Exception:
+        raise ValueError("Invalid base64 in one of: 'image', 'mask', 'ref_image'.")
+    raise ValueError(f"Unknown 'kind' '{kind}'. Available: t2i, i2i, inpaint.")
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def jobs_submit(request: dict):
+    """
+    Same body as /t2i, /i2i or /inpaint plus 'kind' (t2i | i2i | inpaint),
+    'priority' (interactive | bulk) and 'user' (fair-share key). Returns {"job_id"}.
+    """
+    try:
+        kind = request.get("kind", "t2i")
+        kwargs = await asyncio.to_thread(_job_kwargs, kind, request)
+        job_id = await JobQueue().submit.remote.aio(
+            kind, kwargs, user=request.get("user", "anonymous"), priority=request.get("priority", "interactive"),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"job_id": job_id}
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def jobs_status(job_id: str, wait: float = 0.0):
+    """Job status; 'wait' (seconds, ≤ 60) long-polls until the status changes."""
+    status = await JobQueue().status.remote.aio(job_id, wait_s=wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown 'job_id'.")
+    return status
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def jobs_events(job_id: str):
+    """NDJSON stream of status updates, ending with the terminal one."""
+    queue = JobQueue()
+    first = await queue.status.remote.aio(job_id)
+    if first is None:
+        raise HTTPException(status_code=404, detail="Unknown 'job_id'.")
+
+    async def _lines():
+        status = first
+        yield json.dumps(status) + "\n"
+        while status is not None and status["status"] not in JOB_TERMINAL:
+            previous = (status["status"], status["ahead"])
+            status = await queue.status.remote.aio(job_id, wait_s=30.0)
+            if status is not None and (status["status"], status["ahead"]) != previous:
+                yield json.dumps(status) + "\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def jobs_result(job_id: str, encoding: str = "binary"):
+    """The finished image: raw bytes (default) or, with encoding=json, the /t2i-style JSON body."""
+    status, result = await JobQueue().result.remote.aio(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown 'job_id'.")
+    if status != "done":
+        raise HTTPException(status_code=409, detail=f"Job is '{status}'.")
+    if encoding == "json":
+        return {"image": _image_bytes_to_data_url(result["image"], result["output_format"]), "safety": result["safety"]}
+    return _image_response(result["image"], result["output_format"], result["safety"], {})
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def jobs_cancel(request: dict):
+    """{"job_id"} → {"cancelled": bool}; a running job's GPU call is cancelled too."""
+    cancelled = await JobQueue().cancel.remote.aio(request.get("job_id", ""))
+    if cancelled is None:
+        raise HTTPException(status_code=404, detail="Unknown 'job_id'.")
+    return {"cancelled": cancelled}
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def jobs_stats():
+    """Queue depth, running jobs and wait-time percentiles per priority tier."""
+    return await JobQueue().stats.remote.aio()
+
+# Progress streaming: the generator pushes latent previews to a progress_queue
+# partition while the endpoint relays them as server-sent events.
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _progress_events(call, progress_id: str, output_format: str):
+    """SSE for a spawned generate_* call: its previews as they arrive, then the result."""
+    result = asyncio.ensure_future(call.get.aio())
+    try:
+        while True:
+            done = result.done()
+            events = await progress_queue.get_many.aio(8, block=not done, timeout=0.25, partition=progress_id)
+            for event in events:
+                yield _sse("preview", {
+                    "step": event["step"],
+                    "steps": event["steps"],
+                    "image": _image_bytes_to_data_url(event["preview"], "jpeg"),
+                })
+            if done and not events:
+                break
+        data, safety = result.result()
+        yield _sse("result", {"image": _image_bytes_to_data_url(data, output_format), "safety": safety})
+    except Exception as e:
+        yield _sse("error", {"error": str(e)})
+    finally:
+        if not result.done():
+            # client went away
+            result.cancel()
+            await call.cancel.aio()
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def generate_stream(request: dict):
+    """
+    Same body as /t2i, /i2i or /inpaint plus 'kind' and optional 'preview_every'.
+    Server-sent events: "preview" {"step", "steps", "image"} (low-res JPEG from the
+    latents) while denoising, then "result" {"image", "safety"} or "error". A seeded
+    request served from the result cache (see _ResultStore) does not denoise, so
+    it streams the result right away with no previews.
+    """
+    kind = request.get("kind", "t2i")
+    try:
+        kwargs = await asyncio.to_thread(_job_kwargs, kind, request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    kwargs.update(progress_id=uuid.uuid4().hex, preview_every=int(request.get("preview_every", PREVIEW_EVERY)))
+
+    host = SDXLLoRAHost()
+    method = {"t2i": host.generate_t2i, "i2i": host.generate_i2i, "inpaint": host.generate_inpaint_ref}[kind]
+    call = await method.spawn.aio(**kwargs)
+    return StreamingResponse(
+        _progress_events(call, kwargs["progress_id"], kwargs["output_format"]),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+async def upload(request: "Request"):
+    """
+    Store an image once ('image' file part, raw body, or JSON {"image": base64}).
+    Pass the returned id as image_id / mask_id / ref_image_id instead of the bytes.
+    """
+    params, files = await _read_binary_request(request)
+    data = files.get("image")
+    if data is None and params.get("image"):
+        try:
+            data = _decode_data_url_b64(params["image"])
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid base64 in 'image'.")
+    if not data:
+        raise HTTPException(status_code=400, detail="Missing 'image'.")
+    try:
+        blob_id, existing = await asyncio.to_thread(_store_blob, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"id": blob_id, "bytes": len(data), "existing": existing}
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def blob_exists(id: str):
+    """Ids are sha256 hex (first 32 chars) of the file, so a client can check before uploading."""
+    return {"id": id, "exists": await blobs.contains.aio(id)}
+
+@app.function(schedule=modal.Period(hours=1))
+def prune_blobs() -> dict:
+    """Drop blobs idle for BLOB_TTL_S, then the least recently used until the store fits BLOB_STORE_MB."""
+    now = time.time()
+    entries = sorted(blob_meta.items(), key=lambda item: item[1]["last_used"])
+    total = sum(meta["bytes"] for _, meta in entries)
+    dropped = 0
+    for blob_id, meta in entries:
+        if now - meta["last_used"] < BLOB_TTL_S and total <= BLOB_STORE_MB * 2**20:
+            break
+        for store in (blobs, blob_meta):
+            try:
+                store.pop(blob_id)
+            except KeyError:
+                pass
+        total -= meta["bytes"]
+        dropped += 1
+    report = {"dropped": dropped, "kept": len(entries) - dropped, "bytes": total}
+    print(f"[blobs] {report}")
+    return report
+
+@app.function()
+@modal.fastapi_endpoint(method="POST")
+def register_character(request: dict):
+    """Upload a character reference once; pass the returned 'character_id' to /inpaint."""
+    ref_b64 = request.get("ref_image")
+    if not ref_b64:
+        raise HTTPException(status_code=400, detail="Missing 'ref_image'.")
+
+    try:
+        # the id hashes the same normalized PNG /inpaint sends for an inline ref,
+        # so both share one reference-embed cache entry on the GPU containers
+        png = _transport_ref(_decode_data_url_b64(ref_b64))
+        character_id = _content_hash(png)
+        if not character_refs.contains(character_id):
+            character_refs[character_id] = png
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image in 'ref_image'.")
+    return {"character_id": character_id}
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+async def metrics():
+    """
+    Prometheus scrape target: per-stage / request latency and peak-VRAM
+    histograms plus adapter-switch counters of every GPU container, one
+    instance label each, from the snapshots they publish to metrics_snapshots.
+    Runs on CPU only; scraping never starts or keeps warm a GPU container.
+    """
+    def _collect():
+        now, live = time.time(), []
+        for instance, snapshot in list(metrics_snapshots.items()):
+            if now - snapshot["ts"] > METRICS_STALE_S:
+                metrics_snapshots.pop(instance, None)   # container gone; its series end here
+            else:
+                live.append(snapshot["families"])
+        return live
+
+    text = _render_metric_families(await asyncio.to_thread(_collect))
+    return Response(content=text, media_type="text/plain; version=0.0.4")
+
+@app.function()
+def benchmark_preprocess(bg_image_bytes: bytes, mask_bytes: bytes, ref_image_bytes: bytes, out_size: int = 1024, repeats: int = 5) -> dict:
+    """
+    Per-stage CPU cost of the legacy GPU-side prep (full decode, PIL mask
+    filters) vs the reduced-size decode + vectorized mask used now, and how far
+    the new outputs are from the legacy ones.
+    """
+    def _timed(fn):
+        times, out = [], None
+        for _ in range(max(1, int(repeats))):
+            t0 = time.perf_counter()
+            out = fn()
+            times.append((time.perf_counter() - t0) * 1000.0)
+        return out, round(_percentile(times, 0.5), 2)
+
+    size = _snap64(out_size)
+    legacy, new = {}, {}
+    bg_full, legacy["decode_bg"] = _timed(lambda: Image.open(io.BytesIO(bg_image_bytes)).convert("RGB"))
+    bg_old, legacy["resize_bg"] = _timed(lambda: _fit_canvas(bg_full, size))
+    bg_draft, new["decode_bg"] = _timed(lambda: _open_rgb(bg_image_bytes, size))
+    bg_new, new["resize_bg"] = _timed(lambda: _fit_canvas(bg_draft, size))
+
+    mask_in = Image.open(io.BytesIO(mask_bytes)).convert("L")
+    mask_old, legacy["mask"] = _timed(lambda: _clean_mask_pil(mask_in, bg_old.size))
+    mask_new, new["mask"] = _timed(lambda: _clean_mask(mask_in, bg_new.size))
+
+    ref_old, legacy["ref"] = _timed(lambda: _prepare_ref_image(Image.open(io.BytesIO(ref_image_bytes)).convert("RGB")))
+    ref_new, new["ref"] = _timed(lambda: _prepare_ref_image(_open_rgb(ref_image_bytes, target_short_side=512)))
+
+    # i2i init path: center-crop of the background to size²
+    init_old, legacy["init"] = _timed(lambda: ImageOps.fit(
+        Image.open(io.BytesIO(bg_image_bytes)).convert("RGB"), (size, size), method=Image.Resampling.LANCZOS, centering=(0.5, 0.5)
+    ))
+    init_new, new["init"] = _timed(lambda: _prepare_init_image(bg_image_bytes, size))
+    _, new["transport_png"] = _timed(
+        lambda: [_pil_to_png_bytes(i, compress_level=TRANSPORT_PNG_LEVEL) for i in (bg_new, mask_new)]
+    )
+    _, new["end_to_end"] = _timed(lambda: _preprocess_inpaint_inputs(bg_image_bytes, mask_bytes, ref_image_bytes, size))
+
+    # reduced-scale decodes can round the short side differently by a pixel
+    if bg_new.size != bg_old.size:
+        bg_new, mask_new = bg_new.resize(bg_old.size), mask_new.resize(bg_old.size)
+    mask_diff = np.abs(np.asarray(mask_old, dtype=np.int16) - np.asarray(mask_new, dtype=np.int16))
+    bg_diff = np.abs(np.asarray(bg_old, dtype=np.int16) - np.asarray(bg_new, dtype=np.int16))
+    init_diff = np.abs(np.asarray(init_old, dtype=np.int16) - np.asarray(init_new, dtype=np.int16))
+    ref_diff = np.abs(np.asarray(ref_old, dtype=np.int16) - np.asarray(ref_new, dtype=np.int16))
+    return {
+        "legacy_ms": legacy,
+        "new_ms": new,
+        "mask_max_abs_diff": int(mask_diff.max()),
+        "mask_mean_abs_diff": round(float(mask_diff.mean()), 4),
+        "mask_within_tolerance": bool(mask_diff.max() <= MASK_TOLERANCE),
+        "bg_mean_abs_diff": round(float(bg_diff.mean()), 4),
+        "init_mean_abs_diff": round(float(init_diff.mean()), 4),
+        "ref_mean_abs_diff": round(float(ref_diff.mean()), 4),
+    }
+
+@app.function()
+def benchmark_encode(image_bytes: bytes, repeats: int = 5) -> dict:
+    """Encode time (p50 ms) and size for every OUTPUT_FORMATS entry at its default quality."""
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    report = {}
+    for fmt in OUTPUT_FORMATS:
+        times, data = [], b""
+        for _ in range(max(1, int(repeats))):
+            t0 = time.perf_counter()
+            data = _encode_image(img, fmt)
+            times.append((time.perf_counter() - t0) * 1000.0)
+        report[fmt] = {"ms_p50": round(_percentile(times, 0.5), 2), "bytes": len(data)}
+    for level in (1, 3):
+        t0 = time.perf_counter()
+        data = _encode_image(img, "png", level)
+        report[f"png_level{level}"] = {"ms_p50": round((time.perf_counter() - t0) * 1000.0, 2), "bytes": len(data)}
+    return report
+
+@app.local_entrypoint()
+def bench_encode(image: str, repeats: int = 5):
+    """modal run modal_service.py::bench_encode --image page.png"""
+    with open(image, "rb") as f:
+        print(json.dumps(benchmark_encode.remote(f.read(), repeats), indent=2))
+
+@app.local_entrypoint()
+def bench_preprocess(bg: str, mask: str, ref: str, out_size: int = 1024, repeats: int = 5):
+    """modal run modal_service.py::bench_preprocess --bg bg.jpg --mask mask.png --ref selfie.jpg"""
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    print(json.dumps(benchmark_preprocess.remote(_read(bg), _read(mask), _read(ref), out_size, repeats), indent=2))
+
+@app.local_entrypoint()
+def bench_transport(bg: str, mask: str, ref: str, prompt: str = "a child smiling, storybook illustration", seed: int = 0, repeats: int = 3):
+    """
+    Same inpaint request through /inpaint (base64 JSON) and /inpaint_bin
+    (multipart in, image/png out): bytes on the wire, client wall time and the
+    endpoint's Server-Timing. Needs the app deployed (modal deploy).
+
+    modal run modal_service.py::bench_transport --bg bg.png --mask mask.png --ref selfie.jpg
+    """
+    import urllib.request
+    import uuid
+
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    files = {"image": _read(bg), "mask": _read(mask), "ref_image": _read(ref)}
+    fields = {"prompt": prompt, "seed": str(seed)}
+
+    def _json_body():
+        body = dict(fields, seed=seed)
+        body.update({k: "data:image/png;base64," + base64.b64encode(v).decode("ascii") for k, v in files.items()})
+        return json.dumps(body).encode("utf-8"), "application/json"
+
+    def _multipart_body():
+        boundary = uuid.uuid4().hex
+        parts = []
+        for k, v in fields.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8"))
+        for k, v in files.items():
+            head = f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"; filename="{k}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+            parts.append(head.encode("utf-8") + v + b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode("utf-8"))
+        return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+    report = {}
+    for name, fn, make_body in (("json", inpaint, _json_body), ("binary", inpaint_bin, _multipart_body)):
+        url = fn.get_web_url()
+        runs = []
+        for _ in range(max(1, int(repeats))):
+            body, content_type = make_body()
+            req = urllib.request.Request(url, data=body, headers={"Content-Type": content_type}, method="POST")
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(req, timeout=600) as resp:
+                payload = resp.read()
+                server_timing = resp.headers.get("Server-Timing")
+            runs.append({
+                "request_bytes": len(body),
+                "response_bytes": len(payload),
+                "wall_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+                "server_timing": server_timing,
+            })
+        report[name] = {
+            "request_bytes": runs[-1]["request_bytes"],
+            "response_bytes": runs[-1]["response_bytes"],
+            "wall_ms_p50": _percentile([r["wall_ms"] for r in runs], 0.5),
+            "runs": runs,
+        }
+    report["raw_input_bytes"] = sum(len(v) for v in files.values())
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_book(bg: str, mask: str, ref: str, pages: int = 8, prompt: str = "a child exploring, storybook illustration", adapter: str = "none"):
+    """
+    Pages per minute for a per-page generate_inpaint_ref loop vs one
+    generate_book call over the same pages and seeds.
+
+    modal run modal_service.py::bench_book --bg bg.png --mask mask.png --ref selfie.jpg --pages 8
+    """
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    bg_bytes, mask_bytes, ref_bytes = _read(bg), _read(mask), _read(ref)
+    host = SDXLLoRAHost()
+    report = {}
+
+    t0 = time.perf_counter()
+    first = None
+    for i in range(pages):
+        host.generate_inpaint_ref.remote(
+            prompt=f"{prompt}, page {i + 1}", bg_image_bytes=bg_bytes, mask_bytes=mask_bytes,
+            ref_image_bytes=ref_bytes, seed=i, adapter=adapter,
+        )
+        first = first or time.perf_counter() - t0
+    total = time.perf_counter() - t0
+    report["per_page_loop"] = {"seconds": round(total, 2), "first_page_s": round(first, 2), "pages_per_min": round(60 * pages / total, 2)}
+
+    t0 = time.perf_counter()
+    first = None
+    book_pages = [
+        {"prompt": f"{prompt}, page {i + 1}", "image": bg_bytes, "mask": mask_bytes, "seed": i}
+        for i in range(pages)
+    ]
+    for _ in host.generate_book.remote_gen(pages=book_pages, ref_image_bytes=ref_bytes, adapter=adapter):
+        first = first or time.perf_counter() - t0
+    total = time.perf_counter() - t0
+    report["book"] = {"seconds": round(total, 2), "first_page_s": round(first, 2), "pages_per_min": round(60 * pages / total, 2)}
+    report["speedup"] = round(report["book"]["pages_per_min"] / report["per_page_loop"]["pages_per_min"], 3)
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_previews(steps: int = 30, preview_every: int = PREVIEW_EVERY, repeats: int = 3):
+    """modal run modal_service.py::bench_previews --preview-every 4"""
+    report = SDXLLoRAHost().benchmark_previews.remote(steps=steps, preview_every=preview_every, repeats=repeats)
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_lora_fuse(adapter: str = "anime", steps: int = 30, repeats: int = 3):
+    """modal run modal_service.py::bench_lora_fuse --adapter anime"""
+    report = SDXLLoRAHost().benchmark_lora_fuse.remote(adapter=adapter, steps=steps, repeats=repeats)
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_concurrency(requests: int = 16, levels: str = "1,2,4", steps: int = 30):
+    """
+    Seeded t2i through the async remote path with 1, 2 and 4 requests in
+    flight against one host class: images/s and p50 latency per level.
+
+    modal run modal_service.py::bench_concurrency --requests 16
+    """
+    host = SDXLLoRAHost()
+
+    async def _level(level: int, offset: int) -> dict:
+        gate = asyncio.Semaphore(level)
+        latencies = []
+
+        async def _one(i):
+            async with gate:
+                t0 = time.perf_counter()
+                # distinct seeds: never a result-cache hit
+                await host.generate_t2i.remote.aio(prompt=f"a lighthouse at dusk #{i}", steps=steps, seed=offset + i)
+                latencies.append((time.perf_counter() - t0) * 1000.0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(_one(i) for i in range(requests)))
+        return {
+            "images_per_s": round(requests / (time.perf_counter() - t0), 3),
+            "latency_ms_p50": round(_percentile(latencies, 0.5), 1),
+        }
+
+    report = {}
+    for n, level in enumerate(int(x) for x in levels.split(",")):
+        report[f"c{level}"] = asyncio.run(_level(level, 1000 * (n + 1)))
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_deepcache(intervals: str = "2,3,4", steps: int = 30):
+    """modal run modal_service.py::bench_deepcache --intervals 2,3,4"""
+    report = SDXLLoRAHost().benchmark_deepcache.remote(intervals=tuple(int(i) for i in intervals.split(",")), steps=steps)
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_buckets(requests_per_bucket: int = 3, steps: int = 30):
+    """
+    First-request vs steady-state denoise latency per t2i bucket, plus the
+    container's full per-bucket report (warmup ms at start included).
+
+    modal run modal_service.py::bench_buckets
+    """
+    host = SDXLLoRAHost()
+    for width, height in WARMUP_BUCKETS["t2i"]:
+        for _ in range(requests_per_bucket):
+            host.generate_t2i.remote(prompt="a lighthouse at dusk, storybook illustration", width=width, height=height, steps=steps)  # unseeded: never a result-cache hit
+    print(json.dumps(host.bucket_stats.remote(), indent=2))
+
+@app.local_entrypoint()
+def bench_mask_crop(bg: str, mask: str, ref: str, prompt: str = "a child smiling, storybook illustration", seed: int = 0, repeats: int = 3):
+    """modal run modal_service.py::bench_mask_crop --bg bg.png --mask mask.png --ref selfie.jpg"""
+    def _read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    report = SDXLLoRAHost().benchmark_mask_crop.remote(
+        prompt=prompt,
+        bg_image_bytes=_read(bg),
+        mask_bytes=_read(mask),
+        ref_image_bytes=_read(ref),
+        seed=seed,
+        repeats=repeats,
     )
-    return {"image": _png_bytes_to_b64(png), "safety": safety}
\ No newline at end of file
+    print(json.dumps(report, indent=2))
+
+@app.local_entrypoint()
+def bench_job_queue(bulk_jobs: int = 24, interactive_jobs: int = 6, users: int = 3, gpu_ms: float = 200.0):
+    """
+    Scheduler behaviour with the in-process backend (no GPU calls): a book
+    pre-render per user in the bulk tier, with readers' interactive pages
+    arriving mid-way. Reports wait-time percentiles per tier.
+
+    modal run modal_service.py::bench_job_queue --bulk-jobs 24 --interactive-jobs 6
+    """
+    def _fake_gpu(user: str, page: int):
+        time.sleep(gpu_ms / 1000.0)
+        return {"user": user, "page": page}
+
+    scheduler = _JobScheduler(_local_job_runners(t2i=_fake_gpu), slots=JOB_GPU_SLOTS)
+    ids = [
+        scheduler.submit("t2i", {"user": f"user{u}", "page": p}, user=f"user{u}", priority="bulk")
+        for p in range(bulk_jobs // users) for u in range(users)
+    ]
+    time.sleep(2 * gpu_ms / 1000.0)
+    ids += [
+        scheduler.submit("t2i", {"user": f"user{i % users}", "page": -1}, user=f"user{i % users}")
+        for i in range(interactive_jobs)
+    ]
+    for job_id in ids:
+        while scheduler.status(job_id, wait_s=5.0)["status"] not in JOB_TERMINAL:
+            pass
+    print(json.dumps(scheduler.stats(), indent=2))
@@ -0,0 +1,21 @@
+"""
+Shared fixtures: the tiny offline SDXLLoRAHost from bench_offline.py (no GPU,
+no network, no Hub weights). Needs the image's Python packages and the modal
+client, like the benchmark.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_offline  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def host():
+    with tempfile.TemporaryDirectory(prefix="sdxl-test-") as root:
+        with bench_offline._tiny_host(root) as host:
+            yield host
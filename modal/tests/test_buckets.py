@@ -0,0 +1,40 @@
+import io
+
+import pytest
+from PIL import Image
+
+import bench_offline as bench
+import modal_service as svc
+
+
+@pytest.fixture
+def loose_buckets(monkeypatch):
+    # 128² requests are "close" to the tiny host's 64² bucket
+    monkeypatch.setattr(svc, "BUCKET_AREA_TOLERANCE", 4.0)
+    monkeypatch.setattr(svc, "BUCKET_ASPECT_TOLERANCE", 0.05)
+
+
+def test_render_size_respects_the_tolerance():
+    buckets = ((1024, 1024), (1152, 896), (896, 1152))
+    assert svc._nearest_bucket(buckets, 1088, 1088, strict=True) == (1024, 1024)
+    assert svc._nearest_bucket(buckets, 512, 512, strict=True) == (512, 512)
+    assert svc._nearest_bucket(buckets, 768, 1344, strict=True) == (768, 1344)
+
+
+def test_t2i_returns_the_requested_size_when_a_bucket_renders_it(host, loose_buckets):
+    data, meta = host.generate_t2i(prompt="a fox in a forest", width=128, height=128, steps=2, seed=0)
+    assert Image.open(io.BytesIO(data)).size == (128, 128)
+    assert meta["size"] == [128, 128] and meta["render_size"] == [64, 64]
+
+
+def test_i2i_returns_the_requested_size_when_a_bucket_renders_it(host, loose_buckets):
+    init = bench._png(bench._photo(128, 128, 5))
+    data, meta = host.generate_i2i(prompt="a fox in a forest", image_bytes=init, out_size=128, steps=4, seed=0)
+    assert Image.open(io.BytesIO(data)).size == (128, 128)
+    assert meta["size"] == [128, 128] and meta["render_size"] == [64, 64]
+
+
+def test_web_i2i_prep_resizes_once_to_the_render_size(loose_buckets):
+    kwargs = svc._i2i_kwargs({"prompt": "a fox", "out_size": 128}, bench._png(bench._photo(200, 150, 5)))
+    assert Image.open(io.BytesIO(kwargs["image_bytes"])).size == (64, 64)
+    assert kwargs["out_size"] == 128
@@ -0,0 +1,24 @@
+import bench_offline as bench
+
+
+def _deepcache(host):
+    return host.cache_stats()["deepcache"]
+
+
+def _t2i(host, cache_interval, seed):
+    host.generate_t2i(
+        prompt="a fox in a forest", width=bench.SIZE, height=bench.SIZE, steps=bench.STEPS,
+        seed=seed, cache_interval=cache_interval,
+    )
+
+
+def test_calls_are_counted_only_inside_a_session(host):
+    _t2i(host, cache_interval=2, seed=0)   # installs the cache on the t2i UNet
+    before = _deepcache(host)
+    _t2i(host, cache_interval=1, seed=1)
+    assert _deepcache(host) == before
+
+    _t2i(host, cache_interval=2, seed=2)
+    after = _deepcache(host)
+    assert after["full_calls"] > before["full_calls"]
+    assert after["shallow_calls"] > before["shallow_calls"]
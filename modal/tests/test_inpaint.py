@@ -0,0 +1,43 @@
+import functools
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+import bench_offline as bench
+import modal_service as svc
+
+
+def _inpaint(host, bg, mask, crop_to_mask):
+    data, _ = host.generate_inpaint_ref(
+        prompt="a child smiling", bg_image_bytes=bench._png(bg), mask_bytes=bench._png(mask),
+        ref_image_bytes=bench._png(bench._photo(bench.SIZE, bench.SIZE, 7)),
+        out_size=max(bg.size), steps=2, seed=0, crop_to_mask=crop_to_mask,
+    )
+    return Image.open(io.BytesIO(data))
+
+
+@pytest.mark.parametrize("size", [(256, 128), (128, 256)])
+@pytest.mark.parametrize("path", ["full", "crop", "crop_fallback"])
+def test_non_square_canvas_keeps_its_size(host, monkeypatch, size, path):
+    # a small min_side so a crop fits the tiny canvases
+    monkeypatch.setattr(svc, "_mask_crop_box", functools.partial(svc._mask_crop_box, pad=8, min_side=64))
+    w, h = size
+    bg, mask = bench._photo(w, h, 6), Image.new("L", size, 0)
+    if path == "crop_fallback":
+        # mask covers most of the canvas: crop_to_mask falls back to the full-canvas run
+        ImageDraw.Draw(mask).rectangle((0, 0, w - 1, h - 1), fill=255)
+    else:
+        ImageDraw.Draw(mask).ellipse((8, 8, 40, 40), fill=255)
+    out = _inpaint(host, bg, mask, crop_to_mask=path != "full")
+    assert out.size == size
+
+
+def test_crop_keeps_pixels_outside_the_crop(host, monkeypatch):
+    monkeypatch.setattr(svc, "_mask_crop_box", functools.partial(svc._mask_crop_box, pad=8, min_side=64))
+    bg, mask = bench._photo(256, 128, 6), Image.new("L", (256, 128), 0)
+    ImageDraw.Draw(mask).ellipse((8, 8, 40, 40), fill=255)
+    out = _inpaint(host, bg, mask, crop_to_mask=True)
+    # right half is outside the crop box and must be the background's, untouched
+    assert np.array_equal(np.asarray(out)[:, 128:], np.asarray(bg)[:, 128:])
@@ -0,0 +1,107 @@
+"""
+_JobScheduler with the in-process backend: tier priority, the bulk interleave,
+per-user round-robin, queue positions and cancellation. A "gate" job holds the
+only slot while the rest are queued, so the dispatch order is deterministic.
+"""
+import threading
+
+import pytest
+
+import modal_service as svc
+
+
+@pytest.fixture
+def queue():
+    order, gate = [], threading.Event()
+
+    def run(name):
+        if name == "gate":
+            gate.wait(10)
+        order.append(name)
+        return name
+
+    def make(bulk_every=svc.JOB_BULK_EVERY):
+        return svc._JobScheduler(svc._local_job_runners(t2i=run), slots=1, bulk_every=bulk_every)
+
+    def start(scheduler, priority="bulk"):
+        # bulk gate: leaves the interactive streak at 0
+        job_id = scheduler.submit("t2i", {"name": "gate"}, user="gate", priority=priority)
+        assert scheduler.status(job_id, wait_s=5.0)["status"] == "running"
+        return job_id
+
+    def finish(scheduler, ids):
+        gate.set()
+        for job_id in ids:
+            while scheduler.status(job_id, wait_s=5.0)["status"] not in svc.JOB_TERMINAL:
+                pass
+        return [name for name in order if name != "gate"]
+
+    return make, start, finish
+
+
+def _submit(scheduler, jobs):
+    return [scheduler.submit("t2i", {"name": name}, user=user, priority=tier) for name, user, tier in jobs]
+
+
+def test_interactive_goes_before_bulk(queue):
+    make, start, finish = queue
+    scheduler = make()
+    start(scheduler)
+    ids = _submit(scheduler, [("b1", "u", "bulk"), ("b2", "u", "bulk"), ("i1", "u", "interactive")])
+    assert finish(scheduler, ids) == ["i1", "b1", "b2"]
+
+
+def test_bulk_gets_one_in_every_bulk_every(queue):
+    make, start, finish = queue
+    scheduler = make(bulk_every=2)
+    start(scheduler)
+    ids = _submit(scheduler, [(f"b{i}", "u", "bulk") for i in range(2)] + [(f"i{i}", "u", "interactive") for i in range(4)])
+    assert finish(scheduler, ids) == ["i0", "i1", "b0", "i2", "i3", "b1"]
+
+
+def test_users_take_turns_within_a_tier(queue):
+    make, start, finish = queue
+    scheduler = make()
+    start(scheduler)
+    ids = _submit(scheduler, [("a1", "a", "bulk"), ("a2", "a", "bulk"), ("a3", "a", "bulk"), ("b1", "b", "bulk")])
+    assert finish(scheduler, ids) == ["a1", "b1", "a2", "a3"]
+
+
+def test_ahead_matches_dispatch_order(queue):
+    make, start, finish = queue
+    scheduler = make(bulk_every=2)
+    start(scheduler)
+    ids = _submit(scheduler, [
+        ("b0", "a", "bulk"), ("b1", "b", "bulk"),
+        ("i0", "a", "interactive"), ("i1", "a", "interactive"), ("i2", "b", "interactive"), ("i3", "a", "interactive"),
+    ])
+    ahead = {name: scheduler.status(job_id)["ahead"] for job_id, name in zip(ids, ["b0", "b1", "i0", "i1", "i2", "i3"])}
+    order = finish(scheduler, ids)
+    assert order == ["i0", "i2", "b0", "i1", "i3", "b1"]
+    assert ahead == {name: order.index(name) for name in order}
+    assert all(scheduler.status(job_id)["ahead"] is None for job_id in ids)
+
+
+def test_cancel_queued_and_running(queue):
+    make, start, finish = queue
+    scheduler = make()
+    gate_id = start(scheduler)
+    hooks = []
+    scheduler._jobs[gate_id].on_cancel(lambda: hooks.append("gate"))
+    keep, drop = _submit(scheduler, [("keep", "u", "bulk"), ("drop", "u", "bulk")])
+
+    assert scheduler.cancel(drop) is True
+    assert scheduler.status(keep)["ahead"] == 0
+    assert scheduler.cancel(gate_id) is True
+    assert hooks == ["gate"]
+    # a runner that registers after the cancel is aborted straight away
+    scheduler._jobs[gate_id].on_cancel(lambda: hooks.append("late"))
+    assert hooks == ["gate", "late"]
+
+    assert finish(scheduler, [keep]) == ["keep"]
+    assert scheduler.status(drop)["status"] == "cancelled"
+    assert scheduler.status(gate_id)["status"] == "cancelled"
+    assert scheduler.result(keep) == ("done", "keep")
+    assert scheduler.cancel(keep) is False
+    assert scheduler.cancel("missing") is None
+    assert scheduler.stats()["counts"]["cancelled"] == 2
@@ -0,0 +1,29 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import bench_offline as bench
+import modal_service as svc
+
+
+def _render(host, adapter):
+    data, _ = host.generate_t2i(prompt="a fox in a forest", width=bench.SIZE, height=bench.SIZE, steps=bench.STEPS, seed=0, adapter=adapter)
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"), dtype=np.float32)
+
+
+def test_fused_render_stays_within_the_result_cache_tolerance(host, monkeypatch):
+    # fused and unfused renders share one result-cache key (see LORA_FUSE_TOLERANCE)
+    style = bench.STYLES[0]
+    monkeypatch.setattr(host.loras, "fuse_after", 1)
+    host._set_adapter("none")
+    try:
+        plain = _render(host, "none")
+        unfused = _render(host, style)
+        assert not host.loras.stats()["fused"]
+        fused = _render(host, style)
+        assert host.loras.stats()["fused_layers"] > 0
+    finally:
+        host._set_adapter("none")
+    assert np.abs(unfused - plain).mean() > svc.LORA_FUSE_TOLERANCE   # the style does change the image
+    assert np.abs(fused - unfused).mean() <= svc.LORA_FUSE_TOLERANCE
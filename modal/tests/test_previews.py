@@ -0,0 +1,23 @@
+import threading
+import time
+
+import bench_offline as bench
+
+
+def test_previews_are_pushed_before_the_result_returns(host, monkeypatch):
+    pushed, release = [], threading.Event()
+
+    def slow_push(progress_id, step, total, rgb):
+        release.wait(0.2)   # a preview still being encoded when the denoise ends
+        pushed.append((progress_id, step))
+
+    monkeypatch.setattr(host, "_push_preview", slow_push)
+    host.generate_t2i(
+        prompt="a fox in a forest", width=bench.SIZE, height=bench.SIZE, steps=bench.STEPS,
+        seed=0, progress_id="p1", preview_every=1,
+    )
+    done_at = len(pushed)
+    time.sleep(0.3)
+    assert done_at == len(pushed) > 0   # nothing lands after the call returned
+    assert {pid for pid, _ in pushed} == {"p1"}
+    assert "p1" not in host._previews
@@ -0,0 +1,28 @@
+import bench_offline as bench
+import modal_service as svc
+
+
+def _ref_png(seed):
+    return svc._transport_ref(bench._png(bench._photo(96, 64, seed)))
+
+
+def test_inline_bytes_key_the_entry_even_with_a_character_id(host):
+    png = _ref_png(1)
+    key, load = host._ref_source(png, "some-other-character")
+    assert key == svc._content_hash(png)
+    assert load().size == (512, 512)
+
+
+def test_reference_is_fetched_before_the_gpu_section_and_only_on_a_miss(host, monkeypatch):
+    png = _ref_png(2)
+    blob_id = svc._content_hash(png)
+    fetched = []
+    monkeypatch.setattr(host, "_blob", lambda blob: fetched.append(blob) or png)
+
+    source = host._ref_source(None, None, ref_image_id=blob_id)
+    assert fetched == [blob_id]   # fetched up front, outside any lock
+    host._ref_embeds(source, do_cfg=True)
+    assert fetched == [blob_id]   # the embed pass reuses it
+
+    host._ref_source(None, None, ref_image_id=blob_id)
+    assert fetched == [blob_id]   # cached embeds: no fetch at all